@@ -1,23 +1,38 @@
 from google_photos_auth import get_google_photos_credentials
-from googleapiclient.discovery import build
-from apiclient.http import BatchHttpRequest
+from photos_api import build_service, UPLOAD_URL
+from cr2_preview import preview_jpeg
+from upload_scheduler import UploadScheduler
+from sync_profiler import add_profile_arguments, start_profile
 import threading
-from httplib2 import Http
-from oauth2client import file, client, tools
 import os
 from urllib.request import pathname2url
 from time import sleep
 import subprocess
-import sys
+import datetime
+
+# Appended to the description of uploaded previews, so the RAW itself is still matched as missing
+PREVIEW_SUFFIX = " (preview)"
 
 class PhotoSync:
-	def __init__(self):
+	def __init__(self, preview=None, preview_workers=4, raw_workers=1):
+		"""
+			:param preview: None to upload the RAW files, 'only' to upload their embedded JPEG previews instead,
+				'first' to upload the previews and then the RAW files in a background lane.
+			:param preview_workers: Concurrent preview uploads.
+			:param raw_workers: Concurrent RAW uploads when previews are uploaded first.
+		"""
 		# Setup credentials
 		SCOPES = ['https://www.googleapis.com/auth/photoslibrary']
-		creds = get_google_photos_credentials(scopes=SCOPES)
-		self.service = build('photoslibrary', 'v1', credentials=creds)
+		self.creds = get_google_photos_credentials(scopes=SCOPES)
+		self.service = build_service(self.creds)
 		self.sync_directory = os.path.expanduser("~/Pictures")
 		self.photos = {}
+		self.preview = preview
+		self._local = threading.local()
+		self.scheduler = None
+		if preview is not None:
+			# RAW files wait in the large lane while any preview is queued
+			self.scheduler = UploadScheduler(self._runTask, 0, preview_workers, raw_workers, background_lane="large")
 
 	def uploadDirectory(self, album_id, path, subdir, times_in=0):
 		print("uploading {} {} {}".format(album_id, '/'.join(path), subdir))
@@ -32,7 +47,14 @@ class PhotoSync:
 				full_image_description = "-".join(path + [ subdir, image_file ])
 				image_filename = os.path.join(localpath, image_file)
 				print("photo {} / {} ==== {}".format(image_filename, image_file ,image_description))
-				if set((image_filename, full_image_description, image_description, image_file, pathname2url(image_file))) & set(self.photos[album_id]) == set():
+				if set((image_filename, full_image_description, image_description, image_file, pathname2url(image_file))) & set(self.photos[album_id]) != set():
+					continue
+				if self.scheduler is not None:
+					if full_image_description + PREVIEW_SUFFIX not in self.photos[album_id]:
+						self.scheduler.submit(0, 'preview', album_id, image_filename, full_image_description, lane="small")
+					if self.preview == 'first':
+						self.scheduler.submit(os.path.getsize(image_filename), 'raw', album_id, image_filename, full_image_description, lane="large")
+				else:
 					#self.uploadPhoto(album_id, image_filename, image_description)
 					#subprocess.Popen(['python','UploadPhotoToAlbume.py',album_id, image_filename, image_description])
 					subprocess.run(['python','UploadPhotoToAlbume.py',album_id, image_filename, full_image_description])
@@ -48,6 +70,9 @@ class PhotoSync:
 	def syncDirectory(self,subdir = None):
 		albums = self.listAlbums()
 		times = 0
+		dirThreads = []
+		if self.scheduler is not None:
+			self.scheduler.start()
 		for file_name in os.listdir(self.sync_directory):
 			if subdir is not None and subdir != file_name:
 				continue
@@ -78,15 +103,72 @@ class PhotoSync:
 				#self.photos.pop(album_id)
 				dirThread = threading.Thread(target=self.uploadDirectory, args=(album_id,[],file_name,0))
 				dirThread.start()
+				dirThreads.append(dirThread)
 				"""times += 1
 				if (times == 2):
 					sleep(30)
 					times = 0"""
+			elif file_name.endswith(('.cr2','.CR2')) and self.scheduler is not None:
+				self.scheduler.submit(0, 'preview', None, os.path.join(self.sync_directory, file_name), file_name, lane="small")
+				if self.preview == 'first':
+					self.scheduler.submit(os.path.getsize(os.path.join(self.sync_directory, file_name)), 'raw', "-", os.path.join(self.sync_directory, file_name), file_name, lane="large")
 			elif file_name.endswith(('.cr2','.CR2')):
 				 subprocess.Popen(['python','UploadPhotoToAlbume.py',"-",  os.path.join(self.sync_directory,file_name), file_name])
 				#imgThread = threading.Thread(target=self.uploadPhoto, args=('', os.path.join(self.sync_directory,file_name)))
 				#imgThread.start()
+		if self.scheduler is not None:
+			for dirThread in dirThreads:
+				dirThread.join()
+			self.scheduler.finish()
+
+	def _http(self):
+		""" httplib2 connections are not thread safe, so every upload thread gets its own authorized one. """
+		http = getattr(self._local, 'http', None)
+		if http is None:
+			import httplib2
+			import google_auth_httplib2
+			http = self._local.http = google_auth_httplib2.AuthorizedHttp(self.creds, http=httplib2.Http())
+		return http
 
+	def _runTask(self, kind, album_id, image_filename, description):
+		if kind == 'raw':
+			subprocess.run(['python','UploadPhotoToAlbume.py',album_id, image_filename, description])
+		elif not self.uploadPreview(album_id, image_filename, description) and self.preview == 'only':
+			print("no preview in {}, uploading the RAW file".format(image_filename))
+			subprocess.run(['python','UploadPhotoToAlbume.py',album_id or "-", image_filename, description])
+
+	def uploadPreview(self, album_id, image_filename, description):
+		"""
+		Upload the embedded JPEG preview of a RAW file, carrying the RAW's EXIF date (or its modification time when it has none).
+			:return: False when the file has no usable preview or its upload failed.
+		"""
+		date = datetime.datetime.fromtimestamp(os.path.getmtime(image_filename)).strftime("%Y:%m:%d %H:%M:%S")
+		try:
+			media = preview_jpeg(image_filename, date)
+		except (ValueError, OSError) as err:
+			print("error reading the preview of {}: {}".format(image_filename, err))
+			return False
+		import requests
+		headers = {
+			'Authorization': "Bearer " + self.creds.token,
+			'Content-Type': 'application/octet-stream',
+			'X-Goog-Upload-File-Name': '"' + pathname2url(os.path.splitext(os.path.basename(image_filename))[0] + '.JPG') + '"',
+			'X-Goog-Upload-Protocol': "raw",
+		}
+		try:
+			print("uploading preview {} ({} of {} bytes)".format(image_filename, len(media), os.path.getsize(image_filename)))
+			response = requests.post(UPLOAD_URL, data=media, headers=headers, timeout=600)
+			response.raise_for_status()
+			body = {"newMediaItems":[{'description': description + PREVIEW_SUFFIX, "simpleMediaItem": {"uploadToken": response.content.decode('utf8')}}]}
+			if album_id:
+				body["albumId"] = album_id
+			media_result = self.service.mediaItems().batchCreate(body=body).execute(http=self._http())
+			result = media_result['newMediaItemResults'][0]
+			print("\tPreview {} status {}".format(description, result.get('status')))
+		except Exception as err:
+			print("error uploading the preview of {}\n{}".format(image_filename, err))
+			return False
+		return 'mediaItem' in result and result.get('status', {}).get('code', 0) == 0
 
 	def listAlbums(self):
 		# Call the Photo v1 API
@@ -121,7 +203,7 @@ class PhotoSync:
 			print("uploadingv {}".format(photo_name))
 			with open(photo_name,"rb") as photo_file:
 				media = photo_file.read()
-				token=self.service._http.request('https://photoslibrary.googleapis.com/v1/uploads', method='POST', body=media,headers=headers)
+				token=self.service._http.request(UPLOAD_URL, method='POST', body=media,headers=headers)
 			body = {"albumId":album_id,"newMediaItems":[{'description':description if description is not None else os.path.basename(photo_name),"simpleMediaItem": {"uploadToken": token[1].decode('utf8')}}]}
 			media_result = self.service.mediaItems().batchCreate(body=body).execute()
 			print("\tFile {} status {}".format(photo_name.strip(self.sync_directory), media_result['newMediaItemResults'][0]['status']))
@@ -129,7 +211,16 @@ class PhotoSync:
 			print("error uploading {}\n{}".format(photo_name.strip(self.sync_directory),err))
 
 
-photo_sync = PhotoSync()
-
-photo_sync.syncDirectory(sys.argv[1] if len(sys.argv)>1 else None)
+if __name__ == "__main__":
+	import argparse
+	parser = argparse.ArgumentParser(description="Upload the .CR2 files of ~/Pictures to the 'CR2' album.")
+	parser.add_argument('directory', nargs='?', help='Only sync this top-level directory')
+	parser.add_argument('--preview', choices=('only', 'first'), help="Upload the embedded full-size JPEG previews: 'only' instead of the RAW files, 'first' before them with the RAW files queued in a background lane")
+	parser.add_argument('--preview-workers', type=int, default=4, help='Concurrent preview uploads')
+	parser.add_argument('--raw-workers', type=int, default=1, help='Concurrent RAW uploads after their previews')
+	add_profile_arguments(parser)
+	args = parser.parse_args()
+	start_profile(args, "CR2Sync")
+	photo_sync = PhotoSync(args.preview, args.preview_workers, args.raw_workers)
+	photo_sync.syncDirectory(args.directory)
 
@@ -1,10 +1,14 @@
 import os
 import hashlib
+import json
+import time
 from datetime import datetime
 from google_photos_auth import get_google_photos_credentials
-from googleapiclient.discovery import build
-from tqdm import tqdm
+from photos_api import build_service
+from blob_store import BlobStore, BLOB_DIRECTORY, MANIFEST
 import sys
+from sync_metrics import metrics, add_metrics_arguments, start_metrics_export, finish_metrics_export
+from sync_profiler import add_profile_arguments, start_profile
 debug = False
 
 if sys.version_info.major == 3 and sys.version_info.minor >= 10:
@@ -23,23 +27,160 @@ def ensure_dir(path):
     if not os.path.exists(path):
         os.makedirs(path)
 
-def download_photos(target_root, dry_run=False):
+# Downloads are written to <file>.part and renamed into place once complete, <file>.part.json describes the part
+PART_SUFFIX = ".part"
+DOWNLOAD_CHUNK = 1024 * 1024
+DOWNLOAD_RETRIES = 5
+
+class IncompleteDownload(Exception):
+    pass
+
+class ExpiredUrl(Exception):
+    pass
+
+def download_url(item):
+    """ Download URL of a media item's original bytes, videos need '=dv' instead of '=d'. """
+    return item['baseUrl'] + ("=dv" if 'video' in item.get('mediaMetadata', {}) else "=d")
+
+def _content_range(value):
+    """ (first byte, total size or None) of a 'bytes first-last/total' Content-Range header. """
+    span, _, total = value.partition(' ')[2].partition('/')
+    first = span.split('-')[0]
+    return int(first) if first.isdigit() else None, int(total) if total.isdigit() else None
+
+def _fetch_part(session, url, part_path, meta, chunk_size):
+    """
+    Append the missing bytes of a part file, or restart it when the server ignores the range or the content changed.
+        :return: Size of the complete part.
+    """
+    meta_path = part_path + ".json"
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {}
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+        if meta.get("validator"):
+            headers["If-Range"] = meta["validator"]
+    with session.get(url, headers=headers, stream=True, timeout=(30, 300)) as response:
+        if response.status_code == 416:
+            # The part already holds every byte when the range starts at the end of the content
+            if _content_range(response.headers.get("Content-Range", ""))[1] == offset:
+                return offset
+            os.remove(part_path)
+            raise IncompleteDownload(f"range {offset}- not satisfiable, restarting")
+        if response.status_code in (401, 403):
+            raise ExpiredUrl(f"{response.status_code} {response.reason}")
+        if response.status_code == 429 or response.status_code >= 500:
+            metrics.count("http_429" if response.status_code == 429 else "http_5xx")
+            raise IncompleteDownload(f"{response.status_code} {response.reason}")
+        response.raise_for_status()
+        if response.status_code == 206:
+            first, total = _content_range(response.headers.get("Content-Range", ""))
+            if first != offset:
+                raise IncompleteDownload(f"asked for bytes {offset}-, got {first}-")
+            mode = 'ab'
+        else:
+            if offset:
+                metrics.count("download_restarts")
+            length = response.headers.get("Content-Length")
+            total = int(length) if length and 'Content-Encoding' not in response.headers else None
+            mode = 'wb'
+            meta.update(validator=response.headers.get("ETag") or response.headers.get("Last-Modified"), size=total)
+            with open(meta_path, 'w') as meta_file:
+                json.dump(meta, meta_file)
+        with open(part_path, mode) as part:
+            for chunk in response.iter_content(chunk_size):
+                part.write(chunk)
+                metrics.count("bytes_downloaded", len(chunk))
+            part.flush()
+            os.fsync(part.fileno())
+    size = os.path.getsize(part_path)
+    if total is not None and size != total:
+        raise IncompleteDownload(f"{size} of {total} bytes")
+    return size
+
+def download_file(session, item, file_path, refresh_item=None, max_retries=DOWNLOAD_RETRIES, chunk_size=DOWNLOAD_CHUNK):
+    """
+    Download the original bytes of a media item to `file_path`. Bytes go to `file_path`.part, which a later attempt or run
+    resumes with an HTTP Range request, and the part is renamed into place only once its size matches the advertised length,
+    so an interrupted download never leaves a truncated file behind.
+        :param refresh_item: Callable returning the media item again, used when its baseUrl expired (they last 60 minutes).
+        :return: SHA-256 of the downloaded file.
+    """
+    import requests
+    part_path = file_path + PART_SUFFIX
+    meta_path = part_path + ".json"
+    meta = {}
+    if os.path.exists(meta_path):
+        with open(meta_path) as meta_file:
+            meta = json.load(meta_file)
+    if meta.get("id") != item.get("id") and os.path.exists(part_path):
+        # A part left by another item of the same name
+        os.remove(part_path)
+    meta["id"] = item.get("id")
+    attempt = 0
+    while True:
+        try:
+            with metrics.stage("download"), metrics.timed_call("baseUrl"):
+                _fetch_part(session, download_url(item), part_path, meta, chunk_size)
+            break
+        except ExpiredUrl:
+            if refresh_item is None or attempt >= max_retries:
+                raise
+            item = refresh_item()
+        except (IncompleteDownload, requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as err:
+            if attempt >= max_retries:
+                raise
+            print(f"Download of {file_path} interrupted ({err}), resuming")
+            time.sleep(min(2 ** attempt, 60))
+        attempt += 1
+        metrics.count("download_retries")
+    with metrics.stage("hash"):
+        sha256 = get_image_hash(part_path)
+    os.replace(part_path, file_path)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    return sha256
+
+def album_media_items(service, album_id):
+    """ Media items of an album, page by page. """
+    body = {"albumId": album_id, "pageSize": 100}
+    while True:
+        with metrics.timed_call("mediaItems:search"):
+            results = service.mediaItems().search(body=body).execute()
+        yield from results.get('mediaItems', [])
+        body["pageToken"] = results.get('nextPageToken')
+        if not body["pageToken"]:
+            return
+
+def download_photos(target_root, dry_run=False, album_folders=False):
+    """
+    Mirror the library under target_root/YYYY/MM/DD. Contents are stored once in a content-addressed blob store
+    and the date tree, the flat 'album' folder and (with album_folders) 'albums/<title>' are hardlinks to them.
+    """
     import requests
+    from tqdm import tqdm
     SCOPES = [
         'https://www.googleapis.com/auth/photoslibrary.readonly',
         'https://www.googleapis.com/auth/photoslibrary.appendonly',
         'https://www.googleapis.com/auth/photoslibrary.edit.appcreateddata'
     ]
     creds = get_google_photos_credentials(scopes=SCOPES)
-    service = build('photoslibrary', 'v1', credentials=creds)
+    service = build_service(creds)
+    session = requests.Session()
+    # Dry runs only read the manifest of an existing store and never create one
+    store = None
+    if not dry_run or os.path.exists(os.path.join(target_root, BLOB_DIRECTORY, MANIFEST)):
+        store = BlobStore(target_root)
 
     # Get all albums
     albums = {}
-    results = service.albums().list(pageSize=50, fields="nextPageToken,albums(id,title)").execute()
+    with metrics.timed_call("albums:list"):
+        results = service.albums().list(pageSize=50, fields="nextPageToken,albums(id,title)").execute()
     items = results.get('albums', [])
     page_token = results.get('nextPageToken')
     while page_token is not None:
-        results = service.albums().list(pageSize=50, fields="nextPageToken,albums(id,title)", pageToken=page_token).execute()
+        with metrics.timed_call("albums:list"):
+            results = service.albums().list(pageSize=50, fields="nextPageToken,albums(id,title)", pageToken=page_token).execute()
         items += results.get('albums', [])
         page_token = results.get('nextPageToken')
     for album in items:
@@ -47,16 +188,15 @@ def download_photos(target_root, dry_run=False):
 
     # Download all media items
     next_page_token = None
-    hashes = set()
     while True:
         body = {"pageSize": 100}
         if next_page_token:
             body["pageToken"] = next_page_token
-        results = service.mediaItems().list(**body).execute()
+        with metrics.timed_call("mediaItems:list"):
+            results = service.mediaItems().list(**body).execute()
         media_items = results.get('mediaItems', [])
         for item in tqdm(media_items, desc="Downloading photos"):
             filename = item.get('filename')
-            base_url = item.get('baseUrl')
             media_metadata = item.get('mediaMetadata', {})
             creation_time = media_metadata.get('creationTime')
             if not creation_time:
@@ -71,50 +211,66 @@ def download_photos(target_root, dry_run=False):
             day_dir = os.path.join(month_dir, day)
             ensure_dir(day_dir)
             file_path = os.path.join(day_dir, filename)
-            # Check for duplicates by hash
-            if os.path.exists(file_path):
+            refresh_item = lambda item_id=item.get('id'): service.mediaItems().get(mediaItemId=item_id).execute()
+            sha256 = store.lookup(item.get('id')) if store is not None else None
+            if sha256 is None:
                 if dry_run:
-                    print(f"[Dry Run] Would check hash for {file_path}")
-                    print(f"[Dry Run] {filename} already exists, skipping.")
+                    print(f"[Dry Run] Would download {filename} to {file_path}")
                     continue
-                import requests
-                if get_image_hash(file_path) == hashlib.sha256(requests.get(base_url + "=d").content).hexdigest():
-                    continue  # Already downloaded
+                try:
+                    staging_path = store.staging_path(item.get('id'))
+                    sha256 = download_file(session, item, staging_path, refresh_item)
+                except Exception as err:
+                    print(f"Failed to download {filename}: {err}")
+                    continue
+                size = os.path.getsize(staging_path)
+                if store.add(staging_path, sha256, item.get('id'), filename):
+                    metrics.count("files_downloaded")
+                    # Set file's modification and access time to photo creation time, shared by all its links
+                    try:
+                        ts = dt.timestamp()
+                        os.utime(store.blob_path(sha256), (ts, ts))
+                    except Exception as e:
+                        print(f"Failed to set timestamp for {file_path}: {e}")
                 else:
-                    # File exists but is different, skip or rename
-                    file_path = os.path.join(day_dir, f"{os.path.splitext(filename)[0]}_dup{os.path.splitext(filename)[1]}")
-            if dry_run:
-                print(f"[Dry Run] Would download {filename} to {file_path}")
+                    metrics.count("files_deduplicated")
+                    metrics.count("bytes_deduplicated", size)
+            elif dry_run:
                 continue
-            # Download the image
-            import requests
-            r = requests.get(base_url + "=d")
-            with open(file_path, 'wb') as f:
-                f.write(r.content)
-            # Set file's modification and access time to photo creation time
-            try:
-                ts = dt.timestamp()
-                os.utime(file_path, (ts, ts))
-            except Exception as e:
-                print(f"Failed to set timestamp for {file_path}: {e}")
-            # Add to album folder (symlink or copy) outside the year folder
-            album_dir = os.path.join(target_root, 'album')
-            ensure_dir(album_dir)
-            album_link = os.path.join(album_dir, filename)
-            if not os.path.exists(album_link):
-                try:
-                    os.symlink(file_path, album_link)
-                except Exception:
-                    pass  # On Windows, fallback to copy
+            # A different file of the same name goes to name_dup, a pre-store copy of the same content becomes a link
+            file_path, linked = store.place(sha256, file_path)
+            metrics.count("files_linked" if linked else "files_skipped")
+            # Add to album folder outside the year folder
+            store.place(sha256, os.path.join(target_root, 'album', filename))
     
         next_page_token = results.get('nextPageToken')
         if not next_page_token:
             break
 
+    if album_folders and not dry_run:
+        for album_id, title in albums.items():
+            album_dir = os.path.join(target_root, 'albums', (title or album_id).replace(os.sep, '_'))
+            for item in album_media_items(service, album_id):
+                sha256 = store.lookup(item.get('id'))
+                if sha256 is not None:
+                    store.place(sha256, os.path.join(album_dir, item.get('filename')))
+    if store is None:
+        return
+    blobs, blob_bytes = store.usage()
+    print(f"Blob store: {blobs} unique files, {blob_bytes / 1024 ** 2:.1f} MB"
+          + (f", {store.copies} copied because hardlinks are not supported" if store.copies else ""))
+    store.close()
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(description="Download Google Photos hierarchically by year/month/day/image-name, avoid duplicates, and put in year album.")
     parser.add_argument('--target', type=str, default=os.path.expanduser('~/Pictures'), help='Target root directory')
     parser.add_argument('--dry-run', action='store_true', help='Dry run: only print actions, do not download')
+    parser.add_argument('--album-folders', action='store_true', help='Also link every album into albums/<title>')
+    add_metrics_arguments(parser)
+    add_profile_arguments(parser)
     args = parser.parse_args()
-    download_photos(args.target, dry_run=args.dry_run)
+    start_metrics_export(args)
+    start_profile(args, "DownloadPhotos")
+    download_photos(args.target, dry_run=args.dry_run, album_folders=args.album_folders)
+    finish_metrics_export(args)
@@ -1,22 +1,37 @@
-from google_photos_auth import get_google_photos_credentials
-from googleapiclient.discovery import build
-from apiclient.http import BatchHttpRequest
+from google_photos_auth import get_google_photos_credentials, profile_path
+from photos_api import build_service, UPLOAD_URL
 import threading
 import os
 from urllib.request import pathname2url
 import sys
 import mimetypes
-from PIL import Image
 import datetime
-from PIL.ExifTags import TAGS
-from PIL import *
 from io import BytesIO
-import piexif
-import multiprocessing
 import time
-import googleapiclient.errors
 import logging
-import requests  # Import requests for large video uploads
+import hashlib
+import itertools
+# PIL, piexif, requests, httplib2 and googleapiclient.errors are imported where they are needed,
+# so that --list, --album-info and dry runs start without loading them
+from sync_metrics import metrics, add_metrics_arguments, start_metrics_export, finish_metrics_export
+from sync_profiler import add_profile_arguments, start_profile, profile_snapshot
+from upload_scheduler import UploadScheduler, BandwidthLimiter, parse_rate, parse_schedule, upload_priorities, UPLOAD_ORDERS, DEFAULT_RETRIES, DEFAULT_RETRY_DELAY
+from upload_stream import UploadStream, CHUNK_SIZE
+from sync_index import SyncIndex, DEFAULT_INDEX_PATH
+from catalogue_loader import CatalogueLoader, media_item_keys
+from compact_catalogue import CompactKeySet
+from album_registry import AlbumRegistry, load_albums, DEFAULT_ALBUMS_PATH
+from sync_plan import SyncPlan, BatchCollector, year_album, DEFAULT_QUEUE_PATH
+from storage_saver import StorageSaver, DEFAULT_MAX_DIMENSION, DEFAULT_QUALITY
+from perceptual_hash import BKTree, HASH_METHODS, image_hash
+from shard_leases import LeaseStore, ROOT_SHARD, DEFAULT_LEASE_TTL, shard_name, parse_shard, in_bucket
+from http2_transport import Http2Transport, DEFAULT_CONNECTIONS
+from sync_verify import VerifyReport, MISSING, EXTRA, MISMATCHED, default_sample_seed, in_sample, join_index, rehash
+
+# Transient server errors retried like quota errors
+RETRY_STATUSES = (500, 502, 503, 504)
+# Partial response mask for album listings: the dedup check only needs these fields
+MEDIA_ITEM_FIELDS = "nextPageToken,mediaItems(id,filename,description)"
 
 # Setup logger
 logger = logging.getLogger("PhotoSync")
@@ -27,6 +42,8 @@ logger.addHandler(handler)
 logger.setLevel(logging.INFO)
 
 def get_exif_creation_date(path):
+    from PIL import Image, UnidentifiedImageError
+    from PIL.ExifTags import TAGS
     try:
         image = Image.open(path)
     except UnidentifiedImageError:
@@ -48,6 +65,8 @@ def get_exif_creation_date(path):
 
 def inject_exif_datetime(image_bytes: bytes, datetime_str: str) -> bytes:
     """Injects EXIF DateTimeOriginal into image bytes in memory."""
+    from PIL import Image
+    import piexif
     img = Image.open(BytesIO(image_bytes))
 
     # Create EXIF data
@@ -61,237 +80,732 @@ def inject_exif_datetime(image_bytes: bytes, datetime_str: str) -> bytes:
 
 debug = False
 
+def scan_record(sync_directory, relative_path, description, album_title):
+    """ Local facts about one media file that every account's plan is built from. """
+    stat = os.stat(os.path.join(sync_directory, relative_path))
+    return {"path": relative_path, "description": description, "album": album_title, "size": stat.st_size, "mtime": stat.st_mtime}
+
+def read_capture_dates(sync_directory, files):
+    """
+    Add the capture date to scanned file records that have none yet: the EXIF date of images, the mtime otherwise.
+    `inject_date` marks the files whose date has to be written into their EXIF on upload.
+    """
+    for record in files:
+        if "date" in record:
+            continue
+        photo_name = os.path.join(sync_directory, record["path"])
+        exif_date = None
+        if mimetypes.guess_type(photo_name)[0].startswith('image/'):
+            with metrics.stage("metadata"):
+                exif_date = get_exif_creation_date(photo_name)
+        record["date"] = exif_date if exif_date is not None else datetime.datetime.fromtimestamp(record["mtime"])
+        record["inject_date"] = exif_date is None
+
+def read_perceptual_hashes(sync_directory, files, method='dhash', workers=4):
+    """ Add the perceptual hash of the image files among scanned file records that have none yet (RAW files excluded). """
+    from concurrent.futures import ThreadPoolExecutor
+    images = [record for record in files if "phash" not in record
+              and mimetypes.guess_type(record["path"])[0].startswith('image/') and mimetypes.guess_type(record["path"])[0] != 'image/raw']
+    # Draft-mode decoding is mostly spent in PIL's C code, which releases the GIL
+    with metrics.stage("perceptual_hash"), ThreadPoolExecutor(max_workers=workers) as executor:
+        for record, phash in zip(images, executor.map(lambda record: image_hash(os.path.join(sync_directory, record["path"]), method), images)):
+            record["phash"] = phash
+
+def is_root_media(file_name):
+    """ Files directly in the sync directory that are uploaded to the library (RAW files only sync inside albums). """
+    mime_type, _ = mimetypes.guess_type(file_name)
+    return mime_type is not None and ((mime_type.startswith('image/') and not mime_type == 'image/raw') or mime_type.startswith('video/'))
+
 if sys.version_info.major == 3 and sys.version_info.minor >= 10:
         import collections
         setattr(collections, "MutableMapping", collections.abc.MutableMapping)
 
 class PhotoSync:
-    def __init__(self, sync_directory='~/Pictures', dry_run=False, large_file_threshold=10 * 1024 * 1024):  # 10MB default
+    def __init__(self, sync_directory='~/Pictures', dry_run=False, large_file_threshold=10 * 1024 * 1024,  # 10MB default
+                 small_workers=4, large_workers=1, limiter=None, index=None, list_workers=4, albums_path=DEFAULT_ALBUMS_PATH,
+                 credentials_path=None, name=None, catalogue_spill_dir=None,
+                 near_duplicates=None, near_duplicate_distance=6, near_duplicate_hash='dhash', saver=None, transport=None,
+                 upload_order='size', album_round_robin=False, retries=DEFAULT_RETRIES, retry_delay=DEFAULT_RETRY_DELAY, queue_path=None):
         # Setup credentials
         SCOPES = [
             'https://www.googleapis.com/auth/photoslibrary.appendonly',
             'https://www.googleapis.com/auth/photoslibrary.readonly.appcreateddata',
             'https://www.googleapis.com/auth/photoslibrary.edit.appcreateddata'
         ]
-        self.creds = get_google_photos_credentials(scopes=SCOPES)
-        self.service = build('photoslibrary', 'v1', credentials=self.creds, static_discovery=False)
+        self.name = name  # Profile of the account, None for the default one
+        self.creds = get_google_photos_credentials(scopes=SCOPES, credentials_path=credentials_path)
+        self.service = build_service(self.creds, transport)
         self.sync_directory = os.path.expanduser(sync_directory)
-        self.photos = {}
-        self.albums = self.listAlbums()
         self.dry_run = dry_run
-        self.large_file_threshold = large_file_threshold  # Files larger than this will be uploaded using uploadLargeVideo
+        # Among duplicate titles prefer the albums a previous run created and persisted; dry runs must not persist fake ids
+        self.albums = AlbumRegistry(self._createAlbumRemote, self.listAlbums(preferred=load_albums(albums_path)),
+                                    None if dry_run else albums_path)
+        self.large_file_threshold = large_file_threshold  # Files larger than this are streamed in the large-file lane
+        self.small_workers = small_workers
+        self.large_workers = large_workers
+        self.limiter = limiter if limiter is not None else BandwidthLimiter()
+        self.index = index if index is not None else SyncIndex()
+        self._local = threading.local()
+        self.list_workers = list_workers
+        self.catalogue = CatalogueLoader(self._listAlbumPage, list_workers, spill_dir=catalogue_spill_dir)
+        # Uploaded files wait here for a full mediaItems:batchCreate, created media items for a full year album attachment
+        self._creates = BatchCollector(self._createMediaItems)
+        self._attachments = BatchCollector(self._addToAlbum)
+        # Optional StorageSaver downscaling JPEGs before upload
+        self.saver = saver
+        # Storage saver transforms of the plan being executed, see executePlan
+        self._transforms = None
+        # Optional Http2Transport shared by every thread instead of per-thread httplib2 and requests connections
+        self.transport = transport
+        # Perceptual near-duplicate check: None (off), 'report' or 'skip'
+        self.near_duplicates = near_duplicates
+        self.near_duplicate_distance = near_duplicate_distance
+        self.near_duplicate_hash = near_duplicate_hash
+        self._library_hashes = None
+        # Set in sharded mode when another worker took over the shard being uploaded
+        self.lease_lost = threading.Event()
+        # Queue order of the uploads (see upload_priorities), retry rounds of failed uploads, and the file
+        # persisting the uploads a run could not complete (None to drop them)
+        self.upload_order = upload_order
+        self.album_round_robin = album_round_robin
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.queue_path = queue_path
+        # Entries uploaded but not created because their whole mediaItems:batchCreate failed, and
+        # (year album title, media item ids) of failed albums:batchAddMediaItems calls
+        self._failed_creates = []
+        self._failed_attachments = []
 
-    def uploadPhotoToLibrary(self, photo_name, description=None, photo_date=None):
+    def _http(self):
+        """ httplib2 connections are not thread safe, so every upload thread gets its own authorized one. """
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            import httplib2
+            import google_auth_httplib2
+            http = self._local.http = google_auth_httplib2.AuthorizedHttp(self.creds, http=self.transport or httplib2.Http())
+        return http
+
+    def _session(self):
+        """ Per-thread requests session, so streaming uploads reuse their connection, or the shared HTTP/2 transport. """
+        if self.transport is not None:
+            return self.transport
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            import requests
+            session = self._local.session = requests.Session()
+        return session
+
+    def _postUpload(self, photo_name, media=None, chunk_size=CHUNK_SIZE):
         """
-        Upload a single photo to the Google Photos library.
-            :param photo_name: The path to the photo file.
-            :param description: Optional description for the photo.
+        Send the raw bytes of a file to the uploads endpoint.
+        The file is streamed through the thread's reused fixed-size buffer and hashed on the way, unless `media` holds bytes to send instead.
+            :return: (upload token, SHA-256 of the streamed file) or (None, None) on failure.
         """
-        if self.dry_run:
-            logger.info(f"[Dry Run] Would upload {photo_name} to library with description '{description}'")
-            return "dry_run_token"
         headers = {'Authorization': "Bearer " + self.creds.token,
                    'Content-Type': 'application/octet-stream',
                    'X-Goog-Upload-File-Name': '"' + pathname2url(os.path.basename(photo_name)) + '"',
                    'X-Goog-Upload-Protocol': "raw",
         }
-        try:
-            logger.info(f"Uploading {photo_name}")
+        digest = None
+        if media is not None:
+            self.limiter.consume(len(media))
+            with metrics.stage("upload_bytes"), metrics.timed_call("uploads"):
+                response = self._session().post(UPLOAD_URL, data=media, headers=headers, timeout=1800)
+            sent = len(media)
+        else:
             with open(photo_name, "rb") as photo_file:
-                media = photo_file.read()
-            if photo_date is not None:
-                media = inject_exif_datetime(media, photo_date.strftime("%Y:%m:%d %H:%M:%S"))
-            token = self.service._http.request('https://photoslibrary.googleapis.com/v1/uploads', method='POST', body=media, headers=headers)
-            body = {"newMediaItems": [{'description': description if description is not None else os.path.basename(photo_name), "simpleMediaItem": {"uploadToken": token[1].decode('utf8')}}]}
-            media_result = self.safe_batch_create(body)
-            if 'newMediaItemResults' in media_result and media_result['newMediaItemResults'] and media_result['newMediaItemResults'][0]['status']['message'] == 'Success':
-                logger.info(f"\tFile {photo_name.strip(self.sync_directory)} status {media_result['newMediaItemResults'][0]['status']}")
-                return token[1].decode('utf8')
-            else:
-                logger.error(f"Error uploading {photo_name.strip(self.sync_directory)}: {media_result}")
+                stream = UploadStream(photo_file, os.fstat(photo_file.fileno()).st_size, self.limiter, chunk_size)
+                with metrics.stage("upload_bytes"), metrics.timed_call("uploads"):
+                    response = self._session().post(UPLOAD_URL, data=stream, headers=headers, timeout=1800)
+            sent = stream.bytes_read
+            if stream.complete:
+                digest = stream.hexdigest()
+        if response.status_code != 200:
+            if response.status_code == 429:
+                metrics.count("http_429")
+            logger.error(f"Failed to upload {photo_name}: {response.status_code} {response.text}")
+            return None, None
+        metrics.count("bytes_uploaded", sent)
+        return response.content.decode('utf8'), digest
+
+    def _recordUpload(self, photo_name, sha256, description, media_item, phash=None):
+        """ Remember an uploaded file and the media item it became in the sync index. """
+        try:
+            stat = os.stat(photo_name)
+            self.index.record_upload(os.path.abspath(photo_name), stat.st_size, stat.st_mtime, sha256, description, media_item.get('id'), phash)
         except Exception as err:
-            logger.error(f"Error uploading {photo_name.strip(self.sync_directory)}\t{err}")
-        return None
+            logger.warning(f"Could not record {photo_name} in the sync index: {err}")
 
-    def addPhotoToAlbum(self, album_id, photo_token, description=None):
-        if self.dry_run:
-            logger.info(f"[Dry Run] Would add photo {description} (token: {photo_token}) to album {album_id}")
-            return
-        logger.info(f"Adding photo {description} to album {album_id}")
-        """ Add a photo to a specific album in Google Photos.
-            :param album_id: The ID of the album to add the photo to.
-            :param photo_id: The ID of the photo to add.
-            :param description: Optional description for the photo.
-        """
-        if not album_id:
-            logger.warning("No album ID provided, skipping adding photo to album.")
-            return
-        if photo_token is not None:
-            logger.info(f"Adding photo {description} to album {album_id} {self.albums.get(album_id, '')}")
-            body = {"albumId": album_id, "newMediaItems": [{"simpleMediaItem": {"uploadToken": photo_token}}]}
+    def _prepareMedia(self, photo_name, entry):
+        """
+        Bytes to send instead of streaming the file: the storage saver's downscaled JPEG, or a JPEG without EXIF date
+        with its planned date written in. Re-encoding in this process happens in memory, which is bounded by large_file_threshold.
+            :return: (media bytes, SHA-256 of the original file) or (None, None) to stream the file unchanged.
+        """
+        job = self._saverJob(entry)
+        if job is not None:
             try:
-                media_result = self.safe_batch_create(body)
-                logger.info(f"\tFile {media_result['newMediaItemResults'][0]['mediaItem']['description']} status {media_result['newMediaItemResults'][0]['status']}")
+                future = self._transforms.take(*job) if self._transforms is not None else self.saver.submit(*job)
+                # Waits only when the transform has not finished ahead of this upload
+                with metrics.stage("transform"):
+                    media, sha256, original_size = future.result()
+                if media is not None:
+                    metrics.count("bytes_saved", original_size - len(media))
+                    return media, sha256
             except Exception as err:
-                logger.error(f"Error adding media item {description if description is not None else os.path.basename(photo_token)}: {err}")
+                logger.warning(f"Could not downscale {photo_name}, uploading it unchanged: {err}")
+        if not entry["inject_date"] or entry["size"] > self.large_file_threshold or mimetypes.guess_type(photo_name)[0] != 'image/jpeg':
+            return None, None
+        with open(photo_name, "rb") as photo_file:
+            original = photo_file.read()
+        with metrics.stage("hash"):
+            sha256 = hashlib.sha256(original).hexdigest()
+        try:
+            with metrics.stage("metadata"):
+                date = datetime.datetime.fromisoformat(entry["date"])
+                return inject_exif_datetime(original, date.strftime("%Y:%m:%d %H:%M:%S")), sha256
+        except Exception as err:
+            logger.warning(f"Could not add EXIF date to {photo_name}, uploading it unchanged: {err}")
+            return original, sha256
 
-    def uploadPhotoToAlbum(self, album_id, photo_name, description=None):
-        if self.dry_run:
-            logger.info(f"[Dry Run] Would upload {photo_name} to album {album_id} with description '{description}'")
+    def _saverJob(self, entry):
+        """ (path, EXIF date to write or None) of the storage saver transform of a planned JPEG, None for other files. """
+        photo_name = os.path.join(self.sync_directory, entry["path"])
+        if self.saver is None or mimetypes.guess_type(photo_name)[0] != 'image/jpeg':
+            return None
+        return photo_name, datetime.datetime.fromisoformat(entry["date"]).strftime("%Y:%m:%d %H:%M:%S") if entry["inject_date"] else None
+
+    def uploadPlanEntry(self, entry):
+        """
+        Upload the bytes of one planned file. Its media item is created later, together with the other
+        files of its album, in a full mediaItems:batchCreate call.
+            :param entry: Upload entry of a SyncPlan.
+        """
+        photo_name = os.path.join(self.sync_directory, entry["path"])
+        if self.lease_lost.is_set():
+            logger.debug(f"Skipping {photo_name}, its shard is now synced by another worker")
             return
-        if not os.path.exists(photo_name):
+        try:
+            stat = os.stat(photo_name)
+        except OSError:
             logger.warning(f"Photo {photo_name} does not exist.")
+            metrics.count("files_failed")
             return
-        
-        photo_date = get_exif_creation_date(photo_name)
-        if photo_date is None:
-            photo_date = datetime.datetime.fromtimestamp(os.path.getmtime(photo_name))
-        
-        file_size = os.path.getsize(photo_name)
-        if file_size > self.large_file_threshold:
-            logger.info(f"File {photo_name} is larger than {self.large_file_threshold} bytes, using uploadLargeVideo")
-            photo_token = self.uploadLargeVideo(album_id, photo_name, description, photo_date)
-        else:
-            logger.info(f"File {photo_name} is smaller than {self.large_file_threshold} bytes, using uploadPhotoToLibrary")
-            # Upload photo to library and get the token
-            photo_token = self.uploadPhotoToLibrary(photo_name, description, photo_date)
-        if photo_token is None:
-            logger.error(f"Failed to upload photo {photo_name}, skipping adding to album.")
+        if stat.st_size != entry["size"] or stat.st_mtime != entry["mtime"]:
+            logger.info(f"{photo_name} changed since it was planned, uploading its current content")
+            entry = dict(entry, size=stat.st_size)
+        logger.info(f"Uploading {photo_name}")
+        media, sha256 = self._prepareMedia(photo_name, entry)
+        token, streamed_sha256 = self._postUpload(photo_name, media)
+        if token is None:
+            # Retried by the scheduler at the end of the run
+            return False
+        self._creates.add(entry["album"], (entry, token, sha256 or streamed_sha256))
+
+    def _createMediaItems(self, album_title, uploads):
+        """
+        Turn uploaded files into media items with one batchCreate call, directly inside their directory album.
+            :param album_title: Directory album title, '' for files that only go to the library.
+            :param uploads: Up to MAX_BATCH_ITEMS (entry, upload token, SHA-256) tuples.
+        """
+        album_id = None
+        if album_title:
+            try:
+                album_id = self.albums.ensure(album_title)
+            except Exception as err:
+                logger.error(f"Album {album_title} is not available, adding {len(uploads)} files to the library only: {err}")
+        body = {"newMediaItems": [{'description': entry["description"] if entry["description"] is not None else os.path.basename(entry["path"]),
+                                   "simpleMediaItem": {"uploadToken": token}} for entry, token, _ in uploads]}
+        if album_id:
+            body["albumId"] = album_id
+        try:
+            with metrics.stage("batch_create"):
+                media_result = self.safe_batch_create(body)
+        except Exception as err:
+            logger.error(f"Error creating {len(uploads)} media items in album '{album_title}': {err}")
+            metrics.count("files_failed", len(uploads))
+            self._failed_creates.extend(entry for entry, _, _ in uploads)
             return
+        results = {result.get("uploadToken"): result for result in media_result.get("newMediaItemResults", [])}
+        for entry, token, sha256 in uploads:
+            result = results.get(token, {})
+            media_item = result.get("mediaItem")
+            if media_item is None or result.get("status", {}).get("code", 0) != 0:
+                logger.error(f"Error uploading {entry['path']}: {result.get('status')}")
+                metrics.count("files_failed")
+                continue
+            logger.info(f"\tFile {entry['path']} status {result['status']}")
+            metrics.count("files_uploaded")
+            self._recordUpload(os.path.join(self.sync_directory, entry["path"]), sha256, entry["description"], media_item, entry.get("phash"))
+            year = year_album(entry)
+            if year is not None:
+                self._attachments.add(year, media_item["id"])
 
-        photo_year = photo_date.strftime('%Y')
-        
-        logger.info(f"Preparing to upload photo {photo_name} to album {album_id} for year {photo_year}")
-        if photo_token is not None:
-            if not album_id == "":
-                self.addPhotoToAlbum(album_id, photo_token, description)
-            if not album_id == self.albums.get(photo_year):
-                if not photo_year in self.albums:
-                    logger.info(f"Creating album for year {photo_year}")
-                    self.createAlbum(photo_year)
-                if photo_year in self.albums:
-                    self.addPhotoToAlbum(self.albums.get(photo_year), photo_token, description)
-                else:
-                    logger.warning(f"Year album {photo_year} does not exist, skipping adding photo to year album.")
-
-    def readPhotosInAlbum(self, album_id):
-        """
-        Read photos in a specific album.
-            :param album_id: The ID of the album to read photos from.
-        """
-        if album_id not in self.photos:
-            self.photos[album_id] = []
-            read_photos = True
-            search_album = {"pageSize": 100, "albumId": album_id}
-            photos_in_album = self.service.mediaItems().search(body=search_album).execute()
-            while read_photos and "mediaItems" in photos_in_album:
-                #print(photos_in_album)
-                self.photos[album_id] += [photo.get("description", photo.get("filename")) for photo in photos_in_album.get("mediaItems")]
-                search_album["pageToken"] = photos_in_album.get("nextPageToken")
-                if search_album["pageToken"] is None:
-                    read_photos = False
-                else:
-                    photos_in_album = self.service.mediaItems().search(body=search_album).execute()
-    
-    def uploadDirectory(self, album_id, path, subdir, times_in=0, force=False):
-        logger.info(f"Uploading {album_id} {os.path.join(path, subdir)}")
-        if(times_in == 0):
-            self.readPhotosInAlbum(album_id)
-            # read photos in album if album is not new                    
+    def _addToAlbum(self, album_title, media_ids):
+        """ Attach existing media items to an album (the year albums) with one batchAddMediaItems call. """
+        try:
+            album_id = self.albums.ensure(album_title)
+            request = self.service.albums().batchAddMediaItems(albumId=album_id, body={"mediaItemIds": media_ids})
+            with metrics.stage("album_add"):
+                self.safe_execute(request, "albums:batchAddMediaItems")
+            metrics.count("album_adds", len(media_ids))
+            logger.info(f"Added {len(media_ids)} media items to album {album_title}")
+        except Exception as err:
+            logger.error(f"Error adding {len(media_ids)} media items to album {album_title}: {err}")
+            # The media items are already in the sync index, a later scan would not attach them
+            self._failed_attachments.append((album_title, media_ids))
+
+    def _listAlbumPage(self, album_id, page_token=None):
+        """ Fetch one page of an album's media items, limited to the fields the dedup check needs. """
+        search_album = {"pageSize": 100, "albumId": album_id}
+        if page_token:
+            search_album["pageToken"] = page_token
+        with metrics.timed_call("mediaItems:search"):
+            return self.service.mediaItems().search(body=search_album, fields=MEDIA_ITEM_FIELDS).execute(http=self._http())
+
+    def scanDirectory(self, files, album_title, subdir, bucket=0, buckets=1):
+        """
+        Collect the media files of a directory tree, only stat()ing them.
+            :param files: List the file records are appended to, see scanSource.
+            :param bucket: Only collect the files of this hash bucket out of `buckets` (see shard_leases.in_bucket).
+        """
         localpath = os.path.join(self.sync_directory, subdir)
-        pool = multiprocessing.Pool(processes=2, maxtasksperchild=2)
-        upload_tasks = []
-        for image_file in os.listdir(localpath):
-            if os.path.isdir(os.path.join(localpath, image_file)):
+        with metrics.stage("scan"):
+            entries = [(image_file, os.path.isdir(os.path.join(localpath, image_file)), os.path.isfile(os.path.join(localpath, image_file))) for image_file in sorted(os.listdir(localpath))]
+        metrics.count("files_scanned", len(entries))
+        for image_file, is_dir, is_file in entries:
+            if is_dir:
                 if debug:
                     logger.info(f"Found subdirectory: {image_file}")
-                if image_file == '.' or image_file == '..':
-                    continue
-                self.uploadDirectory(album_id, path, os.path.join(subdir, image_file), times_in+1, force)
-            elif os.path.isfile(os.path.join(localpath, image_file)):
+                self.scanDirectory(files, album_title, os.path.join(subdir, image_file), bucket, buckets)
+            elif is_file:
                 mime_type, _ = mimetypes.guess_type(image_file)
                 if mime_type is None or not (mime_type.startswith('image/') or mime_type.startswith('video/') or mime_type == 'image/raw'):
                     if debug:
                         logger.info(f"Skipping non-image file: {image_file}")
                     continue
-                image_description = "-".join([subdir] + [image_file])
-                image_filename = os.path.join(localpath, image_file)
-                if not force and (image_description in self.photos[album_id] or image_file in self.photos[album_id] or pathname2url(image_file) in self.photos[album_id]):
-                    if debug:
-                        logger.info(f"File {image_file} already exists in photos, skipping upload.")
-                    continue
-                logger.info(f"media {image_filename} / {image_file} ==== {image_description}")
-                if self.dry_run:
-                    logger.info(f"[Dry Run] Would upload {image_filename} to album {album_id} with description '{image_description}'")
-                else:
-                    upload_tasks.append((album_id, image_filename, image_description))
-        if upload_tasks and not self.dry_run:
-            pool.starmap(self.uploadPhotoToAlbum, upload_tasks)
-            pool.close()
-            pool.join()
-        if times_in == 0:
-            self.photos.pop(album_id)
+                if in_bucket(os.path.join(subdir, image_file), bucket, buckets):
+                    files.append(scan_record(self.sync_directory, os.path.join(subdir, image_file), "-".join([subdir] + [image_file]), album_title))
 
-    def syncDirectory(self, subdir=None, force=False):
-        logger.info(f"Found {len(self.albums)} albums")
-        if subdir is not None:
-            logger.info(f"Syncing subdirectory: {subdir}")
-            directory = os.path.join(self.sync_directory, subdir)
-            if debug:
-                logger.info(f"subdir: {subdir}, directory: {directory}")
-            if not subdir in self.albums:
-                logger.info(f"Creating album for subdir: {subdir}")
-                if not self.dry_run:
-                    self.albums[subdir] = self.createAlbum(subdir)
-            return self.uploadDirectory(self.albums.get(subdir, ''), self.sync_directory, subdir, 0, force)
+    def scanSource(self, subdir=None, shard=None):
+        """
+        Walk the sync directory once and return a record per media file: path relative to the sync directory,
+        description, directory album title ('' for files directly in the sync directory), size and mtime.
+        Top-level directories map to albums of the same title.
+            :param subdir: Only scan this top-level directory.
+            :param shard: Only scan this shard (see listShards), overrides `subdir`.
+        """
+        files = []
         if not os.path.exists(self.sync_directory):
             logger.error(f"Directory {self.sync_directory} does not exist, exiting.")
-            return
-        times = 0
-        sync_pool = multiprocessing.Pool(processes=2, maxtasksperchild=2)
-        photos_pool = multiprocessing.Pool(processes=2, maxtasksperchild=2)
-        sync_task = []
-        photo_task = []
-        for file_name in os.listdir(self.sync_directory):
+            return files
+        bucket, buckets = 0, 1
+        if shard is not None:
+            subdir, bucket, buckets = parse_shard(shard)
+        if subdir == ROOT_SHARD:
+            entries = [file_name for file_name in sorted(os.listdir(self.sync_directory)) if not os.path.isdir(os.path.join(self.sync_directory, file_name))]
+        else:
+            entries = [subdir] if subdir is not None else sorted(os.listdir(self.sync_directory))
+        for file_name in entries:
             if os.path.isdir(os.path.join(self.sync_directory, file_name)):
-                logger.info(f"Searching for '{file_name}' in albums")
-                album_id = self.albums.get(file_name)
-                if album_id is None:
-                    if not self.dry_run:
-                        self.albums[file_name] = album_id = self.createAlbum(file_name)
-                        self.photos[album_id] = []
-                if self.dry_run:
-                    logger.info(f"[Dry Run] Would sync directory '{file_name}' to album {album_id}")
-                else:
-                    self.uploadDirectory(album_id, self.sync_directory, file_name, 0, force)
-                    logger.info(f"calling thread self.uploadDirectory {album_id} [] {file_name} 0")
-                    sync_task.append((album_id, [], file_name, 0, force))
-                times += 1
+                self.scanDirectory(files, file_name, file_name, bucket, buckets)
             else:
                 if debug:
                     logger.info(f"Found file: {file_name}")
-                mime_type, _ = mimetypes.guess_type(file_name)
-                if (mime_type.startswith('image/') and not mime_type == 'image/raw') or mime_type.startswith('video/'):
-                    if self.dry_run:
-                        logger.info(f"[Dry Run] Would upload {file_name} to library")
-                    else:
-                        photo_task.append(('', os.path.join(self.sync_directory, file_name), None))
-        if sync_task and not self.dry_run:
-            sync_pool.starmap(self.uploadDirectory, sync_task)
-            sync_pool.close()
-            sync_pool.join()
-        if photo_task and not self.dry_run:
-            photos_pool.starmap(self.uploadPhotoToAlbum, photo_task)
-            photos_pool.close()
-            photos_pool.join()
-
-    def listAlbums(self):
+                if is_root_media(file_name) and in_bucket(file_name, bucket, buckets):
+                    files.append(scan_record(self.sync_directory, file_name, None, ''))
+        return files
+
+    def newFiles(self, files, force=False):
+        """
+        Drop the scanned files already in their directory album of this account and, with near_duplicates 'skip',
+        the unchanged files a previous run skipped as near-duplicates.
+            :param force: Keep every file.
+            :return: (new file records, number of files skipped)
+        """
+        titles = sorted({record["album"] for record in files if record["album"]})
+        logger.info(f"Found {len(self.albums)} albums")
+        # List every existing album in the background while the albums are checked one after the other
+        self.catalogue.start([self.albums[title] for title in titles if title in self.albums])
+        by_album = {}
+        for record in files:
+            by_album.setdefault(record["album"], []).append(record)
+        new_files = []
+        skipped = 0
+        for title, records in by_album.items():
+            album_id = self.albums.get(title) if title else None
+            if force or not album_id:
+                new_files += records
+                continue
+            logger.info(f"Searching for '{title}' in albums")
+            keys = self.catalogue.wait(album_id)
+            for record in records:
+                image_file = os.path.basename(record["path"])
+                if record["description"] in keys or image_file in keys or pathname2url(image_file) in keys:
+                    skipped += 1
+                    if debug:
+                        logger.info(f"File {image_file} already exists in photos, skipping upload.")
+                else:
+                    new_files.append(record)
+            self.catalogue.forget(album_id)
+        if self.near_duplicates == 'skip' and not force:
+            new_files, known = self._dropKnownDuplicates(new_files)
+            skipped += known
+        metrics.count("files_skipped", skipped)
+        return new_files, skipped
+
+    def _dropKnownDuplicates(self, files):
+        """ :return: (the files the sync index has no unchanged near-duplicate row for, number of files dropped) """
+        kept = []
+        for record in files:
+            row = self.index.get(os.path.abspath(os.path.join(self.sync_directory, record["path"])))
+            if row and row["duplicate_of"] and row["size"] == record["size"] and abs(row["mtime"] - record["mtime"]) <= 1:
+                if debug:
+                    logger.info(f"File {record['path']} was skipped as a near-duplicate of {row['duplicate_of']} before, skipping it again.")
+            else:
+                kept.append(record)
+        return kept, len(files) - len(kept)
+
+    def findNearDuplicates(self, files):
+        """
+        Find the new images perceptually within near_duplicate_distance of an image this account uploaded before,
+        or of a larger new image (the larger file of a group is assumed to be the better copy).
+            :return: (files to upload, near-duplicate descriptions); in 'report' mode every file is still uploaded.
+        """
+        if not self.near_duplicates:
+            return files, []
+        read_perceptual_hashes(self.sync_directory, files, self.near_duplicate_hash)
+        if self._library_hashes is None:
+            self._library_hashes = BKTree((phash, os.path.relpath(path, self.sync_directory)) for path, phash in self.index.perceptual_hashes())
+        batch = BKTree()
+        near_duplicates = []
+        duplicate_paths = set()
+        for record in sorted(files, key=lambda record: record["size"], reverse=True):
+            if record.get("phash") is None:
+                continue
+            matches = [match for match in (self._library_hashes.nearest(record["phash"], self.near_duplicate_distance),
+                                           batch.nearest(record["phash"], self.near_duplicate_distance)) if match]
+            if not matches:
+                batch.add(record["phash"], record["path"])
+                continue
+            distance, original = min(matches, key=lambda match: match[0])
+            logger.info(f"{record['path']} is a near-duplicate of {original} (distance {distance})")
+            near_duplicates.append({"path": record["path"], "duplicate_of": original, "distance": distance})
+            duplicate_paths.add(record["path"])
+        metrics.count("near_duplicates", len(near_duplicates))
+        if self.near_duplicates == 'skip':
+            files = [record for record in files if record["path"] not in duplicate_paths]
+        return files, near_duplicates
+
+    def buildPlan(self, files, skipped=0, near_duplicates=None):
+        """ Turn new file records, with their capture dates read, into a plan including the albums to create. """
+        plan = SyncPlan(self.sync_directory, skipped=skipped, near_duplicates=near_duplicates)
+        for record in files:
+            if record["album"] and record["album"] not in self.albums:
+                plan.add_album(record["album"])
+            plan.add_upload(record["path"], record["description"], record["album"], record["size"], record["mtime"],
+                            record["date"], record["inject_date"], record.get("phash"))
+            year = year_album(plan.uploads[-1])
+            if year is not None and year not in self.albums:
+                plan.add_album(year)
+        return plan
+
+    def planSync(self, subdir=None, force=False, shard=None):
+        """
+        Compute the complete diff between the sync directory and the library without changing anything.
+            :param subdir: Only plan this top-level directory.
+            :param force: Plan every file, even those already in their album.
+            :param shard: Only plan this shard (see listShards), overrides `subdir`.
+            :return: SyncPlan
+        """
+        files, skipped = self.newFiles(self.scanSource(subdir, shard), force)
+        read_capture_dates(self.sync_directory, files)
+        files, near_duplicates = self.findNearDuplicates(files)
+        return self.buildPlan(files, skipped, near_duplicates)
+
+    def executePlan(self, plan):
+        """
+        Run a plan: create its albums up front, upload its files in the size lanes in the configured order, then create
+        their media items in batches of 50 per directory album and attach them to their year albums in batches of 50.
+        Failed uploads are retried at the end; what still did not complete, also when the run is interrupted, is saved
+        to the queue file for the next run.
+        """
+        if self.dry_run:
+            for title in plan.albums_to_create:
+                logger.info(f"[Dry Run] Would create album '{title}'")
+            for entry in plan.uploads:
+                logger.info(f"[Dry Run] Would upload {entry['path']} to album '{entry['album']}' with description '{entry['description']}'")
+            return
+        self._recordNearDuplicates(plan)
+        self.albums.ensure_all(plan.albums_to_create)
+        scheduler = UploadScheduler(self.uploadPlanEntry, self.large_file_threshold, self.small_workers, self.large_workers,
+                                    retries=self.retries, retry_delay=self.retry_delay)
+        priorities = upload_priorities(plan.uploads, self.upload_order, self.album_round_robin)
+        for entry, priority in zip(plan.uploads, priorities):
+            scheduler.submit(entry["size"], entry, priority=priority)
+        if self.saver is not None:
+            # Transform the JPEGs in the order the lanes take them, while the upload threads send earlier files
+            ordered = [entry for _, _, entry in sorted(zip(priorities, itertools.count(), plan.uploads))]
+            self._transforms = self.saver.stream([job for job in map(self._saverJob, ordered) if job is not None])
+        self._failed_creates = []
+        self._failed_attachments = []
+        # Year album attachments a previous run could not make
+        for title, media_ids in plan.attachments.items():
+            for media_id in media_ids:
+                self._attachments.add(title, media_id)
+        try:
+            scheduler.run()
+        except KeyboardInterrupt:
+            logger.warning("Interrupted, waiting for the running uploads")
+            scheduler.stop()
+            raise
+        finally:
+            if self._transforms is not None:
+                self._transforms.close()
+                self._transforms = None
+            # Media items of every album must exist before the remaining year album attachments are flushed
+            self._creates.close()
+            self._attachments.close()
+            metrics.count("files_failed", len(scheduler.failed))
+            if not scheduler.stopped:
+                self._retryAttachments()
+            attachments = {}
+            for title, media_ids in self._failed_attachments:
+                attachments.setdefault(title, []).extend(media_ids)
+            self._saveQueue(plan, [args[0] for args in scheduler.pending()] + self._failed_creates, attachments)
+
+    def _recordNearDuplicates(self, plan):
+        """ Index the near-duplicates the plan does not upload, so later runs neither hash them again nor report them missing. """
+        uploads = {entry["path"] for entry in plan.uploads}
+        for duplicate in plan.near_duplicates:
+            if duplicate["path"] in uploads:
+                continue
+            path = os.path.abspath(os.path.join(self.sync_directory, duplicate["path"]))
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            self.index.record_skip(path, stat.st_size, stat.st_mtime, duplicate["duplicate_of"])
+
+    def _retryAttachments(self):
+        """ Retry the failed year album attachments in the rounds and delays of the upload retries. """
+        for attempt in range(self.retries):
+            if not self._failed_attachments:
+                return
+            failed, self._failed_attachments = self._failed_attachments, []
+            delay = self.retry_delay * 2 ** attempt
+            logger.warning(f"Retrying {len(failed)} failed album attachments in {delay} seconds (round {attempt + 1} of {self.retries})")
+            time.sleep(delay)
+            for album_title, media_ids in failed:
+                self._addToAlbum(album_title, media_ids)
+
+    def _saveQueue(self, plan, entries, attachments=None):
+        """
+        Persist the entries of `plan` that did not complete, in upload order, and the year album attachments that
+        failed, or clear the queue when everything completed.
+        """
+        if not self.queue_path:
+            return
+        if not entries and not attachments:
+            if os.path.exists(self.queue_path):
+                os.remove(self.queue_path)
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.queue_path)), exist_ok=True)
+        titles = {title for entry in entries for title in (entry["album"], year_album(entry))}
+        # Albums created earlier in this run already exist, the resumed run finds them in the catalogue
+        albums = [title for title in plan.albums_to_create if title in titles and title not in self.albums]
+        SyncPlan(plan.source, albums, entries, created=plan.created,
+                 attachments=attachments).save(self.queue_path)
+        logger.warning(f"{len(entries)} uploads and {sum(len(ids) for ids in (attachments or {}).values())} album attachments "
+                       f"did not complete, they are queued in {self.queue_path} for the next run")
+
+    def resumeQueue(self):
+        """
+        Upload the files a previous run left in the queue file, before anything is planned: they are the most important
+        files of that run's order and do not wait for a scan and catalogue listing of the whole library.
+        """
+        if self.dry_run or not self.queue_path or not os.path.exists(self.queue_path):
+            return
+        try:
+            queued = SyncPlan.load(self.queue_path)
+        except Exception as err:
+            logger.warning(f"Could not read the upload queue {self.queue_path}, ignoring it: {err}")
+            return
+        if os.path.abspath(queued.source) != os.path.abspath(self.sync_directory):
+            logger.info(f"The upload queue {self.queue_path} belongs to {queued.source}, not resuming it")
+            return
+        pending = []
+        for entry in queued.uploads:
+            row = self.index.get(os.path.abspath(os.path.join(self.sync_directory, entry["path"])))
+            if row is None or row["size"] != entry["size"] or row["mtime"] != entry["mtime"]:
+                pending.append(entry)
+        logger.info(f"Resuming {len(pending)} uploads and {sum(len(ids) for ids in queued.attachments.values())} album attachments "
+                    f"queued by the run of {queued.created}")
+        queued.uploads = pending
+        self.executePlan(queued)
+
+    def syncDirectory(self, subdir=None, force=False):
+        plan = self.planSync(subdir, force)
+        logger.info(plan.summary(self.limiter.current_rate()))
+        self.executePlan(plan)
+        return plan
+
+    def verifySync(self, subdir=None, sample=0.0, limiter=None, seed=None):
+        """
+        Check that the sync directory is completely uploaded, without changing anything. Files of a directory are missing
+        when no media item of its album matches them, files at the root when the sync index has no record of them; files
+        the sync index records as skipped near-duplicates are not missing. Remote items of those albums without a local file are extra. Indexed files are mismatched when their size or mtime
+        changed, when their media item is no longer in the album, or when a re-hashed sample differs from the uploaded content.
+            :param sample: Fraction of the indexed files to re-hash.
+            :param limiter: BandwidthLimiter capping the re-hash reads.
+            :param seed: Sample selection seed, the current ISO week by default.
+            :return: VerifyReport
+        """
+        report = VerifyReport(self.sync_directory)
+        files = self.scanSource(subdir)
+        report.count("files", len(files))
+        # Keys of the local files per album, remote items are looked up in them as their pages arrive
+        local_keys = {}
+        for record in files:
+            if record["album"]:
+                image_file = os.path.basename(record["path"])
+                local_keys.setdefault(record["album"], CompactKeySet()).update((record["description"], image_file, pathname2url(image_file)))
+        for keys in local_keys.values():
+            keys.freeze()
+        titles = {self.albums[title]: title for title in local_keys if title in self.albums}
+        remote_ids = CompactKeySet()
+
+        def check_page(album_id, media_items):
+            report.count("remote_items", len(media_items))
+            remote_ids.update(media_item["id"] for media_item in media_items)
+            keys = local_keys[titles[album_id]]
+            for media_item in media_items:
+                if not any(key in keys for key in media_item_keys(media_item)):
+                    report.add(EXTRA, media_item.get("description") or media_item.get("filename"),
+                               f"in album {titles[album_id]} without a local file", media_item_id=media_item.get("id"))
+
+        loader = CatalogueLoader(self._listAlbumPage, self.list_workers, on_page=check_page, spill_dir=self.catalogue.spill_dir)
+        loader.start(list(titles))
+        by_album = {}
+        for record in files:
+            by_album.setdefault(record["album"], []).append(record)
+        flagged = set()
+        duplicates = set(self.index.duplicates())
+        for title, records in by_album.items():
+            if not title:
+                continue
+            album_id = self.albums.get(title)
+            keys = loader.wait(album_id) if album_id else None
+            for record in records:
+                image_file = os.path.basename(record["path"])
+                if os.path.abspath(os.path.join(self.sync_directory, record["path"])) in duplicates:
+                    continue
+                elif keys is None:
+                    report.add(MISSING, record["path"], f"album {title} does not exist")
+                elif not (record["description"] in keys or image_file in keys or pathname2url(image_file) in keys):
+                    report.add(MISSING, record["path"], f"not in album {title}")
+                else:
+                    continue
+                flagged.add(record["path"])
+            if album_id:
+                loader.forget(album_id)
+        loader.close()
+        remote_ids.freeze()
+
+        seed = seed if seed is not None else default_sample_seed()
+        candidates = []
+        records = sorted((os.path.abspath(os.path.join(self.sync_directory, record["path"])), record) for record in files)
+        with metrics.stage("verify_index"):
+            for path, record, row in join_index(records, self.index):
+                if record is None or record["path"] in flagged:
+                    continue
+                if row is None:
+                    if not record["album"]:
+                        report.add(MISSING, record["path"], "not in the sync index")
+                        flagged.add(record["path"])
+                    continue
+                if row["size"] != record["size"] or abs(row["mtime"] - record["mtime"]) > 1:
+                    report.add(MISMATCHED, record["path"], "changed since it was skipped as a near-duplicate" if row["duplicate_of"]
+                               else "changed since it was uploaded", size=record["size"], indexed_size=row["size"])
+                elif record["album"] and row["media_item_id"] and row["media_item_id"] not in remote_ids:
+                    report.add(MISMATCHED, record["path"], "its uploaded media item is no longer in the album", media_item_id=row["media_item_id"])
+                elif row["sha256"] and sample and in_sample(record["path"], sample, seed):
+                    candidates.append((path, record["path"], row))
+                    continue
+                else:
+                    continue
+                flagged.add(record["path"])
+        if candidates:
+            logger.info(f"Re-hashing {len(candidates)} sampled files")
+            with metrics.stage("verify_rehash"):
+                rehash(report, candidates, limiter)
+        report.counts["matched"] = len(files) - len(flagged | {finding["path"] for finding in report.findings[MISMATCHED]})
+        return report
+
+    def listShards(self, buckets=1):
+        """ Shards of the sync directory: every top-level directory, split in `buckets` hash buckets, and the files at its root. """
+        directories = []
+        root_media = False
+        for file_name in sorted(os.listdir(self.sync_directory)):
+            if os.path.isdir(os.path.join(self.sync_directory, file_name)):
+                directories.append(file_name)
+            elif is_root_media(file_name):
+                root_media = True
+        if root_media:
+            directories.append(ROOT_SHARD)
+        return [shard_name(directory, bucket, buckets) for directory in directories for bucket in range(buckets)]
+
+    def syncSharded(self, store, buckets=1, force=False):
+        """
+        Sync the sync directory together with every other worker sharing `store`: claim a shard, plan and execute it,
+        mark it done, until no shard is left. Shards of workers that stopped heartbeating are taken over.
+            :param store: LeaseStore of the run.
+            :param buckets: Hash buckets per top-level directory, more buckets spread a large directory over several workers.
+        """
+        store.register(self.listShards(buckets))
+        # Albums, year albums in particular, are created by one worker only
+        self.albums.create = lambda title: store.ensure_album(title, self._createAlbumRemote)
+        store.start_heartbeat(lambda shard: self.lease_lost.set())
+        synced = 0
+        try:
+            while True:
+                shard, stolen = store.claim()
+                if shard is None:
+                    break
+                for title, album_id in store.albums().items():
+                    if title not in self.albums:
+                        self.albums[title] = album_id
+                self.lease_lost.clear()
+                try:
+                    plan = self.planSync(force=force, shard=shard)
+                    logger.info(f"Shard {shard}{' (taken over)' if stolen else ''}: {plan.summary(self.limiter.current_rate())}")
+                    self.executePlan(plan)
+                except Exception as err:
+                    logger.error(f"Error syncing shard {shard}, giving it back: {err}")
+                    store.release(shard)
+                    continue
+                if self.lease_lost.is_set():
+                    logger.warning(f"Shard {shard} was taken over by another worker, not marking it done")
+                    continue
+                store.complete(shard)
+                synced += 1
+        finally:
+            logger.info(f"Synced {synced} shards, run progress: {store.progress()}")
+
+    def listAlbums(self, preferred=None):
+        """
+        Map album titles to ids. When several albums share a title, the id in `preferred` wins,
+        otherwise the album with the most media items.
+        """
+        preferred = preferred or {}
         # Call the Photo v1 API
-        results = self.service.albums().list(pageSize=50, fields="nextPageToken,albums(id,title,mediaItemsCount)").execute()
+        with metrics.timed_call("albums:list"):
+            results = self.service.albums().list(pageSize=50, fields="nextPageToken,albums(id,title,mediaItemsCount)").execute()
         items = results.get('albums', [])
         page_token = results.get('nextPageToken')
         while page_token is not None:
-            results = self.service.albums().list(pageSize=50, fields="nextPageToken,albums(id,title,mediaItemsCount)", pageToken=page_token).execute()
+            with metrics.timed_call("albums:list"):
+                results = self.service.albums().list(pageSize=50, fields="nextPageToken,albums(id,title,mediaItemsCount)", pageToken=page_token).execute()
             items += results.get('albums', [])
             page_token = results.get('nextPageToken')
         
@@ -299,7 +813,9 @@ class PhotoSync:
         albums = {}
         for album in items:
             if albums.get(album.get("title")) is not None:
-                if albums[album.get("title")].get("mediaItemsCount", 0) < album.get("mediaItemsCount", 0):
+                if albums[album.get("title")].get("id") == preferred.get(album.get("title")):
+                    continue
+                if album.get("id") == preferred.get(album.get("title")) or int(albums[album.get("title")].get("mediaItemsCount", 0)) < int(album.get("mediaItemsCount", 0)):
                     logger.info(f"Album {album.get('title')} has more media items, updating ID from {albums[album.get('title')]} to {album.get('id')}")
                     albums[album.get("title")] = album
             else:
@@ -308,24 +824,22 @@ class PhotoSync:
         return {albums[title].get("title"): albums[title].get("id") for title in albums if albums[title].get("id") is not None}
 
     def createAlbum(self,album_name):
-        """ thread safe create album """
-        # Use a mutex to ensure thread safety when creating albums
-        mutex = multiprocessing.Lock()
-        with mutex:
-            if album_name in self.albums:
-                logger.info(f"Album {album_name} already exists with ID {self.albums[album_name]}")
-                return self.albums[album_name]
-            if self.dry_run:
-                logger.info(f"[Dry Run] Would create album '{album_name}'")
-                # Simulate an album ID for dry run
-                fake_id = f"dry_run_album_{album_name}"
-                self.albums[album_name] = fake_id
-                return fake_id
-            results = self.service.albums().create(body={'album':{'title':album_name}}).execute()
-            logger.info("Album {a[title]}, ID: {a[id]}, Writeable: {a[isWriteable]}, URL: {a[productUrl]}".format(a=results))
-            if results and 'id' in results:
-                self.albums[album_name] = results["id"]
-            return results["id"]
+        """ thread safe create album: concurrent callers for the same title share a single create call """
+        if album_name in self.albums:
+            logger.info(f"Album {album_name} already exists with ID {self.albums[album_name]}")
+        return self.albums.ensure(album_name)
+
+    def _createAlbumRemote(self, album_name):
+        """ Create an album through the API, only called by the album registry. """
+        if self.dry_run:
+            logger.info(f"[Dry Run] Would create album '{album_name}'")
+            # Simulate an album ID for dry run
+            return f"dry_run_album_{album_name}"
+        with metrics.timed_call("albums:create"):
+            results = self.service.albums().create(body={'album':{'title':album_name}}).execute(http=self._http())
+        metrics.count("albums_created")
+        logger.info("Album {a[title]}, ID: {a[id]}, Writeable: {a[isWriteable]}, URL: {a[productUrl]}".format(a=results))
+        return results["id"]
 
     def uploadPhoto(self,album_id,photo_name,description=None):
         #batch = BatchHttpRequest()
@@ -339,7 +853,7 @@ class PhotoSync:
             logger.info(f"Uploading {photo_name}")
             with open(photo_name,"rb") as photo_file:
                 media = photo_file.read()
-                token=self.service._http.request('https://photoslibrary.googleapis.com/v1/uploads', method='POST', body=media,headers=headers)
+                token=self._http().request(UPLOAD_URL, method='POST', body=media,headers=headers)
             body = {"albumId":album_id,"newMediaItems":[{'description':description if description is not None else os.path.basename(photo_name),"simpleMediaItem": {"uploadToken": token[1].decode('utf8')}}]}
             media_result = self.safe_batch_create(body=body)
             logger.info(f"\tFile {photo_name.strip(self.sync_directory)} status {media_result['newMediaItemResults'][0]['status']}")
@@ -424,66 +938,78 @@ class PhotoSync:
         else:
             logger.warning(f"Unknown action: {action}")
 
-    def safe_batch_create(self, body, max_retries=5):
+    def safe_execute(self, request, endpoint, max_retries=5):
+        """ Execute an API request on the thread's connection, backing off while the quota is exceeded. """
+        import googleapiclient.errors
         for attempt in range(max_retries):
             try:
-                return self.service.mediaItems().batchCreate(body=body).execute()
+                with metrics.timed_call(endpoint):
+                    return request.execute(http=self._http())
             except googleapiclient.errors.HttpError as e:
-                if e.resp.status == 429:
+                if e.resp.status == 429 or e.resp.status in RETRY_STATUSES:
+                    metrics.count("http_429" if e.resp.status == 429 else "http_5xx")
+                    metrics.count("retries")
                     wait = 2 ** attempt
-                    logger.warning(f"Quota exceeded, retrying in {wait} seconds...")
+                    logger.warning(f"{'Quota exceeded' if e.resp.status == 429 else f'Server error {e.resp.status}'}, retrying in {wait} seconds...")
                     time.sleep(wait)
                 else:
                     raise
-        raise Exception("Too many retries for batchCreate")
+        raise Exception(f"Too many retries for {endpoint}")
 
-    def uploadLargeVideo(self, album_id, video_path, description=None, video_date=None, chunk_size=8 * 1024 * 1024):
-        """
-        Upload a large video file to Google Photos by streaming it in chunks.
-        Note: Google Photos API does not support resumable uploads, but streaming avoids loading the whole file into memory.
-        :param album_id: The album ID to add the video to.
-        :param video_path: Path to the video file.
-        :param description: Optional description.
-        :param chunk_size: Size of chunks to stream (default 8MB).
-        """
-        if self.dry_run:
-            logger.info(f"[Dry Run] Would upload large video {video_path} to album {album_id} with description '{description}'")
-            return
+    def safe_batch_create(self, body, max_retries=5):
+        return self.safe_execute(self.service.mediaItems().batchCreate(body=body), "mediaItems:batchCreate", max_retries)
 
-        headers = {
-            'Authorization': "Bearer " + self.creds.token,
-            'Content-Type': 'application/octet-stream',
-            'X-Goog-Upload-File-Name': '"' + pathname2url(os.path.basename(video_path)) + '"',
-            'X-Goog-Upload-Protocol': "raw",
-        }
-        upload_url = 'https://photoslibrary.googleapis.com/v1/uploads'
+
+def sync_accounts(accounts, subdir=None, force=False):
+    """
+    Sync one source tree to several accounts at once. The tree is walked once and the capture dates of the files
+    any account is missing are read once; then every account plans against its own library and uploads with its
+    own credentials, rate limiter and workers. The accounts' lanes all run smallest first, so a file read by one
+    account is usually still in the page cache when the next one uploads it.
+        :param accounts: PhotoSync instances of the accounts, sharing the same sync directory.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=len(accounts), thread_name_prefix="account") as executor:
+        list(executor.map(lambda account: account.resumeQueue(), accounts))
+    files = accounts[0].scanSource(subdir)
+
+    def execute(account, plan):
         try:
-            logger.info(f"Uploading large video {video_path} (streaming in chunks)")
-            with open(video_path, "rb") as video_file:
-                response = requests.post(upload_url, data=video_file, headers=headers, timeout=1800)
-            if response.status_code != 200:
-                logger.error(f"Failed to upload video {video_path}: {response.status_code} {response.text}")
-                return
-            upload_token = response.content.decode('utf-8')
-            body = {
-                "albumId": album_id,
-                "newMediaItems": [{
-                    'description': description if description else os.path.basename(video_path),
-                    "simpleMediaItem": {"uploadToken": upload_token}
-                }]
-            }
-            media_result = self.safe_batch_create(body)
-            if 'newMediaItemResults' in media_result and media_result['newMediaItemResults'] and media_result['newMediaItemResults'][0]['status']['message'] == 'Success':
-                logger.info(f"\tLarge video {video_path.strip(self.sync_directory)} status {media_result['newMediaItemResults'][0]['status']}")
-            else:
-                logger.error(f"Error uploading large video {video_path.strip(self.sync_directory)}: {media_result}")
+            account.executePlan(plan)
         except Exception as err:
-            logger.error(f"Error uploading large video {video_path.strip(self.sync_directory)}\t{err}")
-        return upload_token
-        
+            logger.error(f"[{account.name}] Sync failed: {err}")
+
+    with ThreadPoolExecutor(max_workers=len(accounts), thread_name_prefix="account") as executor:
+        new_files = list(executor.map(lambda account: account.newFiles(files, force), accounts))
+        # The records are shared, so a file new to several accounts has its date read once
+        needed = {id(record): record for account_files, _ in new_files for record in account_files}
+        read_capture_dates(accounts[0].sync_directory, list(needed.values()))
+        if accounts[0].near_duplicates:
+            read_perceptual_hashes(accounts[0].sync_directory, list(needed.values()), accounts[0].near_duplicate_hash)
+        plans = []
+        for account, (account_files, skipped) in zip(accounts, new_files):
+            account_files, near_duplicates = account.findNearDuplicates(account_files)
+            plans.append(account.buildPlan(account_files, skipped, near_duplicates))
+        for account, plan in zip(accounts, plans):
+            logger.info(f"[{account.name}] {plan.summary(account.limiter.current_rate())}")
+        list(executor.map(execute, accounts, plans))
+    return plans
+
+
+def _sync_kwargs(args, **overrides):
+    """ PhotoSync keyword arguments from the command line options. """
+    kwargs = dict(dry_run=args.dry_run, large_file_threshold=args.large_file_threshold, small_workers=args.small_workers,
+                  large_workers=args.large_workers, list_workers=args.list_workers, near_duplicates=args.near_duplicates,
+                  near_duplicate_distance=args.near_duplicate_distance, near_duplicate_hash=args.near_duplicate_hash,
+                  upload_order=args.upload_order, album_round_robin=args.album_round_robin, retries=args.retries,
+                  retry_delay=args.retry_delay)
+    kwargs.update(overrides)
+    return kwargs
+
 
 if __name__ == "__main__":
     import argparse
+    import json
     parser = argparse.ArgumentParser(description="Download Google Photos hierarchically by year/month/day/image-name, avoid duplicates, and put in year album.")
     parser.add_argument('--source', type=str, default=os.path.expanduser('~/Pictures'), help='Source root directory')
     parser.add_argument('--dry-run', action='store_true', help='Dry run: only print actions, do not download')
@@ -493,33 +1019,143 @@ if __name__ == "__main__":
     parser.add_argument('--debug', action='store_true', help='Enable debug output')
     parser.add_argument('directory', nargs='?', help='Directory to sync, if not specified, use the default sync directory')
     parser.add_argument('--force', action='store_true', help='Force upload even if the photo already exists in the album')
+    parser.add_argument('--plan', type=str, help='Only compute the sync plan and write it to this file (.json, or .json.gz compressed)')
+    parser.add_argument('--execute-plan', type=str, help='Execute a plan written by --plan instead of scanning the source directory')
+    parser.add_argument('--profiles', type=str, help='Comma separated account profiles synced concurrently, each with its credentials and state in ~/.PhotoSync/profiles/<profile>')
+    parser.add_argument('--profile-config', type=str, help='JSON file of per-profile settings: {"<profile>": {"max_upload_rate", "upload_schedule", "small_workers", "large_workers"}}')
+    parser.add_argument('--shard-store', type=str, help='Shared SQLite lease file: sync in shards together with every worker using the same file')
+    parser.add_argument('--shard-run', type=str, default=datetime.date.today().isoformat(), help='Run name, workers of the same run share its shards (default today)')
+    parser.add_argument('--shard-buckets', type=int, default=1, help='Split every top-level directory into this many shards by path hash')
+    parser.add_argument('--lease-ttl', type=int, default=DEFAULT_LEASE_TTL, help='Seconds after which the shard of a silent worker is taken over')
+    parser.add_argument('--large-file-threshold', type=int, default=10 * 1024 * 1024, help='Files larger than this many bytes use the large-file lane')
+    parser.add_argument('--small-workers', type=int, default=4, help='Concurrent uploads in the small-file lane')
+    parser.add_argument('--large-workers', type=int, default=1, help='Concurrent uploads in the large-file lane')
+    parser.add_argument('--max-upload-rate', type=str, help="Global upload cap in bytes/s, e.g. '2M' (default unlimited)")
+    parser.add_argument('--list-workers', type=int, default=4, help='Albums listed concurrently when loading the remote catalogue')
+    parser.add_argument('--catalogue-spill-dir', type=str, help='Keep the listed album keys in memory-mapped files in this directory instead of in memory')
+    parser.add_argument('--storage-saver', action='store_true', help='Downscale and recompress JPEGs in a process pool before uploading them')
+    parser.add_argument('--saver-max-dimension', type=int, default=DEFAULT_MAX_DIMENSION, help='Longest side of JPEGs uploaded in storage saver mode')
+    parser.add_argument('--saver-quality', type=int, default=DEFAULT_QUALITY, help='JPEG quality of the recompressed files')
+    parser.add_argument('--saver-workers', type=int, help='Transform processes (default one per core), transforms run ahead of the uploads in upload order')
+    parser.add_argument('--near-duplicates', choices=('report', 'skip'), help='Detect images perceptually close to an uploaded or larger new image, and only report or skip them')
+    parser.add_argument('--near-duplicate-distance', type=int, default=6, help='Largest Hamming distance (out of 64 bits) between near-duplicate hashes')
+    parser.add_argument('--near-duplicate-hash', choices=HASH_METHODS, default='dhash', help='Perceptual hash used by --near-duplicates')
+    parser.add_argument('--verify', action='store_true', help='Report missing, extra and mismatched files against the sync index and the remote albums instead of syncing')
+    parser.add_argument('--verify-sample', type=float, default=0.01, help='Fraction of the indexed files --verify re-hashes (the sample changes every week)')
+    parser.add_argument('--verify-rate', type=str, default='50M', help="Read rate cap of the --verify re-hashing in bytes/s, e.g. '50M'")
+    parser.add_argument('--verify-report', type=str, help='Write every --verify finding to this JSON file')
+    parser.add_argument('--http2', action='store_true', help="Multiplex uploads and API calls over shared HTTP/2 connections (needs httpx[http2])")
+    parser.add_argument('--upload-order', choices=UPLOAD_ORDERS, default='size', help="Upload order inside each lane: smallest files first, or newest/oldest capture date first")
+    parser.add_argument('--album-round-robin', action='store_true', help='Interleave the uploads of all albums instead of letting a large album go first')
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES, help='Rounds of retries of the failed uploads at the end of the run')
+    parser.add_argument('--retry-delay', type=float, default=DEFAULT_RETRY_DELAY, help='Seconds before the first retry round, doubled for each further round')
+    parser.add_argument('--queue-file', type=str, default=DEFAULT_QUEUE_PATH, help="JSON file keeping the uploads a run could not complete, uploaded first by the next run ('' to disable)")
+    parser.add_argument('--http2-connections', type=int, default=DEFAULT_CONNECTIONS, help='Connections per host of the HTTP/2 transport')
+    parser.add_argument('--albums-file', type=str, default=DEFAULT_ALBUMS_PATH, help='JSON file persisting the album title to ID registry')
+    parser.add_argument('--index', type=str, default=DEFAULT_INDEX_PATH, help='SQLite sync index recording uploaded files and their SHA-256')
+    parser.add_argument('--upload-schedule', type=str, help="Time-of-day upload caps, e.g. '08:00-23:00=1M,23:00-08:00=unlimited'")
+    add_metrics_arguments(parser)
+    add_profile_arguments(parser)
     args = parser.parse_args()
     if args.debug:
         logger.setLevel(logging.DEBUG)
         debug = True
+    start_metrics_export(args)
+    start_profile(args, "PhotoSync")
 
     # Pass dry_run to PhotoSync
-    photo_sync = PhotoSync(args.source if args.source else '~/Pictures', dry_run=args.dry_run)
-
-    if args.list:
-        albums = photo_sync.listAlbums()
-        print("Found {} albums:".format(len(albums)))
-        for title, album_id in albums.items():
-               print(f"{title} - {album_id}")
-        sys.exit(0)
-    if args.album_photos:
-        album_id = args.album_photos
-        if album_id.startswith('https://photos.app.goo.gl/'):
-             album_id = album_id.split('/')[-1]
-        logger.info(f"Album ID: {album_id}")
-        photo_sync.albumActions(album_id, 'photos')
-        sys.exit(0)
-    if args.album_info:
-        album_id = args.album_info
-        if album_id.startswith('https://photos.app.goo.gl/'):
-            album_id = album_id.split('/')[-1]
-        logger.info(f"Album ID: {album_id}")
-        photo_sync.albumActions(album_id, 'info')
-        sys.exit(0)
-    else:
-        photo_sync.syncDirectory(args.directory if args.directory else None, force=args.force)
+    limiter = BandwidthLimiter(parse_rate(args.max_upload_rate), parse_schedule(args.upload_schedule))
+    saver = StorageSaver(args.saver_max_dimension, args.saver_quality, args.saver_workers) if args.storage_saver else None
+    transport = None
+    if args.http2:
+        from photos_api import API_ROOT
+        try:
+            transport = Http2Transport(args.http2_connections, prior_knowledge=API_ROOT.startswith('http://'))
+        except ImportError as err:
+            parser.error(str(err))
+    try:
+        # Settings shared by the single account and every --profiles account, which override some of them
+        common = _sync_kwargs(args, saver=saver, transport=transport)
+        if args.profiles:
+            if args.plan or args.execute_plan or args.shard_store:
+                parser.error("--profiles cannot be combined with --plan, --execute-plan or --shard-store")
+            settings = {}
+            if args.profile_config:
+                with open(args.profile_config) as config_file:
+                    settings = json.load(config_file)
+            accounts = []
+            for profile in args.profiles.split(','):
+                options = settings.get(profile, {})
+                accounts.append(PhotoSync(args.source if args.source else '~/Pictures', **dict(
+                    common, small_workers=options.get('small_workers', args.small_workers), large_workers=options.get('large_workers', args.large_workers),
+                    limiter=BandwidthLimiter(parse_rate(options.get('max_upload_rate', args.max_upload_rate)),
+                                             parse_schedule(options.get('upload_schedule', args.upload_schedule))),
+                    index=SyncIndex(profile_path(profile, 'sync_index.sqlite')),
+                    albums_path=profile_path(profile, 'albums.json'), credentials_path=profile_path(profile, '.credentials.json'), name=profile,
+                    catalogue_spill_dir=args.catalogue_spill_dir and os.path.join(args.catalogue_spill_dir, profile),
+                    queue_path=args.queue_file and profile_path(profile, 'upload_queue.json'))))
+            sync_accounts(accounts, args.directory if args.directory else None, force=args.force)
+            finish_metrics_export(args, logger)
+            sys.exit(0)
+        plan = SyncPlan.load(args.execute_plan) if args.execute_plan else None
+        source = plan.source if plan is not None else args.source
+        photo_sync = PhotoSync(source if source else '~/Pictures', **dict(
+            common, limiter=limiter, index=SyncIndex(args.index), albums_path=args.albums_file,
+            catalogue_spill_dir=args.catalogue_spill_dir, queue_path=None if args.shard_store else args.queue_file))
+
+        if args.list:
+            albums = photo_sync.listAlbums()
+            print("Found {} albums:".format(len(albums)))
+            for title, album_id in albums.items():
+                   print(f"{title} - {album_id}")
+            sys.exit(0)
+        if args.album_photos:
+            album_id = args.album_photos
+            if album_id.startswith('https://photos.app.goo.gl/'):
+                 album_id = album_id.split('/')[-1]
+            logger.info(f"Album ID: {album_id}")
+            photo_sync.albumActions(album_id, 'photos')
+            sys.exit(0)
+        if args.album_info:
+            album_id = args.album_info
+            if album_id.startswith('https://photos.app.goo.gl/'):
+                album_id = album_id.split('/')[-1]
+            logger.info(f"Album ID: {album_id}")
+            photo_sync.albumActions(album_id, 'info')
+            sys.exit(0)
+        if args.verify:
+            report = photo_sync.verifySync(args.directory if args.directory else None, args.verify_sample,
+                                           BandwidthLimiter(parse_rate(args.verify_rate)))
+            print(report.summary())
+            if args.verify_report:
+                report.save(args.verify_report)
+                logger.info(f"Verification report written to {args.verify_report}")
+            finish_metrics_export(args, logger)
+            sys.exit(0 if report.clean else 1)
+        else:
+            if args.shard_store and not (plan or args.plan or args.dry_run):
+                store = LeaseStore(args.shard_store, args.shard_run, ttl=args.lease_ttl)
+                try:
+                    photo_sync.syncSharded(store, args.shard_buckets, force=args.force)
+                finally:
+                    store.close()
+                finish_metrics_export(args, logger)
+                sys.exit(0)
+            if plan is None:
+                if not args.plan:
+                    photo_sync.resumeQueue()
+                plan = photo_sync.planSync(args.directory if args.directory else None, force=args.force)
+                profile_snapshot("plan")
+            print(plan.summary(limiter.current_rate()))
+            if args.plan:
+                plan.save(args.plan)
+                logger.info(f"Plan written to {args.plan}")
+            else:
+                photo_sync.executePlan(plan)
+            finish_metrics_export(args, logger)
+    finally:
+        # Shut down the transform processes and the HTTP/2 connections on every exit path
+        if saver is not None:
+            saver.close()
+        if transport is not None:
+            transport.close()
@@ -1,13 +1,16 @@
 from google_photos_auth import get_google_photos_credentials
-from googleapiclient.discovery import build
+from photos_api import build_service, UPLOAD_URL
 import os
 import sys
 from urllib.request import pathname2url
-import requests
+from sync_profiler import profile_process
 if sys.version_info.major == 3 and sys.version_info.minor >= 10:
         import collections
         setattr(collections, "MutableMapping", collections.abc.MutableMapping)
 
+# Merged into the parent's profile when CR2Sync or VideoSync run with --profile
+profile_process("upload")
+
 
 # Setup credentials and service
 SCOPES = [
@@ -16,10 +19,11 @@ SCOPES = [
     'https://www.googleapis.com/auth/photoslibrary.edit.appcreateddata'
 ]
 creds = get_google_photos_credentials(scopes=SCOPES)
-service = build('photoslibrary', 'v1', credentials=creds)
+service = build_service(creds)
 sync_directory = os.path.expanduser("~/Pictures")
 
 def uploadPhoto(album_id, photo_name, description=None):
+    import requests
     headers = {
         'Authorization': "Bearer " + creds.token,
         'Content-Type': 'application/octet-stream',
@@ -33,7 +37,7 @@ def uploadPhoto(album_id, photo_name, description=None):
     }]}
     try:
         print("uploading {}".format(photo_name))
-        upload_url = 'https://photoslibrary.googleapis.com/v1/uploads'
+        upload_url = UPLOAD_URL
         response = requests.post(upload_url, data=media, headers=headers)
         token = response.content
     except Exception as err:
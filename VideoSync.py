@@ -1,21 +1,19 @@
 from google_photos_auth import get_google_photos_credentials
-from googleapiclient.discovery import build
-from apiclient.http import BatchHttpRequest
+from photos_api import build_service, UPLOAD_URL
 import threading
-from httplib2 import Http
-from oauth2client import file, client, tools
 import os
 from urllib.request import pathname2url
 from time import sleep
 import subprocess
 import sys
+from sync_profiler import add_profile_arguments, start_profile
 
 class PhotoSync:
 	def __init__(self,extentions=('.jpg','.JPG','.png','.PNG','.gif','.GIf','.jpeg',), directory='~/Pictures'):
 		# Setup credentials
 		SCOPES = ['https://www.googleapis.com/auth/photoslibrary']
 		creds = get_google_photos_credentials(scopes=SCOPES)
-		self.service = build('photoslibrary', 'v1', credentials=creds)
+		self.service = build_service(creds)
 		self.sync_directory = os.path.expanduser(directory)
 		self.extentions=extentions
 		self.photos = {}
@@ -123,7 +121,7 @@ class PhotoSync:
 			print("uploadingv {}".format(photo_name))
 			with open(photo_name,"rb") as photo_file:
 				media = photo_file.read()
-				token=self.service._http.request('https://photoslibrary.googleapis.com/v1/uploads', method='POST', body=media,headers=headers)
+				token=self.service._http.request(UPLOAD_URL, method='POST', body=media,headers=headers)
 			body = {"albumId":album_id,"newMediaItems":[{'description':description if description is not None else os.path.basename(photo_name),"simpleMediaItem": {"uploadToken": token[1].decode('utf8','surrogateescape')}}]}
 			media_result = self.service.mediaItems().batchCreate(body=body).execute()
 			print("\tFile {} status {}".format(photo_name.strip(self.sync_directory), media_result['newMediaItemResults'][0]['status']))
@@ -132,10 +130,16 @@ class PhotoSync:
 
 
 if 'Video' in sys.argv[0]:
+	import argparse
+	parser = argparse.ArgumentParser(description="Upload the videos of ~/Pictures and ~/Videos.")
+	parser.add_argument('directory', nargs='?', help='Only sync this top-level directory')
+	add_profile_arguments(parser)
+	args = parser.parse_args()
+	start_profile(args, "VideoSync")
 	photo_sync = PhotoSync(('.mov','.MOV','.AVI','.avi','.mp4','.ogv','.m4v','.ogg',))
-	photo_sync.syncDirectory(sys.argv[1] if len(sys.argv)>1 else None)
+	photo_sync.syncDirectory(args.directory)
 	photo_sync = PhotoSync(('.mov','.MOV','.AVI','.avi','.mp4','.ogv','.m4v','.ogg',),'~/Videos')
-	photo_sync.syncDirectory(sys.argv[1] if len(sys.argv)>1 else None)
+	photo_sync.syncDirectory(args.directory)
 else:
 	photo_sync = PhotoSync()
 	photo_sync.syncDirectory(sys.argv[1] if len(sys.argv)>1 else None)
@@ -0,0 +1,120 @@
+"""
+Process-wide album registry for PhotoSync. Maps album titles to ids for every upload thread,
+makes concurrent requests for the same missing album share one albums().create call, and persists
+the map to ~/.PhotoSync/albums.json so later runs keep using the albums this one created.
+"""
+import json
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+logger = logging.getLogger("PhotoSync")
+
+DEFAULT_ALBUMS_PATH = os.path.expanduser('~/.PhotoSync/albums.json')
+
+
+def load_albums(path=DEFAULT_ALBUMS_PATH):
+    """ Title -> id map saved by a previous run, empty if there is none. """
+    if not path or not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as albums_file:
+            return json.load(albums_file)
+    except (OSError, ValueError) as err:
+        logger.warning(f"Ignoring unreadable album registry {path}: {err}")
+        return {}
+
+
+class AlbumRegistry:
+    """
+        :param create: Callable (title) -> album id performing the remote creation.
+        :param albums: Initial title -> id map, normally the remote album listing.
+        :param path: JSON file the map is saved to after every creation (None to disable).
+    """
+    def __init__(self, create, albums=None, path=DEFAULT_ALBUMS_PATH):
+        self.create = create
+        self.albums = dict(albums or {})
+        self.path = path
+        self._lock = threading.Lock()
+        self._inflight = {}
+
+    def __contains__(self, title):
+        return title in self.albums
+
+    def __getitem__(self, title):
+        return self.albums[title]
+
+    def __setitem__(self, title, album_id):
+        with self._lock:
+            self.albums[title] = album_id
+
+    def __len__(self):
+        return len(self.albums)
+
+    def get(self, title, default=None):
+        return self.albums.get(title, default)
+
+    def items(self):
+        return list(self.albums.items())
+
+    def ensure(self, title):
+        """
+        Return the id of album `title`, creating it if needed.
+        While one thread creates an album, other threads asking for the same title wait for its result
+        instead of creating a duplicate.
+        """
+        with self._lock:
+            if title in self.albums:
+                return self.albums[title]
+            pending = self._inflight.get(title)
+            owner = pending is None
+            if owner:
+                pending = self._inflight[title] = Future()
+        if not owner:
+            return pending.result()
+        try:
+            album_id = self.create(title)
+            with self._lock:
+                if album_id:
+                    self.albums[title] = album_id
+                self._inflight.pop(title, None)
+            pending.set_result(album_id)
+        except Exception as err:
+            with self._lock:
+                self._inflight.pop(title, None)
+            pending.set_exception(err)
+            raise
+        self.save()
+        return album_id
+
+    def ensure_all(self, titles, workers=4):
+        """ Create every missing album of `titles` up front, concurrently. Returns the title -> id map of `titles`. """
+        missing = sorted({title for title in titles if title not in self.albums})
+        if missing:
+            logger.info(f"Creating {len(missing)} albums up front: {', '.join(missing)}")
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="albums") as executor:
+                for title, result in zip(missing, executor.map(self._ensure_logged, missing)):
+                    if result is None:
+                        logger.warning(f"Album {title} could not be created up front, it will be retried on first use")
+        return {title: self.albums.get(title) for title in titles}
+
+    def _ensure_logged(self, title):
+        try:
+            return self.ensure(title)
+        except Exception as err:
+            logger.error(f"Error creating album {title}: {err}")
+            return None
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            data = json.dumps(self.albums, indent=1, sort_keys=True)
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as albums_file:
+            albums_file.write(data)
+        os.replace(tmp_path, self.path)
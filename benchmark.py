@@ -0,0 +1,488 @@
+"""
+Offline benchmark suite for the PhotoSync scripts.
+Starts fake_photos_server.py, generates a synthetic photo tree in a throw-away HOME, runs each
+script as a subprocess against it and reports files/s, MB/s, API calls per file and peak RSS.
+    python benchmark.py --files 200 --albums 4 --targets photosync,download --output bench.json
+    python benchmark.py --baseline bench.json     # exit code 1 when a metric regressed
+"""
+import datetime
+import json
+import os
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+from fake_photos_server import start_http2_server, start_server
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+TARGETS = ('photosync', 'download', 'cr2', 'cr2_preview', 'video', 'startup', 'catalogue', 'saver', 'http2')
+
+
+def write_fake_credentials(home):
+    """ Authorized-user credentials that google_photos_auth accepts without refreshing. """
+    credentials_dir = os.path.join(home, '.PhotoSync')
+    os.makedirs(credentials_dir, exist_ok=True)
+    with open(os.path.join(credentials_dir, '.credentials.json'), 'w') as out:
+        json.dump({"token": "benchmark-token", "refresh_token": "benchmark", "client_id": "benchmark",
+                   "client_secret": "benchmark", "expiry": "2099-01-01T00:00:00Z"}, out)
+
+
+def _jpeg_templates(count, width, height, seed):
+    from PIL import Image
+    rng = random.Random(seed)
+    templates = []
+    for _ in range(count):
+        bands = [Image.effect_noise((width, height), rng.randint(20, 80)) for _ in range(3)]
+        output = BytesIO()
+        Image.merge('RGB', bands).save(output, format='JPEG', quality=90)
+        templates.append(output.getvalue())
+    return templates
+
+
+def _camera_like_jpeg(width, height, seed, quality=95):
+    """ A JPEG that compresses like a photo (smooth areas plus sensor grain) rather than like pure noise. """
+    from PIL import Image
+    rng = random.Random(seed)
+    bands = [Image.effect_noise((max(1, width // 64), max(1, height // 64)), rng.randint(40, 90)).resize((width, height), Image.BICUBIC)
+             for _ in range(3)]
+    image = Image.blend(Image.merge('RGB', bands), Image.merge('RGB', [Image.effect_noise((width, height), 30)] * 3), 0.08)
+    output = BytesIO()
+    image.save(output, format='JPEG', quality=quality)
+    return output.getvalue()
+
+
+def _with_exif_date(jpeg_bytes, date):
+    import piexif
+    exif_bytes = piexif.dump({"Exif": {piexif.ExifIFD.DateTimeOriginal: date.strftime("%Y:%m:%d %H:%M:%S")}})
+    output = BytesIO()
+    piexif.insert(exif_bytes, jpeg_bytes, output)
+    return output.getvalue()
+
+
+def _tiff_ifd(offset, entries, next_offset=0):
+    """ Little-endian TIFF IFD written at `offset`, followed by the values that do not fit in their entry. """
+    data_offset = offset + 2 + 12 * len(entries) + 4
+    table, data = [struct.pack('<H', len(entries))], b""
+    for tag, field_type, count, payload in sorted(entries):
+        if len(payload) <= 4:
+            table.append(struct.pack('<HHI', tag, field_type, count) + payload.ljust(4, b"\0"))
+        else:
+            table.append(struct.pack('<HHII', tag, field_type, count, data_offset + len(data)))
+            data += payload
+    return b"".join(table) + struct.pack('<I', next_offset) + data
+
+
+def _synthetic_cr2(preview, thumbnail, size, date):
+    """
+    A file laid out like a Canon CR2: IFD0 pointing at the full-size JPEG preview and the EXIF IFD, IFD1 at the
+    thumbnail and the raw IFD at a lossless JPEG stand-in that pads the file to `size` bytes.
+    """
+    ifd0, exif_ifd, ifd1, raw_ifd, data = 16, 512, 1024, 1536, 2048
+    thumbnail_offset, preview_offset = data, data + len(thumbnail)
+    raw_offset = preview_offset + len(preview)
+    raw = b"\xff\xd8\xff\xc3\x00\x0b\x0e\x0e\xa0\x15\xa0" + os.urandom(max(0, size - raw_offset - 11))
+    text = date.strftime("%Y:%m:%d %H:%M:%S").encode('ascii') + b"\0"
+    short = lambda tag, value: (tag, 3, 1, struct.pack('<H', value))
+    uint = lambda tag, value: (tag, 4, 1, struct.pack('<I', value))
+    header = b"II" + struct.pack('<HI', 42, ifd0) + b"CR\x02\x00" + struct.pack('<I', raw_ifd)
+    layout = {
+        ifd0: _tiff_ifd(ifd0, [short(0x0103, 6), (0x010F, 2, 6, b"Canon\0"), (0x0110, 2, 21, b"Canon EOS 5D Mark IV\0"),
+                               uint(0x0111, preview_offset), short(0x0112, 1), uint(0x0117, len(preview)),
+                               (0x0132, 2, len(text), text), uint(0x8769, exif_ifd)], ifd1),
+        exif_ifd: _tiff_ifd(exif_ifd, [(0x829A, 5, 1, struct.pack('<II', 1, 200)), short(0x8827, 400), (0x9003, 2, len(text), text)]),
+        ifd1: _tiff_ifd(ifd1, [uint(0x0201, thumbnail_offset), uint(0x0202, len(thumbnail))], raw_ifd),
+        raw_ifd: _tiff_ifd(raw_ifd, [short(0x0103, 6), uint(0x0111, raw_offset), uint(0x0117, len(raw))]),
+    }
+    output = bytearray(header.ljust(data, b"\0"))
+    for offset, ifd in layout.items():
+        output[offset:offset + len(ifd)] = ifd
+    return bytes(output) + thumbnail + preview + raw
+
+
+def generate_photo_tree(root, albums=4, files_per_album=50, width=1024, height=768, videos=0, video_size=12 * 1024 * 1024,
+                        raws=0, raw_size=2 * 1024 * 1024, seed=0):
+    """
+    Generate a synthetic photo tree: one directory per album with JPEGs (every fifth one without an EXIF date),
+    plus optional videos and .CR2 files (laid out like Canon raws with an embedded preview). Returns the number of files and bytes written.
+    """
+    rng = random.Random(seed)
+    templates = _jpeg_templates(5, width, height, seed)
+    start = datetime.datetime(2015, 1, 1)
+    files, total_bytes = 0, 0
+    for album in range(albums):
+        album_dir = os.path.join(root, f"album-{album:03d}")
+        os.makedirs(album_dir, exist_ok=True)
+        for index in range(files_per_album):
+            date = start + datetime.timedelta(days=rng.randint(0, 3650), seconds=rng.randint(0, 86400))
+            data = templates[index % len(templates)]
+            if index % 5:
+                data = _with_exif_date(data, date)
+            path = os.path.join(album_dir, f"IMG_{album:03d}_{index:05d}.jpg")
+            with open(path, 'wb') as out:
+                out.write(data)
+            os.utime(path, (date.timestamp(), date.timestamp()))
+            files += 1
+            total_bytes += len(data)
+    for kind, count, size, extension in (('videos', videos, video_size, '.mp4'), ('raw', raws, raw_size, '.CR2')):
+        if not count:
+            continue
+        kind_dir = os.path.join(root, kind)
+        os.makedirs(kind_dir, exist_ok=True)
+        block = os.urandom(1024 * 1024)
+        if kind == 'raw':
+            preview = _camera_like_jpeg(width, height, seed)
+            thumbnail = _camera_like_jpeg(160, 120, seed, quality=75)
+        for index in range(count):
+            with open(os.path.join(kind_dir, f"{kind.upper()}_{index:05d}{extension}"), 'wb') as out:
+                if kind == 'raw':
+                    date = start + datetime.timedelta(days=rng.randint(0, 3650), seconds=rng.randint(0, 86400))
+                    out.write(_synthetic_cr2(preview, thumbnail, size, date))
+                else:
+                    for offset in range(0, size, len(block)):
+                        out.write(block[:min(len(block), size - offset)])
+            files += 1
+            total_bytes += size
+    return files, total_bytes
+
+
+def seed_remote_library(backend, items, size, seed=0, duplicates=0.0):
+    """
+    Pre-populate the fake server with `items` media items for the download benchmark.
+        :param duplicates: Fraction of the items sharing the content of an earlier item.
+    """
+    rng = random.Random(seed)
+    seeded = []
+    for index in range(items):
+        date = datetime.datetime(2015, 1, 1) + datetime.timedelta(days=rng.randint(0, 3650))
+        content_of = rng.choice(seeded)["id"] if seeded and rng.random() < duplicates else None
+        seeded.append(backend.add_media_item(f"REMOTE_{index:06d}.jpg", size, date.strftime("%Y-%m-%dT%H:%M:%SZ"), content_of=content_of))
+
+
+def run_script(args, env, cwd=REPO_DIR, timeout=3600):
+    """ Run a script and return (exit code, wall seconds, peak RSS in MB, output tail). """
+    log = tempfile.TemporaryFile()
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable] + args, cwd=cwd, env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = start + timeout
+    while True:
+        pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+        if pid:
+            break
+        if time.perf_counter() > deadline:
+            process.kill()
+        time.sleep(0.01)
+    wall = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    log.seek(0)
+    tail = log.read().decode('utf8', 'replace')[-2000:]
+    log.close()
+    return process.returncode, wall, usage.ru_maxrss / 1024, tail
+
+
+def _server_stats(backend):
+    with backend.lock:
+        return json.loads(json.dumps(backend.stats))
+
+
+def measure(name, backend, args, env, files):
+    before = _server_stats(backend)
+    items_before = len(backend.media_items)
+    exit_code, wall, peak_rss, tail = run_script(args, env)
+    after = _server_stats(backend)
+    calls = {endpoint: count - before["calls"].get(endpoint, 0) for endpoint, count in after["calls"].items()
+             if count - before["calls"].get(endpoint, 0)}
+    moved = (after["bytes_in"] - before["bytes_in"]) + (after["bytes_out"] - before["bytes_out"])
+    result = {
+        "target": name,
+        "exit_code": exit_code,
+        "files": files,
+        "items_created": len(backend.media_items) - items_before,
+        "wall_seconds": round(wall, 3),
+        "files_per_second": round(files / wall, 3) if wall else 0.0,
+        "mb_per_second": round(moved / wall / 1024 / 1024, 3) if wall else 0.0,
+        "api_calls": calls,
+        "api_calls_per_file": round(sum(calls.values()) / files, 3) if files else 0.0,
+        "errors_429": after["errors_429"] - before["errors_429"],
+        "peak_rss_mb": round(peak_rss, 1),
+    }
+    if exit_code != 0:
+        result["output_tail"] = tail
+    return result
+
+
+def import_time(module, env):
+    """ Cumulative import time of a module in ms and its five slowest imports (self time), from python -X importtime. """
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=REPO_DIR, env=env,
+                             capture_output=True, text=True)
+    timings = []
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        timings.append((int(self_us), int(cumulative_us), name.strip()))
+    total = next((cumulative for _, cumulative, name in timings if name == module), 0)
+    heaviest = sorted(timings, reverse=True)[:5]
+    return round(total / 1000, 1), {name: round(self_us / 1000, 1) for self_us, _, name in heaviest}
+
+
+def measure_startup(env):
+    """
+    Startup costs: import time of the importable entry points, and wall time of `PhotoSync.py --list` and of
+    a bare UploadPhotoToAlbume.py run (the setup CR2Sync/VideoSync pay per uploaded file), with a cold and a
+    warm discovery document cache.
+    """
+    result = {"target": "startup", "import_ms": {}, "slowest_imports_ms": {}, "cold_seconds": {}, "warm_seconds": {}}
+    for module in ('PhotoSync', 'DownloadPhotos'):
+        result["import_ms"][module], result["slowest_imports_ms"][module] = import_time(module, env)
+    for name, args in (('photosync_list', ['PhotoSync.py', '--list']), ('upload_script', ['UploadPhotoToAlbume.py'])):
+        shutil.rmtree(os.path.join(env['HOME'], '.PhotoSync', 'discovery'), ignore_errors=True)
+        result["cold_seconds"][name] = round(run_script(args, env)[1], 3)
+        result["warm_seconds"][name] = round(run_script(args, env)[1], 3)
+    return result
+
+
+def measure_catalogue(items, lookups=100000):
+    """
+    Memory of the album dedup keys of `items` remote media items (a description and a filename each): bytes per item
+    of a Python set of strings against a CompactKeySet in memory and spilled to a mapped file, and lookup times.
+    """
+    import tracemalloc
+    from compact_catalogue import CompactKeySet
+
+    def keys():
+        for index in range(items):
+            filename = f"IMG_{index:08d}.jpg"
+            yield f"album-{index % 50:03d}-{index // 1000:05d}-{filename}"
+            yield filename
+
+    def lookup_us(key_set):
+        probes = [f"IMG_{index:08d}.jpg" for index in range(0, items * 2, max(1, items * 2 // lookups))]
+        start = time.perf_counter()
+        for probe in probes:
+            probe in key_set
+        return round((time.perf_counter() - start) / len(probes) * 1e6, 3)
+
+    result = {"target": "catalogue", "items": items}
+    for name, build in (("set", lambda: set(keys())), ("compact", lambda: CompactKeySet(keys()).freeze())):
+        tracemalloc.start()
+        key_set = build()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result[f"{name}_bytes_per_item"] = round(current / items, 1)
+        result[f"{name}_peak_bytes_per_item"] = round(peak / items, 1)
+        result[f"{name}_lookup_us"] = lookup_us(key_set)
+    spill_dir = tempfile.mkdtemp(prefix='photosync-keys-')
+    try:
+        key_set.spill(os.path.join(spill_dir, 'album.keys'))
+        result["mapped_bytes_per_item"] = round(key_set.nbytes() / items, 1)
+        result["mapped_lookup_us"] = lookup_us(key_set)
+        key_set.close()
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+    return result
+
+
+def measure_storage_saver(root, files, width, height, max_dimension, quality, workers=None):
+    """
+    Bytes saved against CPU spent by the storage saver transform over `files` camera-like JPEGs,
+    with draft-mode decoding and with a full decode for comparison.
+    """
+    import resource
+    from concurrent.futures import ProcessPoolExecutor
+    from storage_saver import transform_jpeg
+    date = datetime.datetime(2020, 6, 1)
+    paths = []
+    for index in range(files):
+        path = os.path.join(root, f"IMG_{index:05d}.jpg")
+        with open(path, 'wb') as out:
+            out.write(_with_exif_date(_camera_like_jpeg(width, height, index), date))
+        paths.append(path)
+    bytes_in = sum(os.path.getsize(path) for path in paths)
+    result = {"target": "saver", "files": files, "megapixels": round(width * height / 1e6, 1), "bytes_in": bytes_in}
+    for name, draft in (("draft", True), ("full_decode", False)):
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            outputs = list(executor.map(transform_jpeg, paths, [max_dimension] * files, [quality] * files, [None] * files, [draft] * files))
+        wall = time.perf_counter() - start
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu = after.ru_utime + after.ru_stime - before.ru_utime - before.ru_stime
+        bytes_out = sum(len(media) if media is not None else size for media, _, size in outputs)
+        saved_mb = (bytes_in - bytes_out) / 1024 ** 2
+        result[name] = {"wall_seconds": round(wall, 3), "cpu_seconds": round(cpu, 3), "bytes_out": bytes_out,
+                        "saved_fraction": round(1 - bytes_out / bytes_in, 3),
+                        "cpu_seconds_per_mb_saved": round(cpu / saved_mb, 4) if saved_mb > 0 else None}
+    return result
+
+
+def measure_http2(home, options):
+    """
+    Many small photos (where per-request overhead dominates) synced through the same hypercorn server
+    over HTTP/1.1 connections per thread, then multiplexed over HTTP/2, each against a fresh library.
+    """
+    result = {"target": "http2"}
+    for protocol, extra_args in (("http1", []), ("http2", ['--http2'])):
+        server, root_url = start_http2_server(latency=options.latency_ms / 1000,
+                                              bandwidth=options.bandwidth_mbps * 125000 if options.bandwidth_mbps else None,
+                                              error_rate=options.error_rate)
+        protocol_home = os.path.join(home, protocol)
+        pictures = os.path.join(protocol_home, 'Pictures')
+        os.makedirs(pictures)
+        write_fake_credentials(protocol_home)
+        env = dict(os.environ, HOME=protocol_home, PHOTOSYNC_API_ROOT=root_url)
+        files, _ = generate_photo_tree(pictures, options.albums, options.files // options.albums, 320, 240)
+        result[protocol] = measure(protocol, server.backend, ['PhotoSync.py', '--source', pictures] + extra_args, env, files)
+        server.shutdown()
+    if result["http1"]["wall_seconds"]:
+        result["speedup"] = round(result["http2"]["files_per_second"] / result["http1"]["files_per_second"], 3)
+    return result
+
+
+def run_benchmarks(options):
+    results = []
+    work_dir = tempfile.mkdtemp(prefix='photosync-bench-')
+    try:
+        for target in options.targets:
+            if target == 'catalogue':
+                result = measure_catalogue(options.catalogue_items)
+                print(json.dumps(result), flush=True)
+                results.append(result)
+                continue
+            if target == 'saver':
+                saver_dir = os.path.join(work_dir, target)
+                os.makedirs(saver_dir)
+                result = measure_storage_saver(saver_dir, options.saver_files, options.saver_width, options.saver_height,
+                                               options.saver_max_dimension, options.saver_quality)
+                print(json.dumps(result), flush=True)
+                results.append(result)
+                continue
+            if target == 'http2':
+                result = measure_http2(os.path.join(work_dir, target), options)
+                print(json.dumps(result), flush=True)
+                results.append(result)
+                continue
+            # A fresh server per target keeps the library state and call counts independent
+            server, root_url = start_server(latency=options.latency_ms / 1000,
+                                            bandwidth=options.bandwidth_mbps * 125000 if options.bandwidth_mbps else None,
+                                            error_rate=options.error_rate, drop_rate=options.drop_rate)
+            backend = server.backend
+            home = os.path.join(work_dir, target)
+            pictures = os.path.join(home, 'Pictures')
+            os.makedirs(pictures)
+            write_fake_credentials(home)
+            env = dict(os.environ, HOME=home, PHOTOSYNC_API_ROOT=root_url)
+            if target == 'photosync':
+                files, _ = generate_photo_tree(pictures, options.albums, options.files // options.albums, options.width, options.height,
+                                               videos=options.videos, video_size=options.video_size)
+                args = ['PhotoSync.py', '--source', pictures]
+            elif target == 'download':
+                seed_remote_library(backend, options.files, options.download_size, duplicates=options.download_duplicates)
+                files = options.files
+                args = ['DownloadPhotos.py', '--target', os.path.join(home, 'Download')]
+            elif target in ('cr2', 'cr2_preview'):
+                files, _ = generate_photo_tree(pictures, 0, 0, options.width, options.height, raws=options.raws, raw_size=options.raw_size)
+                args = ['CR2Sync.py'] if target == 'cr2' else ['CR2Sync.py', '--preview', 'only']
+            elif target == 'startup':
+                result = measure_startup(env)
+                server.shutdown()
+                print(json.dumps(result), flush=True)
+                results.append(result)
+                continue
+            elif target == 'video':
+                files, _ = generate_photo_tree(pictures, 0, 0, videos=options.videos, video_size=options.video_size)
+                os.makedirs(os.path.join(home, 'Videos'))
+                args = ['VideoSync.py']
+            else:
+                raise ValueError(f"Unknown benchmark target {target}")
+            result = measure(target, backend, args, env, files)
+            server.shutdown()
+            print(json.dumps(result), flush=True)
+            results.append(result)
+    finally:
+        if not options.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """ Return the list of regressions of `results` against a previous benchmark output. """
+    previous = {result["target"]: result for result in baseline.get("results", [])}
+    regressions = []
+    for result in results:
+        old = previous.get(result["target"])
+        if old is None:
+            continue
+        if result["target"] == 'catalogue':
+            if result["compact_bytes_per_item"] > old["compact_bytes_per_item"] * (1 + tolerance):
+                regressions.append(f"catalogue: bytes/item {old['compact_bytes_per_item']} -> {result['compact_bytes_per_item']}")
+            continue
+        if result["target"] == 'saver':
+            if result["draft"]["cpu_seconds"] > old["draft"]["cpu_seconds"] * (1 + tolerance):
+                regressions.append(f"saver: CPU seconds {old['draft']['cpu_seconds']} -> {result['draft']['cpu_seconds']}")
+            if result["draft"]["saved_fraction"] < old["draft"]["saved_fraction"] * (1 - tolerance):
+                regressions.append(f"saver: saved fraction {old['draft']['saved_fraction']} -> {result['draft']['saved_fraction']}")
+            continue
+        if result["target"] == 'http2':
+            if result["http2"]["files_per_second"] < old["http2"]["files_per_second"] * (1 - tolerance):
+                regressions.append(f"http2: files/s {old['http2']['files_per_second']} -> {result['http2']['files_per_second']}")
+            continue
+        if result["target"] == 'startup':
+            for group in ('import_ms', 'warm_seconds'):
+                for name, value in result[group].items():
+                    if name in old.get(group, {}) and value > old[group][name] * (1 + tolerance):
+                        regressions.append(f"startup: {group} {name} {old[group][name]} -> {value}")
+            continue
+        if result["files_per_second"] < old["files_per_second"] * (1 - tolerance):
+            regressions.append(f"{result['target']}: files/s {old['files_per_second']} -> {result['files_per_second']}")
+        if result["api_calls_per_file"] > old["api_calls_per_file"] * (1 + tolerance):
+            regressions.append(f"{result['target']}: API calls/file {old['api_calls_per_file']} -> {result['api_calls_per_file']}")
+        if result["peak_rss_mb"] > old["peak_rss_mb"] * (1 + tolerance):
+            regressions.append(f"{result['target']}: peak RSS {old['peak_rss_mb']}MB -> {result['peak_rss_mb']}MB")
+    return regressions
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the PhotoSync scripts against a local fake Google Photos server.")
+    parser.add_argument('--targets', type=lambda value: value.split(','), default=list(TARGETS), help=f"Comma separated targets out of {','.join(TARGETS)}")
+    parser.add_argument('--files', type=int, default=200, help='Number of photos to sync/download')
+    parser.add_argument('--albums', type=int, default=4, help='Number of album directories in the synthetic tree')
+    parser.add_argument('--width', type=int, default=1024, help='Synthetic photo width')
+    parser.add_argument('--height', type=int, default=768, help='Synthetic photo height')
+    parser.add_argument('--videos', type=int, default=4, help='Number of videos for the video target')
+    parser.add_argument('--video-size', type=int, default=12 * 1024 * 1024, help='Size of each synthetic video in bytes')
+    parser.add_argument('--raws', type=int, default=10, help='Number of .CR2 files for the cr2 target')
+    parser.add_argument('--raw-size', type=int, default=2 * 1024 * 1024, help='Size of each synthetic .CR2 file in bytes')
+    parser.add_argument('--download-size', type=int, default=256 * 1024, help='Size of each remote item for the download target')
+    parser.add_argument('--download-duplicates', type=float, default=0, help='Fraction of remote items sharing the content of another item')
+    parser.add_argument('--catalogue-items', type=int, default=1000000, help='Remote media items of the catalogue memory benchmark')
+    parser.add_argument('--saver-files', type=int, default=8, help='JPEGs transformed by the saver benchmark')
+    parser.add_argument('--saver-width', type=int, default=7296, help='Width of the saver benchmark JPEGs (default 40 MP)')
+    parser.add_argument('--saver-height', type=int, default=5472, help='Height of the saver benchmark JPEGs')
+    parser.add_argument('--saver-max-dimension', type=int, default=4608, help='Storage saver maximum dimension')
+    parser.add_argument('--saver-quality', type=int, default=85, help='Storage saver JPEG quality')
+    parser.add_argument('--latency-ms', type=float, default=20, help='Latency added by the fake server to every API call')
+    parser.add_argument('--bandwidth-mbps', type=float, help='Fake server bandwidth in megabits per second')
+    parser.add_argument('--error-rate', type=float, default=0, help='Probability of 429 answers to uploads and batchCreate')
+    parser.add_argument('--drop-rate', type=float, default=0, help='Probability that the fake server drops a download halfway through')
+    parser.add_argument('--output', type=str, help='Write the results as JSON to this file')
+    parser.add_argument('--baseline', type=str, help='Compare against a previous --output file, exit 1 on regression')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative regression when comparing with --baseline')
+    parser.add_argument('--keep', action='store_true', help='Keep the generated trees')
+    options = parser.parse_args()
+    results = run_benchmarks(options)
+    report = {"created": datetime.datetime.now().isoformat(timespec='seconds'), "options": vars(options), "results": results}
+    if options.output:
+        with open(options.output, 'w') as out:
+            json.dump(report, out, indent=2)
+    if options.baseline:
+        with open(options.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), options.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
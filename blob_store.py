@@ -0,0 +1,149 @@
+"""
+Content-addressed store for DownloadPhotos: every distinct content is kept once under
+<target>/.blobs/<sha256[:2]>/<sha256>, and the date tree and album folders are hardlinks to those blobs.
+The same photo in several media items or albums therefore costs its bytes once, and a manifest of
+media item id -> SHA-256 lets later runs skip known items without downloading or hashing them.
+On file systems without hardlinks the blobs are copied into place instead, and the manifest remembers the size
+and mtime of every placed copy so that later runs recognize it without hashing it again.
+"""
+import hashlib
+import os
+import shutil
+import sqlite3
+import time
+
+BLOB_DIRECTORY = ".blobs"
+MANIFEST = "manifest.sqlite"
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as blob_file:
+        for chunk in iter(lambda: blob_file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class BlobStore:
+    """
+        :param target_root: Root of the local mirror, the store lives in its .blobs directory.
+    """
+    def __init__(self, target_root):
+        self.root = os.path.join(target_root, BLOB_DIRECTORY)
+        self.staging = os.path.join(self.root, "incoming")
+        os.makedirs(self.staging, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(self.root, MANIFEST))
+        self.db.execute("""CREATE TABLE IF NOT EXISTS items (
+            item_id TEXT PRIMARY KEY,
+            sha256 TEXT,
+            filename TEXT,
+            added REAL)""")
+        # Mirror paths holding a blob, with the size and mtime they had when placed
+        self.db.execute("""CREATE TABLE IF NOT EXISTS placed (
+            path TEXT PRIMARY KEY,
+            sha256 TEXT,
+            size INTEGER,
+            mtime REAL)""")
+        self.db.commit()
+        self.copies = 0
+
+    def blob_path(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def staging_path(self, item_id):
+        """ Download location of a media item before its content is known, stable across runs so parts resume. """
+        return os.path.join(self.staging, item_id.replace(os.sep, "_"))
+
+    def lookup(self, item_id):
+        """ SHA-256 of a media item downloaded before, None when it is unknown or its blob is gone. """
+        row = self.db.execute("SELECT sha256 FROM items WHERE item_id = ?", (item_id,)).fetchone()
+        return row[0] if row and os.path.exists(self.blob_path(row[0])) else None
+
+    def add(self, path, sha256, item_id=None, filename=None):
+        """
+        Move a downloaded file into the store, dropping it when the content is already there.
+            :return: True when the content was new.
+        """
+        blob = self.blob_path(sha256)
+        new = not os.path.exists(blob)
+        if new:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            os.replace(path, blob)
+        else:
+            os.remove(path)
+        if item_id is not None:
+            self.record(item_id, sha256, filename)
+        return new
+
+    def record(self, item_id, sha256, filename=None):
+        self.db.execute("INSERT OR REPLACE INTO items (item_id, sha256, filename, added) VALUES (?, ?, ?, ?)",
+                        (item_id, sha256, filename, time.time()))
+        self.db.commit()
+
+    def _link(self, source, destination):
+        try:
+            os.link(source, destination)
+        except OSError:
+            # No hardlinks across devices or on FAT/exFAT, fall back to a copy
+            shutil.copy2(source, destination)
+            self.copies += 1
+
+    def _remember(self, path, sha256):
+        stat = os.stat(path)
+        self.db.execute("INSERT OR REPLACE INTO placed (path, sha256, size, mtime) VALUES (?, ?, ?, ?)",
+                        (os.path.abspath(path), sha256, stat.st_size, stat.st_mtime))
+        self.db.commit()
+
+    def _placed(self, path, sha256):
+        """ Whether `path` is a copy of the blob placed earlier and unchanged since. """
+        row = self.db.execute("SELECT sha256, size, mtime FROM placed WHERE path = ?", (os.path.abspath(path),)).fetchone()
+        if row is None or row[0] != sha256:
+            return False
+        stat = os.stat(path)
+        return (stat.st_size, stat.st_mtime) == (row[1], row[2])
+
+    def place(self, sha256, path):
+        """
+        Materialize a blob at `path`. A different file already using the name makes the blob go to
+        name_dup, name_dup2, ... instead; a plain copy of the same content is replaced by a link where hardlinks work,
+        and kept otherwise.
+            :return: (path the blob is at, whether a new link was made)
+        """
+        blob = self.blob_path(sha256)
+        base, extension = os.path.splitext(path)
+        candidate, attempt = path, 1
+        while os.path.lexists(candidate):
+            if os.path.exists(candidate) and (os.path.samefile(candidate, blob) or self._placed(candidate, sha256)):
+                return candidate, False
+            if os.path.isfile(candidate) and not os.path.islink(candidate) and \
+                    os.path.getsize(candidate) == os.path.getsize(blob) and file_sha256(candidate) == sha256:
+                tmp_path = f"{candidate}.{os.getpid()}.tmp"
+                try:
+                    os.link(blob, tmp_path)
+                except OSError:
+                    # Copying the blob over an identical copy would gain nothing
+                    self._remember(candidate, sha256)
+                    return candidate, False
+                os.replace(tmp_path, candidate)
+                return candidate, True
+            candidate = f"{base}_dup{attempt if attempt > 1 else ''}{extension}"
+            attempt += 1
+        os.makedirs(os.path.dirname(candidate), exist_ok=True)
+        self._link(blob, candidate)
+        if not os.path.samefile(candidate, blob):
+            self._remember(candidate, sha256)
+        return candidate, True
+
+    def usage(self):
+        """ (number of blobs, their total bytes). """
+        count = size = 0
+        for directory, _, files in os.walk(self.root):
+            if directory == self.root or directory == self.staging:
+                continue
+            for name in files:
+                count += 1
+                size += os.path.getsize(os.path.join(directory, name))
+        return count, size
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,93 @@
+"""
+Concurrent loading of the remote catalogue: every album's media item listing is fetched on a bounded
+thread pool. Page tokens serialize the pages of one album, but different albums are listed in parallel
+and each album's keys stream into its dedup set as pages arrive. The dedup sets are CompactKeySets
+(8 bytes per key), optionally spilled to memory-mapped files once an album is listed.
+"""
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from compact_catalogue import CompactKeySet
+
+logger = logging.getLogger("PhotoSync")
+
+
+def media_item_keys(media_item):
+    """ Keys an uploaded file can be matched by: its description (PhotoSync stores the relative path there) or filename. """
+    return [key for key in (media_item.get("description"), media_item.get("filename")) if key]
+
+
+class CatalogueLoader:
+    """
+        :param list_page: Callable (album_id, page_token) returning one mediaItems:search response.
+        :param workers: Maximum number of albums listed at the same time.
+        :param on_page: Optional callable (album_id, media_items) invoked for every page as it arrives.
+        :param spill_dir: Directory the key sets of listed albums are written to and memory-mapped from (None keeps them in memory).
+    """
+    def __init__(self, list_page, workers=4, on_page=None, spill_dir=None):
+        self.list_page = list_page
+        self.on_page = on_page
+        self.spill_dir = spill_dir
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="catalogue")
+        self.catalogue = {}
+        self.futures = {}
+        self._lock = threading.Lock()
+
+    def start(self, album_ids):
+        """ Queue the listing of every album not already loading. """
+        with self._lock:
+            for album_id in album_ids:
+                if album_id and album_id not in self.futures:
+                    self.catalogue[album_id] = CompactKeySet()
+                    self.futures[album_id] = self.executor.submit(self._load, album_id)
+
+    def _load(self, album_id):
+        keys = self.catalogue[album_id]
+        page_token = None
+        pages = 0
+        while True:
+            response = self.list_page(album_id, page_token)
+            media_items = response.get("mediaItems", [])
+            for media_item in media_items:
+                keys.update(media_item_keys(media_item))
+            if self.on_page is not None and media_items:
+                self.on_page(album_id, media_items)
+            pages += 1
+            page_token = response.get("nextPageToken")
+            if not page_token:
+                break
+        keys.freeze()
+        if self.spill_dir:
+            keys.spill(self._spill_path(album_id))
+        logger.info(f"Listed album {album_id}: {len(keys)} keys in {pages} pages")
+        return keys
+
+    def _spill_path(self, album_id):
+        return os.path.join(self.spill_dir, f"{hashlib.sha1(album_id.encode('utf8')).hexdigest()[:16]}.{os.getpid()}.keys")
+
+    def keys(self, album_id):
+        """ Keys listed so far for an album (grows while the listing is in flight). """
+        return self.catalogue.get(album_id, set())
+
+    def wait(self, album_id):
+        """ Block until an album's listing is complete and return its keys, starting the listing if needed. """
+        if album_id not in self.futures:
+            self.start([album_id])
+        return self.futures[album_id].result()
+
+    def forget(self, album_id):
+        """ Drop an album's keys once its directory has been synced. """
+        with self._lock:
+            keys = self.catalogue.pop(album_id, None)
+            future = self.futures.pop(album_id, None)
+        if future is not None and future.done() and not future.exception():
+            keys.close()
+            if self.spill_dir and os.path.exists(self._spill_path(album_id)):
+                os.remove(self._spill_path(album_id))
+
+    def close(self):
+        self.executor.shutdown(wait=True)
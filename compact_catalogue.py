@@ -0,0 +1,131 @@
+"""
+Compact membership sets for the remote catalogue. Instead of a Python set of description and filename
+strings (~100+ bytes per key), every key is reduced to a fixed-width 64-bit BLAKE2b digest kept in a sorted
+`array('Q')`, 8 bytes per key, and looked up by binary search. A frozen set can be spilled to a file and
+memory-mapped, so a million-item library costs page cache instead of process memory.
+
+With 64-bit digests the chance that any of a million keys collides with an unrelated file name is about 3e-8;
+a collision would make one local file look already uploaded.
+"""
+import hashlib
+import heapq
+import mmap
+import os
+import sys
+import threading
+from array import array
+from bisect import bisect_left
+from itertools import islice
+
+# Keys added since the last merge wait unsorted until there are this many, or as many as are already sorted
+PENDING_LIMIT = 4096
+MAGIC = b"PSKEYS01"
+
+
+def key_digest(key):
+    """ Fixed-width 64-bit digest of a catalogue key. """
+    return int.from_bytes(hashlib.blake2b(key.encode('utf8'), digest_size=8).digest(), sys.byteorder)
+
+
+class CompactKeySet:
+    """
+    Set of strings supporting add() and `in`, stored as sorted 64-bit digests.
+    Keys stream into an unsorted pending array that is merged into the sorted one whenever it grows as large,
+    which keeps building linearithmic and its peak memory a small multiple of the final array.
+    """
+    def __init__(self, keys=()):
+        self.sorted = array('Q')
+        self.pending = array('Q')
+        self._mapped = None
+        self._lock = threading.Lock()
+        self.update(keys)
+
+    def add(self, key):
+        with self._lock:
+            self.pending.append(key_digest(key))
+            if len(self.pending) >= max(PENDING_LIMIT, len(self.sorted)):
+                self._merge()
+
+    def update(self, keys):
+        digests = map(key_digest, keys)
+        while True:
+            chunk = array('Q', islice(digests, PENDING_LIMIT))
+            if not chunk:
+                return
+            with self._lock:
+                self.pending.extend(chunk)
+                if len(self.pending) >= max(PENDING_LIMIT, len(self.sorted)):
+                    self._merge()
+
+    def _merge(self):
+        if not self.pending:
+            return
+        new = sorted(self.pending)
+        self.pending = array('Q')
+        merged = array('Q', heapq.merge(self.sorted, new))
+        self._release()
+        self.sorted = merged
+
+    def freeze(self):
+        """ Merge the pending keys, after which lookups are pure binary searches. """
+        with self._lock:
+            self._merge()
+        return self
+
+    def __contains__(self, key):
+        digest = key_digest(key)
+        with self._lock:
+            # Lookups start once an album is listed, merging the last keys then is cheaper than scanning them
+            self._merge()
+            index = bisect_left(self.sorted, digest)
+            return index < len(self.sorted) and self.sorted[index] == digest
+
+    def __len__(self):
+        return len(self.sorted) + len(self.pending)
+
+    def nbytes(self):
+        """ Memory held by the set outside of any mapped file. """
+        held = 0 if self._mapped is not None else sys.getsizeof(self.sorted)
+        return held + sys.getsizeof(self.pending)
+
+    def spill(self, path):
+        """ Write the frozen set to `path` and serve lookups from a read-only memory map of it. """
+        self.freeze()
+        with self._lock:
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as keys_file:
+                keys_file.write(MAGIC)
+                self.sorted.tofile(keys_file)
+            os.replace(tmp_path, path)
+            self._release()
+            self.sorted, self._mapped = _map_digests(path)
+        return self
+
+    @classmethod
+    def open(cls, path):
+        """ Memory-map a set written by spill(). """
+        key_set = cls()
+        key_set.sorted, key_set._mapped = _map_digests(path)
+        return key_set
+
+    def _release(self):
+        if self._mapped is not None:
+            self.sorted.release()
+            self._mapped.close()
+            self._mapped = None
+
+    def close(self):
+        with self._lock:
+            self._release()
+            self.sorted = array('Q')
+            self.pending = array('Q')
+
+
+def _map_digests(path):
+    with open(path, 'rb') as keys_file:
+        if keys_file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a catalogue key file")
+        if os.fstat(keys_file.fileno()).st_size == len(MAGIC):
+            return array('Q'), None
+        mapped = mmap.mmap(keys_file.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(mapped)[len(MAGIC):].cast('Q'), mapped
@@ -0,0 +1,424 @@
+"""
+Local stand-in for the Google Photos Library API, used by benchmark.py.
+Implements the endpoints PhotoSync touches (uploads, mediaItems:batchCreate, mediaItems:search,
+mediaItems list, albums and baseUrl downloads with Range requests) with configurable latency, bandwidth,
+429 injection and dropped download connections.
+Run standalone with: python fake_photos_server.py --port 8765 --latency-ms 50
+With hypercorn installed, --http2 serves the same backend over HTTP/1.1 and cleartext HTTP/2 (prior knowledge).
+"""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
+
+READ_CHUNK = 64 * 1024
+
+
+def discovery_document(root_url):
+    """ Minimal photoslibrary v1 discovery document covering the methods PhotoSync calls. """
+    def method(method_id, path, http_method, parameters=None, request=None):
+        spec = {"id": method_id, "path": path, "flatPath": path, "httpMethod": http_method,
+                "parameters": parameters or {}, "parameterOrder": [name for name, p in (parameters or {}).items() if p.get("required")],
+                "response": {"$ref": "Response"}}
+        if request:
+            spec["request"] = {"$ref": "Request"}
+        return spec
+    page = {"pageSize": {"type": "integer", "location": "query"}, "pageToken": {"type": "string", "location": "query"}}
+    album_id = {"albumId": {"type": "string", "location": "path", "required": True}}
+    return {
+        "kind": "discovery#restDescription", "discoveryVersion": "v1", "id": "photoslibrary:v1",
+        "name": "photoslibrary", "version": "v1", "protocol": "rest",
+        "rootUrl": root_url + "/", "servicePath": "", "baseUrl": root_url + "/", "batchPath": "batch",
+        "parameters": {"fields": {"type": "string", "location": "query"}},
+        "schemas": {"Request": {"id": "Request", "type": "object"}, "Response": {"id": "Response", "type": "object"}},
+        "resources": {
+            "albums": {"methods": {
+                "list": method("photoslibrary.albums.list", "v1/albums", "GET", page),
+                "create": method("photoslibrary.albums.create", "v1/albums", "POST", request=True),
+                "get": method("photoslibrary.albums.get", "v1/albums/{+albumId}", "GET", album_id),
+                "batchAddMediaItems": method("photoslibrary.albums.batchAddMediaItems", "v1/albums/{+albumId}:batchAddMediaItems", "POST", album_id, request=True),
+            }},
+            "mediaItems": {"methods": {
+                "list": method("photoslibrary.mediaItems.list", "v1/mediaItems", "GET", page),
+                "get": method("photoslibrary.mediaItems.get", "v1/mediaItems/{+mediaItemId}", "GET",
+                              {"mediaItemId": {"type": "string", "location": "path", "required": True}}),
+                "search": method("photoslibrary.mediaItems.search", "v1/mediaItems:search", "POST", request=True),
+                "batchCreate": method("photoslibrary.mediaItems.batchCreate", "v1/mediaItems:batchCreate", "POST", request=True),
+            }},
+        },
+    }
+
+
+class FakePhotosBackend:
+    """
+    In-memory library state and request routing, independent of the HTTP front end.
+        :param latency: Seconds added to every API response.
+        :param bandwidth: Bytes per second for upload bodies and downloads (None for unlimited).
+        :param error_rate: Probability that an uploads/batchCreate call answers 429.
+        :param drop_rate: Probability that a download connection is closed halfway through the body.
+    """
+    def __init__(self, root_url, latency=0.0, bandwidth=None, error_rate=0.0, seed=0, drop_rate=0.0):
+        self.root_url = root_url
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.albums = {}
+        self.media_items = {}
+        self.album_items = {}
+        self.uploads = {}
+        self.content = {}
+        self.shared_content = {}
+        self.next_id = 0
+        self.stats = {"calls": {}, "bytes_in": 0, "bytes_out": 0, "errors_429": 0}
+
+    def _new_id(self, prefix):
+        with self.lock:
+            self.next_id += 1
+            return f"{prefix}{self.next_id}"
+
+    def _count(self, endpoint, bytes_in=0, bytes_out=0):
+        with self.lock:
+            self.stats["calls"][endpoint] = self.stats["calls"].get(endpoint, 0) + 1
+            self.stats["bytes_in"] += bytes_in
+            self.stats["bytes_out"] += bytes_out
+
+    def _throttle(self, size):
+        if self.bandwidth:
+            time.sleep(size / self.bandwidth)
+
+    def _inject_429(self):
+        if self.error_rate and self.random.random() < self.error_rate:
+            with self.lock:
+                self.stats["errors_429"] += 1
+            return True
+        return False
+
+    def add_media_item(self, filename, size, creation_time, description=None, album_id=None, content_of=None):
+        """
+        Seed the library with a media item whose content is `size` synthetic bytes.
+            :param content_of: Id of an existing item whose bytes this one shares, like a photo saved twice.
+        """
+        item_id = self._new_id("item")
+        item = {"id": item_id, "filename": filename, "description": description or filename,
+                "baseUrl": f"{self.root_url}/media/{item_id}",
+                "mediaMetadata": {"creationTime": creation_time}}
+        with self.lock:
+            self.media_items[item_id] = item
+            self.content[item_id] = size
+            if content_of is not None:
+                self.shared_content[item_id] = content_of
+            if album_id:
+                self.album_items.setdefault(album_id, []).append(item_id)
+                self.albums[album_id]["mediaItemsCount"] = str(len(self.album_items[album_id]))
+        return item
+
+    def add_album(self, title):
+        album_id = self._new_id("album")
+        album = {"id": album_id, "title": title, "productUrl": f"{self.root_url}/album/{album_id}",
+                 "isWriteable": True, "mediaItemsCount": "0"}
+        with self.lock:
+            self.albums[album_id] = album
+            self.album_items[album_id] = []
+        return album
+
+    def media_bytes(self, item_id):
+        """ Deterministic synthetic content of a seeded media item. """
+        size = self.content[item_id]
+        item_id = self.shared_content.get(item_id, item_id)
+        pattern = (item_id.encode('utf8') + b"-") * (size // (len(item_id) + 1) + 1)
+        return pattern[:size]
+
+    def _page(self, ids, query):
+        page_size = int(query.get("pageSize", 100))
+        start = int(query.get("pageToken") or 0)
+        result = ids[start:start + page_size]
+        next_token = str(start + page_size) if start + page_size < len(ids) else None
+        return result, next_token
+
+    def handle(self, method, path, query, headers, body):
+        """ Route one request. Returns (status, content_type, payload bytes) or (status, content_type, payload bytes, headers). """
+        if path.startswith("/$discovery/rest"):
+            self._count("discovery")
+            return 200, "application/json", json.dumps(discovery_document(self.root_url)).encode('utf8')
+        if path == "/__stats":
+            with self.lock:
+                return 200, "application/json", json.dumps(self.stats).encode('utf8')
+        if path.startswith("/media/"):
+            item_id = path[len("/media/"):].split("=")[0]
+            if item_id not in self.content:
+                return 404, "text/plain", b"not found"
+            data = self.media_bytes(item_id)
+            status, extra = 200, {"ETag": f'"{item_id}"'}
+            requested = headers.get("Range", "")
+            if requested.startswith("bytes=") and headers.get("If-Range", extra["ETag"]) == extra["ETag"]:
+                first = int(requested[len("bytes="):].split("-")[0])
+                if first >= len(data):
+                    return 416, "text/plain", b"", {"Content-Range": f"bytes */{len(data)}"}
+                status, extra["Content-Range"] = 206, f"bytes {first}-{len(data) - 1}/{len(data)}"
+                data = data[first:]
+            with self.lock:
+                dropped = self.drop_rate and self.random.random() < self.drop_rate
+            if dropped:
+                # Announce the whole body but close the connection halfway through it
+                extra["Content-Length"] = str(len(data))
+                data = data[:len(data) // 2]
+            self._throttle(len(data))
+            self._count("baseUrl", bytes_out=len(data))
+            return status, "application/octet-stream", data, extra
+        time.sleep(self.latency)
+        if path == "/v1/uploads" and method == "POST":
+            self._count("uploads", bytes_in=len(body))
+            if self._inject_429():
+                return 429, "text/plain", b"quota exceeded"
+            token = self._new_id("upload-token-")
+            with self.lock:
+                self.uploads[token] = (unquote(headers.get("X-Goog-Upload-File-Name", "").strip('"')), len(body))
+            return 200, "text/plain", token.encode('utf8')
+        if path == "/v1/mediaItems:batchCreate" and method == "POST":
+            self._count("mediaItems:batchCreate")
+            if self._inject_429():
+                return 429, "application/json", json.dumps({"error": {"code": 429, "message": "quota exceeded"}}).encode('utf8')
+            request = json.loads(body or b"{}")
+            results = []
+            for new_item in request.get("newMediaItems", []):
+                token = new_item.get("simpleMediaItem", {}).get("uploadToken")
+                with self.lock:
+                    upload = self.uploads.pop(token, None)
+                if upload is None:
+                    results.append({"uploadToken": token, "status": {"code": 3, "message": "Invalid upload token"}})
+                    continue
+                filename, size = upload
+                item = self.add_media_item(filename, size, time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                                           new_item.get("description"), request.get("albumId"))
+                results.append({"uploadToken": token, "status": {"message": "Success"}, "mediaItem": item})
+            return 200, "application/json", json.dumps({"newMediaItemResults": results}).encode('utf8')
+        if path == "/v1/mediaItems:search" and method == "POST":
+            self._count("mediaItems:search")
+            request = json.loads(body or b"{}")
+            with self.lock:
+                ids = list(self.album_items.get(request.get("albumId"), [])) if request.get("albumId") else list(self.media_items)
+            page, next_token = self._page(ids, request)
+            result = {"mediaItems": [self.media_items[item_id] for item_id in page]} if page else {}
+            if next_token:
+                result["nextPageToken"] = next_token
+            return 200, "application/json", json.dumps(result).encode('utf8')
+        if path.startswith("/v1/mediaItems/") and method == "GET":
+            self._count("mediaItems:get")
+            item = self.media_items.get(unquote(path[len("/v1/mediaItems/"):]))
+            if item is None:
+                return 404, "application/json", b'{"error": {"code": 404}}'
+            return 200, "application/json", json.dumps(item).encode('utf8')
+        if path == "/v1/mediaItems" and method == "GET":
+            self._count("mediaItems:list")
+            with self.lock:
+                ids = list(self.media_items)
+            page, next_token = self._page(ids, query)
+            result = {"mediaItems": [self.media_items[item_id] for item_id in page]}
+            if next_token:
+                result["nextPageToken"] = next_token
+            return 200, "application/json", json.dumps(result).encode('utf8')
+        if path == "/v1/albums" and method == "GET":
+            self._count("albums:list")
+            with self.lock:
+                ids = list(self.albums)
+            page, next_token = self._page(ids, query)
+            result = {"albums": [self.albums[album_id] for album_id in page]}
+            if next_token:
+                result["nextPageToken"] = next_token
+            return 200, "application/json", json.dumps(result).encode('utf8')
+        if path == "/v1/albums" and method == "POST":
+            self._count("albums:create")
+            request = json.loads(body or b"{}")
+            return 200, "application/json", json.dumps(self.add_album(request["album"]["title"])).encode('utf8')
+        if path.startswith("/v1/albums/") and path.endswith(":batchAddMediaItems") and method == "POST":
+            self._count("albums:batchAddMediaItems")
+            album_id = unquote(path[len("/v1/albums/"):-len(":batchAddMediaItems")])
+            request = json.loads(body or b"{}")
+            with self.lock:
+                if album_id not in self.albums:
+                    return 404, "application/json", b'{"error": {"code": 404}}'
+                self.album_items[album_id] += [item_id for item_id in request.get("mediaItemIds", []) if item_id in self.media_items]
+                self.albums[album_id]["mediaItemsCount"] = str(len(self.album_items[album_id]))
+            return 200, "application/json", b"{}"
+        if path.startswith("/v1/albums/") and method == "GET":
+            self._count("albums:get")
+            album = self.albums.get(unquote(path[len("/v1/albums/"):]))
+            if album is None:
+                return 404, "application/json", b'{"error": {"code": 404}}'
+            return 200, "application/json", json.dumps(album).encode('utf8')
+        return 404, "application/json", b'{"error": {"code": 404, "message": "unknown endpoint"}}'
+
+
+class FakePhotosHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _read_body(self):
+        backend = self.server.backend
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = bytearray()
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                body += self.rfile.read(size)
+                self.rfile.readline()
+                backend._throttle(size)
+            return bytes(body)
+        remaining = int(self.headers.get("Content-Length") or 0)
+        body = bytearray()
+        while remaining > 0:
+            chunk = self.rfile.read(min(READ_CHUNK, remaining))
+            if not chunk:
+                break
+            body += chunk
+            remaining -= len(chunk)
+            backend._throttle(len(chunk))
+        return bytes(body)
+
+    def _dispatch(self, method):
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        body = self._read_body() if method == "POST" else b""
+        status, content_type, payload, *extra = self.server.backend.handle(method, url.path, query, self.headers, body)
+        headers = extra[0] if extra else {}
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if "Content-Length" not in headers:
+            self.send_header("Content-Length", str(len(payload)))
+        elif int(headers["Content-Length"]) > len(payload):
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def log_message(self, format, *args):
+        pass
+
+
+def asgi_app(backend):
+    """
+    ASGI front end of a backend, so an ASGI server such as hypercorn can serve it over HTTP/2.
+    The blocking backend (latency and bandwidth are simulated with sleeps) runs on worker threads.
+    Dropped downloads are only simulated by the HTTP/1.1 front end.
+    """
+    import asyncio
+    from email.message import Message
+
+    async def app(scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        headers = Message()
+        for name, value in scope["headers"]:
+            headers[name.decode('latin-1')] = value.decode('latin-1')
+        body = bytearray()
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        if body:
+            await asyncio.to_thread(backend._throttle, len(body))
+        query = {key: values[0] for key, values in parse_qs(scope["query_string"].decode('latin-1')).items()}
+        status, content_type, payload, *extra = await asyncio.to_thread(backend.handle, scope["method"], scope["path"], query, headers, bytes(body))
+        extra = dict(extra[0]) if extra else {}
+        extra.pop("Content-Length", None)
+        response_headers = [(b"content-type", content_type.encode('latin-1')), (b"content-length", str(len(payload)).encode('latin-1'))]
+        response_headers += [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in extra.items()]
+        await send({"type": "http.response.start", "status": status, "headers": response_headers})
+        await send({"type": "http.response.body", "body": payload})
+    return app
+
+
+class Http2Server:
+    """ Hypercorn serving asgi_app(backend) on a daemon thread, with the shutdown() of the HTTP/1.1 server. """
+    def __init__(self, port, backend):
+        import asyncio
+        from hypercorn.asyncio import serve
+        from hypercorn.config import Config
+        self.backend = backend
+        config = Config()
+        config.bind = [f"127.0.0.1:{port}"]
+        config.accesslog = None
+        config.errorlog = None
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        async def run():
+            self.stop = asyncio.Event()
+            started.set()
+            await serve(asgi_app(backend), config, shutdown_trigger=self.stop.wait)
+        self.thread = threading.Thread(target=self.loop.run_until_complete, args=(run(),), name="fake-photos-h2", daemon=True)
+        self.thread.start()
+        started.wait()
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.stop.set)
+        self.thread.join(timeout=10)
+
+
+def start_http2_server(port=0, latency=0.0, bandwidth=None, error_rate=0.0, drop_rate=0.0):
+    """ Start the backend behind hypercorn (HTTP/1.1 and HTTP/2) and return (server, root_url). """
+    import socket
+    if not port:
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+    root_url = f"http://127.0.0.1:{port}"
+    server = Http2Server(port, FakePhotosBackend(root_url, latency, bandwidth, error_rate, drop_rate=drop_rate))
+    # serve() binds asynchronously, wait until the port accepts connections
+    for _ in range(200):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            break
+        except OSError:
+            time.sleep(0.02)
+    return server, root_url
+
+
+def start_server(port=0, latency=0.0, bandwidth=None, error_rate=0.0, drop_rate=0.0):
+    """ Start the fake server on a daemon thread and return (server, root_url). """
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakePhotosHandler)
+    server.daemon_threads = True
+    root_url = f"http://127.0.0.1:{server.server_address[1]}"
+    server.backend = FakePhotosBackend(root_url, latency, bandwidth, error_rate, drop_rate=drop_rate)
+    threading.Thread(target=server.serve_forever, name="fake-photos", daemon=True).start()
+    return server, root_url
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Local stand-in for the Google Photos Library API.")
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on')
+    parser.add_argument('--latency-ms', type=float, default=0, help='Latency added to every API call')
+    parser.add_argument('--bandwidth-mbps', type=float, help='Upload/download bandwidth in megabits per second')
+    parser.add_argument('--error-rate', type=float, default=0, help='Probability of answering 429 to uploads and batchCreate')
+    parser.add_argument('--drop-rate', type=float, default=0, help='Probability of closing a download connection halfway through')
+    parser.add_argument('--http2', action='store_true', help='Serve HTTP/1.1 and cleartext HTTP/2 through hypercorn')
+    args = parser.parse_args()
+    server, root_url = (start_http2_server if args.http2 else start_server)(args.port, args.latency_ms / 1000, args.bandwidth_mbps * 125000 if args.bandwidth_mbps else None, args.error_rate,
+                                    args.drop_rate)
+    print(f"Fake Google Photos API listening on {root_url} (set PHOTOSYNC_API_ROOT={root_url})")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -1,7 +1,13 @@
 import os
-from google_auth_oauthlib.flow import InstalledAppFlow
 from google.oauth2.credentials import Credentials
-import google.auth.transport.requests
+
+PHOTOSYNC_DIRECTORY = os.path.expanduser('~/.PhotoSync')
+
+def profile_path(profile, file_name):
+    """ Per-account state file: ~/.PhotoSync/<file_name> for the default account, ~/.PhotoSync/profiles/<profile>/<file_name> otherwise. """
+    if not profile:
+        return os.path.join(PHOTOSYNC_DIRECTORY, file_name)
+    return os.path.join(PHOTOSYNC_DIRECTORY, 'profiles', profile, file_name)
 
 def get_google_photos_credentials(scopes=None, credentials_path=None, client_secret_path='client_secret.json'):
     if scopes is None:
@@ -12,7 +18,7 @@ def get_google_photos_credentials(scopes=None, credentials_path=None, client_sec
             'https://www.googleapis.com/auth/photoslibrary.edit.appcreateddata'
         ]
     if credentials_path is None:
-        credentials_path = os.path.expanduser('~/.PhotoSync/.credentials.json')
+        credentials_path = profile_path(None, '.credentials.json')
     credentials_directory = os.path.dirname(credentials_path)
     if not os.path.exists(credentials_directory):
         os.makedirs(credentials_directory)
@@ -20,9 +26,12 @@ def get_google_photos_credentials(scopes=None, credentials_path=None, client_sec
     if os.path.exists(credentials_path):
         creds = Credentials.from_authorized_user_file(credentials_path, scopes)
     if not creds or not creds.valid:
+        # The refresh transport and the OAuth flow are heavy imports, only pay for them when the token needs renewing
         if creds and creds.expired and creds.refresh_token:
+            import google.auth.transport.requests
             creds.refresh(google.auth.transport.requests.Request())
         else:
+            from google_auth_oauthlib.flow import InstalledAppFlow
             flow = InstalledAppFlow.from_client_secrets_file(client_secret_path, scopes)
             creds = flow.run_local_server(port=0)
         # Save the credentials for the next run
@@ -0,0 +1,82 @@
+"""
+Optional HTTP/2 transport for PhotoSync, built on httpx with the h2 package (pip install 'httpx[http2]').
+One thread-safe client is shared by every upload thread and API call, so requests are multiplexed as
+streams over a few connections instead of each thread holding its own HTTP/1.1 connection and TLS session.
+The client offers the httplib2 request() interface googleapiclient and google_auth_httplib2.AuthorizedHttp
+call, and a requests-style post() for the upload endpoint. Plain http:// roots (the benchmark's local server)
+are spoken to with HTTP/2 prior knowledge.
+"""
+import logging
+
+logger = logging.getLogger("PhotoSync")
+
+# Connections per origin; HTTP/2 multiplexes the concurrent requests of all threads over them
+DEFAULT_CONNECTIONS = 2
+# Bytes of an upload body read per frame batch
+BODY_CHUNK = 256 * 1024
+
+
+def httpx_module():
+    """ httpx when it and h2 are installed, else None. """
+    try:
+        import httpx
+        import h2  # noqa: F401
+        return httpx
+    except ImportError:
+        return None
+
+
+def _body_chunks(body):
+    while True:
+        chunk = body.read(BODY_CHUNK)
+        if not chunk:
+            return
+        yield chunk
+
+
+class Http2Transport:
+    """
+        :param connections: Maximum connections per origin.
+        :param prior_knowledge: Speak HTTP/2 on plain http:// URLs without an upgrade (the server must support it).
+    """
+    # Attributes google_auth_httplib2.AuthorizedHttp reads from the httplib2.Http it wraps
+    redirect_codes = frozenset((300, 301, 302, 303, 307, 308))
+    follow_redirects = True
+
+    def __init__(self, connections=DEFAULT_CONNECTIONS, prior_knowledge=False):
+        httpx = httpx_module()
+        if httpx is None:
+            raise ImportError("The HTTP/2 transport needs httpx and h2: pip install 'httpx[http2]'")
+        self.timeout = None
+        self.connections = {}
+        self.client = httpx.Client(http1=not prior_knowledge, http2=True,
+                                   limits=httpx.Limits(max_connections=connections, max_keepalive_connections=connections),
+                                   timeout=httpx.Timeout(60.0, read=1800.0, write=1800.0, pool=None))
+
+    def request(self, uri, method="GET", body=None, headers=None, redirections=5, connection_type=None):
+        """ httplib2.Http.request(): returns (httplib2.Response, content bytes). """
+        import httplib2
+        response = self.client.request(method, uri, content=body, headers=headers, follow_redirects=redirections > 0)
+        info = dict(response.headers.items())
+        info["status"] = str(response.status_code)
+        result = httplib2.Response(info)
+        result.reason = response.reason_phrase
+        result.version = 20 if response.http_version == "HTTP/2" else 11
+        return result, response.content
+
+    def post(self, url, data=None, headers=None, timeout=None):
+        """
+        requests.Session.post() for upload bodies: bytes, or a file-like object (e.g. UploadStream) that is streamed
+        with the Content-Length taken from its len().
+        """
+        headers = dict(headers or {})
+        if data is not None and hasattr(data, "read"):
+            headers["Content-Length"] = str(len(data))
+            data = _body_chunks(data)
+        return self.client.post(url, content=data, headers=headers, timeout=timeout if timeout is not None else self.client.timeout)
+
+    def add_certificate(self, key, cert, domain, password=None):
+        raise NotImplementedError("Client certificates are not supported by the HTTP/2 transport")
+
+    def close(self):
+        self.client.close()
@@ -0,0 +1,145 @@
+"""
+Perceptual hashes for near-duplicate detection: the same shot exported at another size, re-saved by an editor
+or taken in a burst hashes to a 64-bit value within a small Hamming distance of the original.
+Images are decoded through PIL's draft mode, so a JPEG is only decoded at 1/8 scale, and the hashes are computed
+with NumPy when it is installed (pure Python otherwise). A BK-tree indexes known hashes by Hamming distance.
+"""
+import math
+
+HASH_METHODS = ('dhash', 'phash')
+# pHash keeps the 8x8 lowest frequencies of the DCT of a 32x32 thumbnail
+PHASH_SIZE = 32
+HASH_SIZE = 8
+
+_numpy = None
+
+
+def numpy_module():
+    """ NumPy if it is installed, else None (checked once). """
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+    return _numpy or None
+
+
+def hamming(first, second):
+    return bin(first ^ second).count('1')
+
+
+def _thumbnail(path, width, height):
+    """ Grayscale thumbnail, decoded at the smallest JPEG draft scale that is still larger than it. """
+    from PIL import Image, ImageOps
+    with Image.open(path) as image:
+        image.draft('L', (width * 4, height * 4))
+        image = ImageOps.exif_transpose(image)
+        return image.convert('L').resize((width, height), Image.BILINEAR)
+
+
+def _bits_to_int(bits):
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+
+def dhash(path):
+    """ Difference hash: whether each pixel of a 9x8 thumbnail is brighter than its right neighbour. """
+    thumbnail = _thumbnail(path, HASH_SIZE + 1, HASH_SIZE)
+    np = numpy_module()
+    if np is not None:
+        pixels = np.asarray(thumbnail, dtype=np.int16)
+        return int.from_bytes(np.packbits(pixels[:, 1:] > pixels[:, :-1]).tobytes(), 'big')
+    pixels = list(thumbnail.getdata())
+    width = HASH_SIZE + 1
+    return _bits_to_int(pixels[row * width + column + 1] > pixels[row * width + column]
+                        for row in range(HASH_SIZE) for column in range(HASH_SIZE))
+
+
+_dct_matrix = None
+
+
+def _dct_rows():
+    """ The first HASH_SIZE rows of the DCT-II basis of size PHASH_SIZE. """
+    global _dct_matrix
+    if _dct_matrix is None:
+        _dct_matrix = [[math.cos((2 * x + 1) * u * math.pi / (2 * PHASH_SIZE)) for x in range(PHASH_SIZE)] for u in range(HASH_SIZE)]
+    return _dct_matrix
+
+
+def phash(path):
+    """ DCT hash: whether each of the 8x8 lowest frequencies of a 32x32 thumbnail is above their median. """
+    thumbnail = _thumbnail(path, PHASH_SIZE, PHASH_SIZE)
+    rows = _dct_rows()
+    np = numpy_module()
+    if np is not None:
+        basis = np.array(rows)
+        coefficients = basis @ np.asarray(thumbnail, dtype=np.float64) @ basis.T
+        return int.from_bytes(np.packbits(coefficients > np.median(coefficients)).tobytes(), 'big')
+    pixels = list(thumbnail.getdata())
+    # Rows of the thumbnail transformed first, then the columns, keeping only the low frequencies
+    partial = [[sum(rows[v][x] * pixels[y * PHASH_SIZE + x] for x in range(PHASH_SIZE)) for v in range(HASH_SIZE)] for y in range(PHASH_SIZE)]
+    coefficients = [sum(rows[u][y] * partial[y][v] for y in range(PHASH_SIZE)) for u in range(HASH_SIZE) for v in range(HASH_SIZE)]
+    ordered = sorted(coefficients)
+    median = (ordered[len(ordered) // 2 - 1] + ordered[len(ordered) // 2]) / 2
+    return _bits_to_int(coefficient > median for coefficient in coefficients)
+
+
+def image_hash(path, method='dhash'):
+    """ Perceptual hash of an image file, None when PIL cannot read it. """
+    try:
+        return (phash if method == 'phash' else dhash)(path)
+    except Exception:
+        return None
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree over 64-bit hashes with the Hamming distance: a search within distance d only visits
+    the children whose edge distance lies within d of the query's distance to their parent.
+    """
+    def __init__(self, items=()):
+        self.root = None
+        self.size = 0
+        for hash_value, value in items:
+            self.add(hash_value, value)
+
+    def __len__(self):
+        return self.size
+
+    def add(self, hash_value, value):
+        node = [hash_value, value, {}]
+        self.size += 1
+        if self.root is None:
+            self.root = node
+            return
+        current = self.root
+        while True:
+            distance = hamming(hash_value, current[0])
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def search(self, hash_value, max_distance):
+        """ All (distance, value) within `max_distance` of `hash_value`. """
+        found = []
+        candidates = [self.root] if self.root is not None else []
+        while candidates:
+            node = candidates.pop()
+            distance = hamming(hash_value, node[0])
+            if distance <= max_distance:
+                found.append((distance, node[1]))
+            for edge, child in node[2].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    candidates.append(child)
+        return found
+
+    def nearest(self, hash_value, max_distance):
+        """ The closest (distance, value) within `max_distance`, or None. """
+        found = self.search(hash_value, max_distance)
+        return min(found, key=lambda match: match[0]) if found else None
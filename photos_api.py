@@ -0,0 +1,66 @@
+"""
+Endpoints of the Google Photos Library API used by the PhotoSync scripts.
+PHOTOSYNC_API_ROOT overrides the API host, which lets the benchmark suite point every
+script (including the UploadPhotoToAlbume.py subprocesses) at a local stand-in server.
+The discovery document is cached under ~/.PhotoSync/discovery so that starting a script
+does not fetch it over the network every time.
+"""
+import hashlib
+import json
+import os
+import time
+
+API_ROOT = os.environ.get('PHOTOSYNC_API_ROOT', 'https://photoslibrary.googleapis.com').rstrip('/')
+UPLOAD_URL = API_ROOT + '/v1/uploads'
+DISCOVERY_URL = API_ROOT + '/$discovery/rest?version={apiVersion}'
+DISCOVERY_CACHE_DIR = os.path.expanduser('~/.PhotoSync/discovery')
+# Cached documents older than this are fetched again (seconds, default one week)
+DISCOVERY_MAX_AGE = int(os.environ.get('PHOTOSYNC_DISCOVERY_MAX_AGE', 7 * 24 * 3600))
+
+
+def discovery_cache_path(version='v1'):
+    """ Cache file of a discovery document, keyed by API root and client library version so either change refetches it. """
+    from googleapiclient.version import __version__ as client_version
+    key = hashlib.sha1(f"{API_ROOT}|{version}|{client_version}".encode('utf8')).hexdigest()[:12]
+    return os.path.join(DISCOVERY_CACHE_DIR, f"photoslibrary.{version}.{key}.json")
+
+
+def load_discovery_document(version='v1', max_age=DISCOVERY_MAX_AGE):
+    """
+    Return the photoslibrary discovery document, from the cache while it is younger than `max_age`.
+    If fetching a fresh copy fails, a stale cached copy is used rather than failing the run.
+    """
+    path = discovery_cache_path(version)
+    cached = None
+    if os.path.exists(path):
+        with open(path) as cache_file:
+            cached = cache_file.read()
+        if time.time() - os.path.getmtime(path) < max_age:
+            return cached
+    from urllib.request import urlopen
+    try:
+        with urlopen(DISCOVERY_URL.format(apiVersion=version), timeout=60) as response:
+            document = response.read().decode('utf8')
+        json.loads(document)
+    except Exception:
+        if cached is not None:
+            return cached
+        raise
+    os.makedirs(DISCOVERY_CACHE_DIR, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as cache_file:
+        cache_file.write(document)
+    os.replace(tmp_path, path)
+    return document
+
+
+def build_service(creds, transport=None):
+    """
+    Build the photoslibrary v1 service for the configured API root from the cached discovery document.
+        :param transport: Optional httplib2-compatible transport (e.g. Http2Transport) the service's calls go through.
+    """
+    from googleapiclient.discovery import build_from_document
+    if transport is not None:
+        import google_auth_httplib2
+        return build_from_document(load_discovery_document(), http=google_auth_httplib2.AuthorizedHttp(creds, http=transport))
+    return build_from_document(load_discovery_document(), credentials=creds)
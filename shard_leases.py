@@ -0,0 +1,209 @@
+"""
+Lease-based coordination for sharded syncs: several PhotoSync processes, on one machine or on several machines
+mounting the same photo tree, share a SQLite file listing the shards of a run (top-level directories, optionally
+split into hash buckets of file paths). A worker claims a pending shard, keeps its lease alive with a heartbeat
+and marks it done; shards whose lease expired because their worker died are stolen by the next idle worker.
+The same file serializes album creation between workers, so no album is created twice.
+
+SQLite locking on network file systems depends on the share supporting POSIX locks (NFSv4, SMB with
+byte-range locking); otherwise keep the store on a local disk of one host and share it via its mount.
+"""
+import contextlib
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import zlib
+
+logger = logging.getLogger("PhotoSync")
+
+# Shard name of the media files directly in the sync directory
+ROOT_SHARD = "."
+# Seconds a lease stays valid without a heartbeat
+DEFAULT_LEASE_TTL = 120
+# Claims of a shard before it is left alone, so a shard that keeps failing does not loop forever
+MAX_ATTEMPTS = 3
+
+
+def shard_name(directory, bucket=0, buckets=1):
+    """ Name of a shard: the top-level directory, followed by '#bucket/buckets' when directories are split. """
+    return directory if buckets == 1 else f"{directory}#{bucket}/{buckets}"
+
+
+def parse_shard(name):
+    """ Inverse of shard_name: (directory, bucket, buckets). """
+    directory, _, split = name.rpartition("#")
+    if not directory or "/" not in split:
+        return name, 0, 1
+    bucket, buckets = split.split("/")
+    return directory, int(bucket), int(buckets)
+
+
+def in_bucket(relative_path, bucket, buckets):
+    """ Whether a file belongs to a bucket, using a hash that is stable across processes and hosts. """
+    return buckets == 1 or zlib.crc32(relative_path.encode('utf8')) % buckets == bucket
+
+
+class LeaseStore:
+    """
+        :param path: SQLite file shared by all workers.
+        :param run: Name of the sync run, workers started with the same name share its shards.
+        :param owner: Identifier of this worker, host name and process id by default.
+        :param ttl: Seconds a lease (or an album creation in progress) stays valid without a heartbeat.
+        :param max_attempts: Claims of a shard before it is left alone.
+    """
+    def __init__(self, path, run="default", owner=None, ttl=DEFAULT_LEASE_TTL, max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.run = run
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+        self.held = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat = None
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        with self._transaction() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS leases (
+                run TEXT,
+                shard TEXT,
+                state TEXT,
+                owner TEXT,
+                expires REAL,
+                attempts INTEGER DEFAULT 0,
+                PRIMARY KEY (run, shard))""")
+            db.execute("""CREATE TABLE IF NOT EXISTS albums (
+                title TEXT PRIMARY KEY,
+                album_id TEXT,
+                owner TEXT,
+                expires REAL)""")
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """ Write transaction taking the database lock up front, so concurrent claims cannot both see a shard as free. """
+        with self._lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    def register(self, shards):
+        """ Add the shards of the run that no worker registered yet. """
+        with self._transaction() as db:
+            db.executemany("INSERT OR IGNORE INTO leases (run, shard, state) VALUES (?, ?, 'pending')",
+                           [(self.run, shard) for shard in shards])
+
+    def claim(self):
+        """
+        Lease the next shard: a pending one, otherwise one whose lease expired (work stealing).
+            :return: (shard, stolen) or (None, False) when every shard is done or leased by a live worker.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute("""SELECT shard, state, owner FROM leases WHERE run = ? AND attempts < ?
+                                AND (state = 'pending' OR (state = 'leased' AND expires < ?))
+                                ORDER BY state = 'leased', shard LIMIT 1""", (self.run, self.max_attempts, now)).fetchone()
+            if row is None:
+                return None, False
+            shard, state, previous_owner = row
+            db.execute("UPDATE leases SET state = 'leased', owner = ?, expires = ?, attempts = attempts + 1 WHERE run = ? AND shard = ?",
+                       (self.owner, now + self.ttl, self.run, shard))
+        stolen = state == 'leased'
+        if stolen:
+            logger.warning(f"Taking over shard {shard} from {previous_owner}, its lease expired")
+        self.held.add(shard)
+        return shard, stolen
+
+    def renew(self, shard):
+        """ Extend a lease, returns False when it was lost to another worker. """
+        with self._transaction() as db:
+            renewed = db.execute("UPDATE leases SET expires = ? WHERE run = ? AND shard = ? AND owner = ? AND state = 'leased'",
+                                 (time.time() + self.ttl, self.run, shard, self.owner)).rowcount
+        return renewed == 1
+
+    def complete(self, shard):
+        with self._transaction() as db:
+            completed = db.execute("UPDATE leases SET state = 'done', expires = NULL WHERE run = ? AND shard = ? AND owner = ?",
+                                   (self.run, shard, self.owner)).rowcount
+        self.held.discard(shard)
+        if not completed:
+            logger.warning(f"Shard {shard} was taken over by another worker before it completed here")
+
+    def release(self, shard):
+        """ Give a shard back so another worker retries it. """
+        with self._transaction() as db:
+            db.execute("UPDATE leases SET state = 'pending', owner = NULL, expires = NULL WHERE run = ? AND shard = ? AND owner = ?",
+                       (self.run, shard, self.owner))
+        self.held.discard(shard)
+
+    def progress(self):
+        """ Number of shards of the run per state. """
+        with self._lock:
+            rows = self.db.execute("SELECT state, COUNT(*) FROM leases WHERE run = ? GROUP BY state", (self.run,)).fetchall()
+        return dict(rows)
+
+    def start_heartbeat(self, on_lost=None):
+        """
+        Renew the held leases every third of the ttl in a background thread.
+            :param on_lost: Callable (shard) invoked when a lease could not be renewed.
+        """
+        def beat():
+            while not self._stop.wait(self.ttl / 3):
+                for shard in list(self.held):
+                    try:
+                        if not self.renew(shard):
+                            logger.error(f"Lost the lease of shard {shard}")
+                            self.held.discard(shard)
+                            if on_lost is not None:
+                                on_lost(shard)
+                    except sqlite3.Error as err:
+                        logger.warning(f"Could not renew the lease of shard {shard}: {err}")
+        self._heartbeat = threading.Thread(target=beat, name="lease-heartbeat", daemon=True)
+        self._heartbeat.start()
+
+    def albums(self):
+        """ Title -> id of the albums created through the store. """
+        with self._lock:
+            return dict(self.db.execute("SELECT title, album_id FROM albums WHERE album_id IS NOT NULL").fetchall())
+
+    def ensure_album(self, title, create, poll=1.0):
+        """
+        Return the id of album `title`, calling `create(title)` in at most one worker at a time.
+        Other workers wait for the id, or take over when the creating worker's reservation expires.
+        """
+        while True:
+            now = time.time()
+            with self._transaction() as db:
+                row = db.execute("SELECT album_id, expires FROM albums WHERE title = ?", (title,)).fetchone()
+                if row is not None and row[0]:
+                    return row[0]
+                owner = row is None or row[1] < now
+                if owner:
+                    db.execute("INSERT OR REPLACE INTO albums (title, album_id, owner, expires) VALUES (?, NULL, ?, ?)",
+                               (title, self.owner, now + self.ttl))
+            if owner:
+                break
+            time.sleep(poll)
+        try:
+            album_id = create(title)
+        except BaseException:
+            with self._transaction() as db:
+                db.execute("DELETE FROM albums WHERE title = ? AND owner = ? AND album_id IS NULL", (title, self.owner))
+            raise
+        with self._transaction() as db:
+            db.execute("UPDATE albums SET album_id = ?, expires = NULL WHERE title = ?", (album_id, title))
+        return album_id
+
+    def close(self):
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+        self.db.close()
@@ -0,0 +1,143 @@
+"""
+Storage-saver transform: before upload, JPEGs larger than a maximum dimension are downscaled and recompressed,
+since Google stores "storage saver" uploads at reduced quality anyway and the full-size bytes only cost uplink.
+JPEGs are decoded through PIL's draft mode, which lets libjpeg decode directly at 1/2, 1/4 or 1/8 scale.
+The EXIF block is kept (with the embedded thumbnail stripped and the dimensions updated), and a missing capture
+date can be written in the same pass. Transforms run in a process pool, submitted in upload order ahead of the
+upload threads (see TransformStream), so they use every core while the upload threads send the earlier results.
+"""
+import collections
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from sync_profiler import profile_worker
+
+logger = logging.getLogger("PhotoSync")
+
+# Google's storage saver quality keeps photos up to 16 MP
+DEFAULT_MAX_DIMENSION = 4608
+DEFAULT_QUALITY = 85
+
+
+def transform_jpeg(path, max_dimension=DEFAULT_MAX_DIMENSION, quality=DEFAULT_QUALITY, date=None, draft=True):
+    """
+    Downscale a JPEG so that its longer side is at most `max_dimension` and recompress it.
+        :param date: Optional "YYYY:MM:DD HH:MM:SS" written as DateTimeOriginal (for files without an EXIF date).
+        :param draft: Decode at reduced scale (disable to compare against a full decode).
+        :return: (new JPEG bytes or None when the result would not be smaller, SHA-256 of the original file, original size)
+    """
+    from PIL import Image
+    import piexif
+    with open(path, 'rb') as photo_file:
+        original = photo_file.read()
+    sha256 = hashlib.sha256(original).hexdigest()
+    with Image.open(BytesIO(original)) as image:
+        if max(image.size) <= max_dimension and date is None:
+            return None, sha256, len(original)
+        exif_bytes = image.info.get('exif')
+        icc_profile = image.info.get('icc_profile')
+        if draft:
+            image.draft('RGB', (max_dimension, max_dimension))
+        image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        exif = {"0th": {}, "Exif": {}, "GPS": {}, "Interop": {}, "1st": {}, "thumbnail": None}
+        if exif_bytes:
+            try:
+                exif = piexif.load(exif_bytes)
+            except Exception as err:
+                logger.warning(f"Could not parse the EXIF data of {path}, dropping it: {err}")
+        # The embedded thumbnail is regenerated by Google and only costs bytes
+        exif["1st"] = {}
+        exif["thumbnail"] = None
+        exif["Exif"][piexif.ExifIFD.PixelXDimension] = image.size[0]
+        exif["Exif"][piexif.ExifIFD.PixelYDimension] = image.size[1]
+        if date is not None:
+            exif["Exif"][piexif.ExifIFD.DateTimeOriginal] = date
+        output = BytesIO()
+        save_options = {"format": "JPEG", "quality": quality, "optimize": True, "exif": piexif.dump(exif)}
+        if icc_profile:
+            save_options["icc_profile"] = icc_profile
+        image.convert('RGB').save(output, **save_options)
+    if output.tell() >= len(original):
+        return None, sha256, len(original)
+    return output.getvalue(), sha256, len(original)
+
+
+class StorageSaver:
+    """
+        :param max_dimension: Longest side of the uploaded JPEGs in pixels.
+        :param quality: JPEG quality of the recompressed files.
+        :param workers: Transform processes, all cores by default.
+    """
+    def __init__(self, max_dimension=DEFAULT_MAX_DIMENSION, quality=DEFAULT_QUALITY, workers=None):
+        self.max_dimension = max_dimension
+        self.quality = quality
+        self.workers = workers or os.cpu_count()
+        self._executor = None
+        # Upload threads of every account submit at once, only one of them may create the pool
+        self._lock = threading.Lock()
+
+    def submit(self, path, date=None):
+        """ Queue the transform of `path`, the returned future yields the transform_jpeg result. """
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=profile_worker, initargs=("saver",))
+            executor = self._executor
+        return executor.submit(transform_jpeg, path, self.max_dimension, self.quality, date)
+
+    def stream(self, jobs, window=None):
+        """
+        Start transforming `jobs`, (path, date) in upload order, ahead of the upload threads.
+            :param window: Transforms submitted and not yet taken, twice the transform processes by default.
+        """
+        return TransformStream(self, jobs, window or 2 * self.workers)
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+class TransformStream:
+    """
+    Transforms of the JPEGs of a plan, submitted in upload order so that an upload thread usually finds its file
+    already transformed. At most `window` results are kept waiting, which bounds the memory of the queued JPEGs.
+        :param saver: StorageSaver running the transforms.
+        :param jobs: (path, date) of the JPEGs in upload order.
+        :param window: Transforms submitted and not yet taken.
+    """
+    def __init__(self, saver, jobs, window):
+        self.saver = saver
+        self.window = window
+        self._jobs = collections.deque(jobs)
+        self._futures = {}
+        self._taken = set()
+        self._lock = threading.Lock()
+        with self._lock:
+            self._fill()
+
+    def _fill(self):
+        while self._jobs and len(self._futures) < self.window:
+            path, date = self._jobs.popleft()
+            if path not in self._futures and path not in self._taken:
+                self._futures[path] = self.saver.submit(path, date)
+
+    def take(self, path, date=None):
+        """ Future of the transform of `path`, submitted now when the stream has not reached it yet (or it is retried). """
+        with self._lock:
+            future = self._futures.pop(path, None)
+            self._taken.add(path)
+            self._fill()
+        return future if future is not None else self.saver.submit(path, date)
+
+    def close(self):
+        """ Cancel the transforms nobody took, e.g. of an interrupted run. """
+        with self._lock:
+            self._jobs.clear()
+            for future in self._futures.values():
+                future.cancel()
+            self._futures.clear()
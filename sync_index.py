@@ -0,0 +1,100 @@
+"""
+Local index of what PhotoSync uploaded: one row per file with its size, mtime, SHA-256 and the
+media item it became, kept in SQLite under ~/.PhotoSync so later runs can verify uploads. Files skipped as
+near-duplicates have a row too, with the file they duplicate instead of a hash and media item.
+"""
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_INDEX_PATH = os.path.expanduser('~/.PhotoSync/sync_index.sqlite')
+
+
+class SyncIndex:
+    """
+    Thread-safe SQLite index of uploaded files.
+        :param path: Database file, created on first use.
+    """
+    def __init__(self, path=DEFAULT_INDEX_PATH):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime REAL,
+            sha256 TEXT,
+            description TEXT,
+            media_item_id TEXT,
+            uploaded REAL,
+            phash TEXT,
+            duplicate_of TEXT)""")
+        # Indexes written before perceptual hashes and skipped near-duplicates were recorded lack the columns
+        columns = [column[1] for column in self.db.execute("PRAGMA table_info(files)")]
+        for column in ("phash", "duplicate_of"):
+            if column not in columns:
+                self.db.execute(f"ALTER TABLE files ADD COLUMN {column} TEXT")
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256)")
+        self.db.commit()
+
+    def record_upload(self, path, size, mtime, sha256, description=None, media_item_id=None, phash=None):
+        """ :param phash: Perceptual hash of the image (64-bit int), see perceptual_hash. """
+        with self._lock:
+            self.db.execute("INSERT OR REPLACE INTO files (path, size, mtime, sha256, description, media_item_id, uploaded, phash) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            (path, size, mtime, sha256, description, media_item_id, time.time(), None if phash is None else f"{phash:016x}"))
+            self.db.commit()
+
+    def record_skip(self, path, size, mtime, duplicate_of):
+        """ Record a file that was not uploaded because it is a near-duplicate of `duplicate_of` (relative path). """
+        with self._lock:
+            self.db.execute("INSERT OR REPLACE INTO files (path, size, mtime, uploaded, duplicate_of) VALUES (?, ?, ?, ?, ?)",
+                            (path, size, mtime, time.time(), duplicate_of))
+            self.db.commit()
+
+    def get(self, path):
+        """ Return the row of `path` as a dict, or None if it was never uploaded or skipped. """
+        with self._lock:
+            cursor = self.db.execute("SELECT path, size, mtime, sha256, description, media_item_id, uploaded, duplicate_of FROM files WHERE path = ?", (path,))
+            row = cursor.fetchone()
+        return _as_dict(row) if row else None
+
+    def find_by_hash(self, sha256):
+        with self._lock:
+            cursor = self.db.execute("SELECT path, size, mtime, sha256, description, media_item_id, uploaded, duplicate_of FROM files WHERE sha256 = ?", (sha256,))
+            return [_as_dict(row) for row in cursor.fetchall()]
+
+    def perceptual_hashes(self):
+        """ (path, perceptual hash) of every uploaded image that has one. """
+        for path, phash in self._stream("SELECT path, phash FROM files WHERE phash IS NOT NULL"):
+            yield path, int(phash, 16)
+
+    def duplicates(self):
+        """ Paths of the files skipped as near-duplicates. """
+        for (path,) in self._stream("SELECT path FROM files WHERE duplicate_of IS NOT NULL"):
+            yield path
+
+    def __iter__(self):
+        """ Stream all rows ordered by path without loading the whole table. """
+        for row in self._stream("SELECT path, size, mtime, sha256, description, media_item_id, uploaded, duplicate_of FROM files ORDER BY path"):
+            yield _as_dict(row)
+
+    def _stream(self, query):
+        """
+        Rows of `query` read through a connection of their own, so that a long scan does not hold the lock of the
+        writers. The connection is closed when the rows are exhausted or the generator is closed.
+        """
+        with contextlib.closing(sqlite3.connect(self.path)) as db:
+            yield from db.execute(query)
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+
+def _as_dict(row):
+    return dict(zip(("path", "size", "mtime", "sha256", "description", "media_item_id", "uploaded", "duplicate_of"), row))
@@ -0,0 +1,258 @@
+"""
+Run metrics for PhotoSync: per-stage timers, counters and per-endpoint latency histograms.
+A single process-wide `metrics` instance is shared by the upload and download paths; the
+collected values can be exported as a JSON summary or in the Prometheus text format.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds (seconds) of the latency histogram buckets, the last bucket is +Inf
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Stages each thread is in, by thread ident, for the sampling profiler
+        self._active = {}
+        self.reset()
+
+    def reset(self):
+        """ Drop all collected values and restart the run clock. """
+        with self._lock:
+            self.started = time.time()
+            self.counters = {}
+            self.stages = {}
+            self.latencies = {}
+
+    def count(self, name, value=1):
+        """
+        Increment a counter.
+            :param name: Counter name, e.g. 'files_uploaded' or 'http_429'.
+            :param value: Amount to add.
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_stage_time(self, name, seconds):
+        with self._lock:
+            stage = self.stages.setdefault(name, {"count": 0, "seconds": 0.0, "max": 0.0})
+            stage["count"] += 1
+            stage["seconds"] += seconds
+            stage["max"] = max(stage["max"], seconds)
+
+    @contextmanager
+    def stage(self, name):
+        """ Time the enclosed block as one occurrence of stage `name`. """
+        ident = threading.get_ident()
+        with self._lock:
+            self._active.setdefault(ident, []).append(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage_time(name, time.perf_counter() - start)
+            with self._lock:
+                active = self._active[ident]
+                active.pop()
+                if not active:
+                    del self._active[ident]
+
+    def active_stages(self, ident):
+        """ Names of the stages thread `ident` is in, outermost first. """
+        with self._lock:
+            return list(self._active.get(ident, ()))
+
+    def observe(self, endpoint, seconds):
+        """
+        Record the latency of one call to an API endpoint.
+            :param endpoint: Endpoint name, e.g. 'uploads' or 'mediaItems:batchCreate'.
+            :param seconds: Call duration.
+        """
+        with self._lock:
+            histogram = self.latencies.setdefault(endpoint, {"count": 0, "sum": 0.0, "buckets": [0] * (len(LATENCY_BUCKETS) + 1)})
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    break
+            else:
+                index = len(LATENCY_BUCKETS)
+            histogram["buckets"][index] += 1
+
+    @contextmanager
+    def timed_call(self, endpoint):
+        """ Time the enclosed API call and record it in the endpoint's latency histogram. """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(endpoint, time.perf_counter() - start)
+
+    def snapshot(self):
+        """ Return a picklable copy of the collected values, used to ship metrics out of worker processes. """
+        with self._lock:
+            return json.loads(json.dumps({"counters": self.counters, "stages": self.stages, "latencies": self.latencies}))
+
+    def merge(self, snapshot):
+        """ Add the values of a snapshot taken in another process into this instance. """
+        if not snapshot:
+            return
+        with self._lock:
+            for name, value in snapshot.get("counters", {}).items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, other in snapshot.get("stages", {}).items():
+                stage = self.stages.setdefault(name, {"count": 0, "seconds": 0.0, "max": 0.0})
+                stage["count"] += other["count"]
+                stage["seconds"] += other["seconds"]
+                stage["max"] = max(stage["max"], other["max"])
+            for endpoint, other in snapshot.get("latencies", {}).items():
+                histogram = self.latencies.setdefault(endpoint, {"count": 0, "sum": 0.0, "buckets": [0] * (len(LATENCY_BUCKETS) + 1)})
+                histogram["count"] += other["count"]
+                histogram["sum"] += other["sum"]
+                histogram["buckets"] = [a + b for a, b in zip(histogram["buckets"], other["buckets"])]
+
+    def summary(self):
+        """ Return the run summary: elapsed time, counters, stage totals and latency percentiles per endpoint. """
+        snapshot = self.snapshot()
+        elapsed = time.time() - self.started
+        counters = snapshot["counters"]
+        summary = {
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            "elapsed_seconds": round(elapsed, 3),
+            "counters": counters,
+            "stages": {name: {"count": s["count"], "seconds": round(s["seconds"], 3), "max_seconds": round(s["max"], 3),
+                              "mean_seconds": round(s["seconds"] / s["count"], 4) if s["count"] else 0.0}
+                       for name, s in snapshot["stages"].items()},
+            "endpoints": {},
+        }
+        for endpoint, histogram in snapshot["latencies"].items():
+            summary["endpoints"][endpoint] = {
+                "calls": histogram["count"],
+                "mean_seconds": round(histogram["sum"] / histogram["count"], 4) if histogram["count"] else 0.0,
+                "p50_seconds": _bucket_quantile(histogram, 0.5),
+                "p95_seconds": _bucket_quantile(histogram, 0.95),
+                "buckets": dict(zip([str(b) for b in LATENCY_BUCKETS] + ["+Inf"], histogram["buckets"])),
+            }
+        if elapsed > 0:
+            summary["rates"] = {
+                "files_per_second": round(counters.get("files_uploaded", 0) / elapsed, 3),
+                "upload_mb_per_second": round(counters.get("bytes_uploaded", 0) / elapsed / 1024 / 1024, 3),
+                "download_mb_per_second": round(counters.get("bytes_downloaded", 0) / elapsed / 1024 / 1024, 3),
+            }
+        return summary
+
+    def write_json(self, path):
+        _atomic_write(path, json.dumps(self.summary(), indent=2, sort_keys=True))
+
+    def to_prometheus(self):
+        """ Render the collected values in the Prometheus text exposition format. """
+        snapshot = self.snapshot()
+        lines = ["# TYPE photosync_elapsed_seconds gauge", f"photosync_elapsed_seconds {time.time() - self.started:.3f}"]
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append(f"# TYPE photosync_{name}_total counter")
+            lines.append(f"photosync_{name}_total {value}")
+        if snapshot["stages"]:
+            lines.append("# TYPE photosync_stage_seconds_total counter")
+            for name, stage in sorted(snapshot["stages"].items()):
+                lines.append(f'photosync_stage_seconds_total{{stage="{name}"}} {stage["seconds"]:.6f}')
+            lines.append("# TYPE photosync_stage_count_total counter")
+            for name, stage in sorted(snapshot["stages"].items()):
+                lines.append(f'photosync_stage_count_total{{stage="{name}"}} {stage["count"]}')
+        if snapshot["latencies"]:
+            lines.append("# TYPE photosync_request_seconds histogram")
+            for endpoint, histogram in sorted(snapshot["latencies"].items()):
+                cumulative = 0
+                for bound, value in zip([str(b) for b in LATENCY_BUCKETS] + ["+Inf"], histogram["buckets"]):
+                    cumulative += value
+                    lines.append(f'photosync_request_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {cumulative}')
+                lines.append(f'photosync_request_seconds_sum{{endpoint="{endpoint}"}} {histogram["sum"]:.6f}')
+                lines.append(f'photosync_request_seconds_count{{endpoint="{endpoint}"}} {histogram["count"]}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        _atomic_write(path, self.to_prometheus())
+
+    def start_prometheus_file(self, path, interval=15):
+        """ Rewrite `path` every `interval` seconds from a daemon thread, for node_exporter's textfile collector. """
+        def writer():
+            while True:
+                self.write_prometheus(path)
+                time.sleep(interval)
+        thread = threading.Thread(target=writer, name="metrics-textfile", daemon=True)
+        thread.start()
+        return thread
+
+    def start_prometheus_server(self, port, address=''):
+        """ Serve the metrics on http://address:port/metrics from a daemon thread. """
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.to_prometheus().encode('utf8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((address, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+        return server
+
+
+def _bucket_quantile(histogram, quantile):
+    """ Estimate a quantile from histogram buckets (upper bound of the bucket that contains it, None past the last bound). """
+    if not histogram["count"]:
+        return 0.0
+    rank = quantile * histogram["count"]
+    cumulative = 0
+    for bound, value in zip(LATENCY_BUCKETS, histogram["buckets"]):
+        cumulative += value
+        if cumulative >= rank:
+            return bound
+    return None
+
+
+def _atomic_write(path, text):
+    # Unique per writer: the periodic Prometheus writer and the end-of-run export may write the same file at once
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as out:
+        out.write(text)
+    os.replace(tmp_path, path)
+
+
+def add_metrics_arguments(parser):
+    """ Add the --metrics-* options shared by the PhotoSync entry points. """
+    parser.add_argument('--metrics-json', type=str, help='Write a JSON metrics summary to this file at the end of the run')
+    parser.add_argument('--metrics-prom', type=str, help='Periodically write Prometheus text-format metrics to this file')
+    parser.add_argument('--metrics-port', type=int, help='Serve Prometheus metrics on this port while running')
+
+
+def start_metrics_export(args):
+    """ Start the long-running exporters requested on the command line. """
+    if args.metrics_prom:
+        metrics.start_prometheus_file(args.metrics_prom)
+    if args.metrics_port:
+        metrics.start_prometheus_server(args.metrics_port)
+
+
+def finish_metrics_export(args, logger=None):
+    """ Write the end-of-run summary files requested on the command line. """
+    if args.metrics_prom:
+        metrics.write_prometheus(args.metrics_prom)
+    if args.metrics_json:
+        metrics.write_json(args.metrics_json)
+    if logger is not None:
+        summary = metrics.summary()
+        logger.info(f"Run finished in {summary['elapsed_seconds']}s: {summary['counters']}")
+
+
+metrics = Metrics()
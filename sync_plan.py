@@ -0,0 +1,166 @@
+"""
+Sync plans for PhotoSync: the complete diff between the source directory and the library (files to upload,
+albums to create, year album attachments) computed before anything is uploaded. A plan can be saved as
+JSON (or gzipped JSON for large libraries), reviewed, and executed later with full-size API batches.
+"""
+import datetime
+import gzip
+import json
+import logging
+import math
+import os
+import threading
+
+logger = logging.getLogger("PhotoSync")
+
+PLAN_VERSION = 1
+# Uploads a run could not complete, uploaded first by the next run
+DEFAULT_QUEUE_PATH = os.path.expanduser('~/.PhotoSync/upload_queue.json')
+# mediaItems:batchCreate and albums:batchAddMediaItems accept at most 50 items per call
+MAX_BATCH_ITEMS = 50
+# Default Library API quota: requests per project per day
+DAILY_REQUEST_QUOTA = 10000
+# Rough cost of one non-upload API call, used for the duration estimate
+REQUEST_SECONDS = 0.5
+
+
+def year_album(entry):
+    """ Title of the year album a planned upload is attached to, None when its directory album already is that year. """
+    return None if entry["year"] == entry["album"] else entry["year"]
+
+
+class SyncPlan:
+    """
+        :param source: Root directory the upload paths are relative to.
+        :param albums_to_create: Titles of the albums the sync needs that do not exist yet.
+        :param uploads: Upload entries, see add_upload.
+        :param skipped: Number of files already in their album.
+        :param near_duplicates: {path, duplicate_of, distance} of the files perceptually close to another one.
+        :param attachments: {album title: media item ids} of existing media items still to add to their year album.
+    """
+    def __init__(self, source, albums_to_create=None, uploads=None, skipped=0, created=None, near_duplicates=None, attachments=None):
+        self.source = source
+        self.attachments = dict(attachments or {})
+        self.near_duplicates = list(near_duplicates or [])
+        self.albums_to_create = list(albums_to_create or [])
+        self.uploads = list(uploads or [])
+        self.skipped = skipped
+        self.created = created or datetime.datetime.now().isoformat(timespec='seconds')
+
+    def __len__(self):
+        return len(self.uploads)
+
+    def add_album(self, title):
+        if title not in self.albums_to_create:
+            self.albums_to_create.append(title)
+
+    def add_upload(self, path, description, album, size, mtime, date, inject_date, phash=None):
+        """
+        Queue one file.
+            :param path: File path relative to the plan source.
+            :param description: Media item description (PhotoSync matches already uploaded files by it).
+            :param album: Title of the directory album, '' for the library only.
+            :param date: Capture date of the file, its year picks the year album.
+            :param inject_date: True when the file has no EXIF date and `date` must be written into it.
+            :param phash: Perceptual hash of the image, recorded in the sync index on upload.
+        """
+        entry = {"path": path, "description": description, "album": album, "size": size, "mtime": mtime,
+                 "date": date.isoformat(timespec='seconds'), "year": date.strftime('%Y'), "inject_date": inject_date}
+        if phash is not None:
+            entry["phash"] = phash
+        self.uploads.append(entry)
+
+    def batch_sizes(self):
+        """ Items per API batch: mediaItems:batchCreate grouped by directory album and albums:batchAddMediaItems by year album. """
+        creates = {}
+        attachments = {}
+        for entry in self.uploads:
+            creates[entry["album"]] = creates.get(entry["album"], 0) + 1
+            year = year_album(entry)
+            if year is not None:
+                attachments[year] = attachments.get(year, 0) + 1
+        return creates, attachments
+
+    def estimate(self, rate=None):
+        """
+        API calls, bytes and duration the plan will take.
+            :param rate: Upload rate in bytes/second, the duration is only estimated when it is known.
+        """
+        creates, attachments = self.batch_sizes()
+        calls = {
+            "albums:create": len(self.albums_to_create),
+            "uploads": len(self.uploads),
+            "mediaItems:batchCreate": sum(math.ceil(count / MAX_BATCH_ITEMS) for count in creates.values()),
+            "albums:batchAddMediaItems": sum(math.ceil(count / MAX_BATCH_ITEMS) for count in attachments.values()),
+        }
+        total_bytes = sum(entry["size"] for entry in self.uploads)
+        requests = sum(calls.values())
+        estimate = {"api_calls": calls, "requests": requests, "bytes": total_bytes,
+                    "daily_quota_fraction": round(requests / DAILY_REQUEST_QUOTA, 4), "seconds": None}
+        if rate:
+            estimate["seconds"] = round(total_bytes / rate + (requests - calls["uploads"]) * REQUEST_SECONDS, 1)
+        return estimate
+
+    def summary(self, rate=None):
+        estimate = self.estimate(rate)
+        lines = [f"Plan for {self.source} ({self.created}): {len(self.uploads)} files to upload "
+                 f"({estimate['bytes'] / 1024 ** 2:.1f} MB), {self.skipped} already synced"
+                 + (f", {len(self.near_duplicates)} near-duplicates" if self.near_duplicates else ""),
+                 f"Albums to create: {', '.join(self.albums_to_create) if self.albums_to_create else 'none'}",
+                 "API calls: " + ", ".join(f"{name} {count}" for name, count in estimate["api_calls"].items()),
+                 f"Requests: {estimate['requests']} ({estimate['daily_quota_fraction']:.1%} of the daily quota)"]
+        if estimate["seconds"] is not None:
+            lines.append(f"Estimated duration: {datetime.timedelta(seconds=int(estimate['seconds']))}")
+        return "\n".join(lines)
+
+    def to_dict(self):
+        return {"version": PLAN_VERSION, "source": self.source, "created": self.created, "skipped": self.skipped,
+                "albums_to_create": self.albums_to_create, "estimate": self.estimate(), "uploads": self.uploads,
+                "near_duplicates": self.near_duplicates, "attachments": self.attachments}
+
+    @classmethod
+    def from_dict(cls, data):
+        if data.get("version") != PLAN_VERSION:
+            raise ValueError(f"Unsupported plan version {data.get('version')}")
+        return cls(data["source"], data["albums_to_create"], data["uploads"], data.get("skipped", 0), data.get("created"),
+                   data.get("near_duplicates"), data.get("attachments"))
+
+    def save(self, path):
+        """ Write the plan as JSON, gzip compressed when `path` ends with .gz. """
+        data = json.dumps(self.to_dict(), indent=None if path.endswith('.gz') else 1).encode('utf8')
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with (gzip.open if path.endswith('.gz') else open)(tmp_path, 'wb') as plan_file:
+            plan_file.write(data)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with (gzip.open if path.endswith('.gz') else open)(path, 'rb') as plan_file:
+            return cls.from_dict(json.loads(plan_file.read().decode('utf8')))
+
+
+class BatchCollector:
+    """
+    Thread-safe grouping of items into per-key batches: `flush(key, items)` runs as soon as a key holds
+    `size` items, and for the remainders on close().
+    """
+    def __init__(self, flush, size=MAX_BATCH_ITEMS):
+        self.flush = flush
+        self.size = size
+        self.batches = {}
+        self._lock = threading.Lock()
+
+    def add(self, key, item):
+        with self._lock:
+            batch = self.batches.setdefault(key, [])
+            batch.append(item)
+            if len(batch) < self.size:
+                return
+            del self.batches[key]
+        self.flush(key, batch)
+
+    def close(self):
+        with self._lock:
+            batches, self.batches = self.batches, {}
+        for key, batch in batches.items():
+            self.flush(key, batch)
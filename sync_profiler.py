@@ -0,0 +1,280 @@
+"""
+Profiling hooks for the PhotoSync entry points (--profile DIR). A profiled run writes to DIR:
+    <name>-<time>.pstats   cProfile stats merged over the main thread, the worker threads and the child
+                           processes (upload subprocesses, storage saver workers), for python -m pstats or snakeviz
+    <name>-<time>.folded   sampled wall-clock stacks in the folded format of flamegraph.pl and speedscope, rooted at
+                           the process, the thread group and the metrics stages the thread was in, so time spent
+                           sleeping or waiting on the network shows up next to CPU time
+    <name>-<time>.memory.txt  with --profile-memory, the top allocating lines at each snapshot and their growth
+Child processes find the run through the PHOTOSYNC_PROFILE_DIR environment variable and leave their parts in a
+directory the parent merges at exit.
+"""
+import atexit
+import collections
+import logging
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+
+from sync_metrics import metrics
+
+logger = logging.getLogger("PhotoSync")
+
+PROFILE_ENV = "PHOTOSYNC_PROFILE_DIR"
+INTERVAL_ENV = "PHOTOSYNC_PROFILE_INTERVAL"
+DEFAULT_SAMPLE_INTERVAL = 0.01
+# Deepest stack recorded per sample
+MAX_SAMPLE_DEPTH = 128
+# Before 3.12 cProfile hooks a single thread, from 3.12 on it uses sys.monitoring and sees every thread
+PER_THREAD_PROFILES = sys.version_info < (3, 12)
+
+# The profiler of this process, see profile_snapshot()
+_running = None
+
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _thread_group(name):
+    """ Thread name without its pool index, so that all workers of a pool share one flame graph root. """
+    default = re.match(r"Thread-\d+ \((.*)\)$", name)
+    return default.group(1) if default else re.sub(r"[-_]\d+$", "", name)
+
+
+class Profiler:
+    """
+        :param directory: Output directory.
+        :param name: Run name, the output files are <name>-<time>.* (parts of child processes are <name>.*).
+        :param interval: Seconds between wall-clock stack samples, 0 to disable sampling.
+        :param memory_top: Allocating lines listed per tracemalloc snapshot, 0 to disable memory tracing.
+        :param part: Write a child-process part for the parent run to merge instead of the final files.
+    """
+    def __init__(self, directory, name, interval=DEFAULT_SAMPLE_INTERVAL, memory_top=0, part=False):
+        self.directory = directory
+        self.name = name
+        self.interval = interval
+        self.memory_top = memory_top
+        self.part = part
+        self.base = os.path.join(directory, name if part else f"{name}-{time.strftime('%Y%m%d-%H%M%S')}")
+        self.parts_directory = None if part else f"{self.base}.parts"
+        self.samples = collections.Counter()
+        self.snapshots = []
+        self._profiles = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+        self._thread_run = None
+        self._finished = False
+
+    @classmethod
+    def from_environment(cls, name):
+        """ Profiler of a child process of a profiled run, None when the parent is not profiling. """
+        directory = os.environ.get(PROFILE_ENV)
+        if not directory:
+            return None
+        return cls(directory, f"{name}-{os.getpid()}", float(os.environ.get(INTERVAL_ENV, DEFAULT_SAMPLE_INTERVAL)), part=True)
+
+    def start(self):
+        global _running
+        import cProfile
+        if _running is not None:
+            # Forked from a profiled process: drop the inherited hooks before installing ours
+            _running._abandon()
+        _running = self
+        os.makedirs(self.directory, exist_ok=True)
+        if self.parts_directory is not None:
+            os.makedirs(self.parts_directory, exist_ok=True)
+            os.environ[PROFILE_ENV] = self.parts_directory
+            os.environ[INTERVAL_ENV] = str(self.interval)
+        if self.memory_top:
+            import tracemalloc
+            tracemalloc.start()
+        if PER_THREAD_PROFILES:
+            self._thread_run = threading.Thread.run
+            original_run, profiles, lock = self._thread_run, self._profiles, self._lock
+
+            def profiled_run(thread):
+                profile = cProfile.Profile()
+                profile.enable()
+                try:
+                    original_run(thread)
+                finally:
+                    profile.disable()
+                    with lock:
+                        profiles.append(profile)
+            threading.Thread.run = profiled_run
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        if self.interval:
+            self._sampler = threading.Thread(target=self._sample, name="profile-sampler", daemon=True)
+            self._sampler.start()
+        return self
+
+    def _sample(self):
+        own = threading.get_ident()
+        root = _thread_group(self.name.rsplit("-", 1)[0] if self.part else self.name)
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < MAX_SAMPLE_DEPTH:
+                    stack.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                stages = tuple(f"[{stage}]" for stage in metrics.active_stages(ident))
+                self.samples[(root, _thread_group(names.get(ident, "thread"))) + stages + tuple(reversed(stack))] += 1
+
+    def snapshot(self, label):
+        """ Take a tracemalloc snapshot reported under `label`, when memory tracing is on. """
+        if not self.memory_top:
+            return
+        import tracemalloc
+        if tracemalloc.is_tracing():
+            # Leave out the profiler's own allocations (sample stacks, stats)
+            snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, module.__file__)
+                                                                  for module in (tracemalloc, sys.modules[__name__])])
+            self.snapshots.append((label, snapshot, tracemalloc.get_traced_memory()))
+
+    def _abandon(self):
+        """ Stop the hooks a forked child inherited without writing anything. """
+        self._finished = True
+        self._stop.set()
+        sys.setprofile(None)
+        if not PER_THREAD_PROFILES:
+            try:
+                self.profile.disable()
+            except Exception:
+                pass
+        if self._thread_run is not None:
+            threading.Thread.run = self._thread_run
+        if self.memory_top:
+            import tracemalloc
+            tracemalloc.stop()
+
+    def finish(self):
+        """ Stop profiling and write the output files, only the first call does anything. """
+        global _running
+        import pstats
+        if self._finished:
+            return
+        self._finished = True
+        self.profile.disable()
+        self.snapshot("end")
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        if self._thread_run is not None:
+            threading.Thread.run = self._thread_run
+        if _running is self:
+            _running = None
+        # Threads still running (daemon helpers) are left out, their profiles are in use
+        with self._lock:
+            profiles = list(self._profiles)
+        stats = pstats.Stats(self.profile)
+        for profile in profiles:
+            stats.add(profile)
+        samples = self.samples
+        if self.parts_directory is not None:
+            for part in sorted(os.listdir(self.parts_directory)):
+                path = os.path.join(self.parts_directory, part)
+                try:
+                    if part.endswith(".pstats"):
+                        stats.add(path)
+                    elif part.endswith(".folded"):
+                        samples.update(read_folded(path))
+                except Exception as err:
+                    logger.warning(f"Could not merge the profile part {path}: {err}")
+            shutil.rmtree(self.parts_directory, ignore_errors=True)
+            os.environ.pop(PROFILE_ENV, None)
+        stats.dump_stats(f"{self.base}.pstats")
+        write_folded(f"{self.base}.folded", samples)
+        written = [f"{self.base}.pstats", f"{self.base}.folded"]
+        if self.memory_top:
+            import tracemalloc
+            tracemalloc.stop()
+            if not self.part:
+                self._write_memory_report(f"{self.base}.memory.txt")
+                written.append(f"{self.base}.memory.txt")
+        if not self.part:
+            logger.info(f"Profile written to {', '.join(written)}")
+
+    def _write_memory_report(self, path):
+        lines = []
+        previous = None
+        for label, snapshot, (current, peak) in self.snapshots:
+            lines.append(f"== {label}: {current / 1024 ** 2:.1f} MB traced, peak {peak / 1024 ** 2:.1f} MB")
+            for statistic in snapshot.statistics("lineno")[:self.memory_top]:
+                lines.append(f"  {statistic}")
+            if previous is not None:
+                lines.append(f"-- growth since {previous[0]}")
+                for difference in snapshot.compare_to(previous[1], "lineno")[:self.memory_top]:
+                    lines.append(f"  {difference}")
+            lines.append("")
+            previous = (label, snapshot)
+        with open(path, 'w') as report:
+            report.write("\n".join(lines))
+
+
+def read_folded(path):
+    samples = collections.Counter()
+    with open(path) as folded:
+        for line in folded:
+            stack, _, count = line.rstrip("\n").rpartition(" ")
+            if stack:
+                samples[tuple(stack.split(";"))] += int(count)
+    return samples
+
+
+def write_folded(path, samples):
+    """ Write stack samples as "frame;frame;frame count" lines, the input format of flamegraph.pl. """
+    with open(path, 'w') as folded:
+        for stack, count in sorted(samples.items()):
+            folded.write(";".join(frame.replace(";", ":") for frame in stack) + f" {count}\n")
+
+
+def profile_snapshot(label):
+    """ Take a tracemalloc snapshot at a stage boundary of a run profiled with --profile-memory. """
+    if _running is not None:
+        _running.snapshot(label)
+
+
+def profile_worker(name):
+    """ ProcessPoolExecutor initializer profiling the worker processes of a profiled run. """
+    profiler = Profiler.from_environment(name)
+    if profiler is not None:
+        from multiprocessing import util
+        util.Finalize(profiler, profiler.finish, exitpriority=10)
+        profiler.start()
+
+
+def profile_process(name):
+    """ Profile a child script (e.g. UploadPhotoToAlbume.py) of a profiled run until it exits. """
+    profiler = Profiler.from_environment(name)
+    if profiler is not None:
+        atexit.register(profiler.finish)
+        profiler.start()
+    return profiler
+
+
+def add_profile_arguments(parser):
+    """ Add the --profile options shared by the PhotoSync entry points. """
+    parser.add_argument('--profile', type=str, metavar='DIR',
+                        help='Write merged cProfile stats and sampled wall-clock stacks (flame graph input) of this run to DIR')
+    parser.add_argument('--profile-interval', type=float, default=DEFAULT_SAMPLE_INTERVAL,
+                        help='Seconds between the wall-clock stack samples of --profile, 0 to disable sampling')
+    parser.add_argument('--profile-memory', type=int, default=0, metavar='N',
+                        help='With --profile, trace allocations and report the top N allocating lines at each stage snapshot')
+
+
+def start_profile(args, name):
+    """ Start the profiler requested on the command line, it writes its files when the process exits. """
+    if not args.profile:
+        return None
+    profiler = Profiler(os.path.expanduser(args.profile), name, args.profile_interval, args.profile_memory)
+    atexit.register(profiler.finish)
+    return profiler.start()
@@ -0,0 +1,137 @@
+"""
+Verification of a synced tree against the sync index and the remote library, without uploading anything.
+Local file records are merge-joined with the sync index (both ordered by path) and matched against the
+album listings by the same keys the sync uses (description, filename). The albums are listed concurrently
+and each page is checked for remote items without a local file as it arrives. A sample of the indexed
+files is re-hashed under a bandwidth cap to catch local files that changed without a size or mtime change.
+"""
+import datetime
+import hashlib
+import json
+import logging
+import os
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("PhotoSync")
+
+# Finding kinds, in report order
+MISSING = "missing"
+EXTRA = "extra"
+MISMATCHED = "mismatched"
+KINDS = (MISSING, EXTRA, MISMATCHED)
+# Findings of each kind printed by summary(), the saved report has all of them
+SUMMARY_LIMIT = 20
+HASH_CHUNK = 1024 * 1024
+
+
+def default_sample_seed():
+    """ The ISO year and week, so that weekly runs re-hash a different sample each time. """
+    year, week, _ = datetime.date.today().isocalendar()
+    return f"{year}-W{week:02d}"
+
+
+def in_sample(path, fraction, seed=""):
+    """ Whether `path` belongs to the re-hash sample: a stable hash of the path and seed below `fraction`. """
+    if fraction >= 1:
+        return True
+    return zlib.crc32(f"{seed}|{path}".encode('utf8')) < fraction * 2 ** 32
+
+
+def join_index(records, index_rows):
+    """
+    Merge-join file records with sync index rows, both keyed by absolute path.
+        :param records: (absolute path, record) sorted by path.
+        :param index_rows: Index rows sorted by path, see SyncIndex.__iter__.
+        :return: Iterator of (absolute path, record or None, index row or None).
+    """
+    records = iter(records)
+    index_rows = iter(index_rows)
+    record = next(records, None)
+    row = next(index_rows, None)
+    while record is not None or row is not None:
+        if row is None or (record is not None and record[0] < row["path"]):
+            yield record[0], record[1], None
+            record = next(records, None)
+        elif record is None or row["path"] < record[0]:
+            yield row["path"], None, row
+            row = next(index_rows, None)
+        else:
+            yield record[0], record[1], row
+            record = next(records, None)
+            row = next(index_rows, None)
+
+
+def file_sha256(path, limiter=None):
+    """ SHA-256 of a file, read in chunks that first pass through `limiter` (a BandwidthLimiter) when given. """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as media_file:
+        while True:
+            if limiter is not None:
+                limiter.consume(HASH_CHUNK)
+            chunk = media_file.read(HASH_CHUNK)
+            if not chunk:
+                return digest.hexdigest()
+            digest.update(chunk)
+
+
+class VerifyReport:
+    """ Thread-safe collection of verification findings and match counts. """
+    def __init__(self, source):
+        self.source = source
+        self.created = datetime.datetime.now().isoformat(timespec='seconds')
+        self.findings = {kind: [] for kind in KINDS}
+        self.counts = {"files": 0, "matched": 0, "rehashed": 0, "remote_items": 0}
+        self._lock = threading.Lock()
+
+    def add(self, kind, path, reason, **details):
+        with self._lock:
+            self.findings[kind].append(dict(path=path, reason=reason, **details))
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    @property
+    def clean(self):
+        return not any(self.findings.values())
+
+    def summary(self, limit=SUMMARY_LIMIT):
+        lines = [f"Verified {self.counts['files']} local files against {self.counts['remote_items']} remote items of {self.source}: "
+                 f"{self.counts['matched']} matched, " + ", ".join(f"{len(self.findings[kind])} {kind}" for kind in KINDS)
+                 + f" ({self.counts['rehashed']} files re-hashed)"]
+        for kind in KINDS:
+            for finding in self.findings[kind][:limit]:
+                lines.append(f"  {kind}: {finding['path']} ({finding['reason']})")
+            if len(self.findings[kind]) > limit:
+                lines.append(f"  ... {len(self.findings[kind]) - limit} more {kind}")
+        return "\n".join(lines)
+
+    def to_dict(self):
+        return {"source": self.source, "created": self.created, "counts": self.counts, **self.findings}
+
+    def save(self, path):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as report_file:
+            json.dump(self.to_dict(), report_file, indent=1)
+        os.replace(tmp_path, path)
+
+
+def rehash(report, candidates, limiter=None, workers=4):
+    """
+    Re-hash sampled files and report those whose content no longer matches the index.
+        :param candidates: (absolute path, relative path, index row) of files whose size and mtime match the index.
+    """
+    def check(candidate):
+        path, relative_path, row = candidate
+        try:
+            sha256 = file_sha256(path, limiter)
+        except OSError as err:
+            report.add(MISMATCHED, relative_path, f"unreadable: {err}")
+            return
+        report.count("rehashed")
+        if sha256 != row["sha256"]:
+            report.add(MISMATCHED, relative_path, "content differs from the uploaded file", sha256=sha256, indexed_sha256=row["sha256"])
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rehash") as executor:
+        list(executor.map(check, candidates))
@@ -0,0 +1,94 @@
+import pytest
+
+import compact_catalogue
+from compact_catalogue import CompactKeySet, MAGIC
+
+
+def keys(count, prefix="IMG_"):
+    return [f"{prefix}{index:06}.jpg" for index in range(count)]
+
+
+def test_membership_before_and_after_freeze():
+    key_set = CompactKeySet(keys(100))
+    key_set.add("holiday.jpg")
+    assert "holiday.jpg" in key_set
+    assert "IMG_000042.jpg" in key_set
+    assert "IMG_000100.jpg" not in key_set
+    key_set.freeze()
+    assert not key_set.pending
+    assert list(key_set.sorted) == sorted(key_set.sorted)
+    assert len(key_set) == 101
+    assert "IMG_000099.jpg" in key_set
+
+
+def test_merges_keep_the_digests_sorted(monkeypatch):
+    monkeypatch.setattr(compact_catalogue, "PENDING_LIMIT", 8)
+    key_set = CompactKeySet()
+    for key in keys(50):
+        key_set.add(key)
+    key_set.update(keys(50, prefix="DSC_"))
+    # Pending keys were merged along the way, not only at the end
+    assert len(key_set.sorted) >= 64
+    key_set.freeze()
+    assert list(key_set.sorted) == sorted(key_set.sorted)
+    assert len(key_set) == 100
+    assert all(key in key_set for key in keys(50) + keys(50, prefix="DSC_"))
+
+
+def test_lookup_merges_pending_keys():
+    key_set = CompactKeySet(keys(10)).freeze()
+    key_set.add("late.jpg")
+    assert key_set.pending
+    assert "late.jpg" in key_set
+    assert not key_set.pending
+
+
+def test_duplicate_keys_are_found():
+    key_set = CompactKeySet(["a.jpg", "a.jpg", "b.jpg"]).freeze()
+    assert "a.jpg" in key_set and "b.jpg" in key_set
+    assert "c.jpg" not in key_set
+
+
+def test_spill_serves_lookups_from_the_mapped_file(tmp_path):
+    path = str(tmp_path / "album.keys")
+    key_set = CompactKeySet(keys(1000))
+    key_set.add("pending.jpg")
+    key_set.spill(path)
+    assert key_set._mapped is not None
+    assert "pending.jpg" in key_set
+    assert "IMG_000999.jpg" in key_set
+    assert "IMG_001000.jpg" not in key_set
+    assert key_set.nbytes() < 1000 * 8
+    with open(path, 'rb') as keys_file:
+        assert keys_file.read(len(MAGIC)) == MAGIC
+    reopened = CompactKeySet.open(path)
+    assert len(reopened) == 1001
+    assert "IMG_000500.jpg" in reopened
+    reopened.close()
+    key_set.close()
+    assert len(key_set) == 0
+
+
+def test_keys_added_after_a_spill_are_merged_out_of_the_map(tmp_path):
+    key_set = CompactKeySet(keys(10)).spill(str(tmp_path / "album.keys"))
+    key_set.add("new.jpg")
+    assert "new.jpg" in key_set
+    # The merge copied the mapped digests into memory and released the map
+    assert key_set._mapped is None
+    assert "IMG_000003.jpg" in key_set
+    key_set.close()
+
+
+def test_spill_of_an_empty_set(tmp_path):
+    path = str(tmp_path / "empty.keys")
+    CompactKeySet().spill(path)
+    reopened = CompactKeySet.open(path)
+    assert len(reopened) == 0
+    assert "a.jpg" not in reopened
+
+
+def test_open_rejects_other_files(tmp_path):
+    path = tmp_path / "other.keys"
+    path.write_bytes(b"NOTKEYS!" + bytes(16))
+    with pytest.raises(ValueError):
+        CompactKeySet.open(str(path))
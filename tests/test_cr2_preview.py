@@ -0,0 +1,183 @@
+import struct
+from io import BytesIO
+
+import pytest
+
+from cr2_preview import TiffFile, capture_date, jpeg_dimensions, preview_jpeg, read_preview
+
+Image = pytest.importorskip("PIL.Image")
+
+IFD0, EXIF_IFD, IFD1, RAW_IFD, DATA = 16, 256, 512, 768, 1024
+DATE = b"2021:06:05 14:30:00\0"
+
+
+def jpeg(width, height):
+    output = BytesIO()
+    Image.new('RGB', (width, height), (200, 120, 40)).save(output, format='JPEG')
+    return output.getvalue()
+
+
+def ifd(order, offset, entries, next_offset=0):
+    """ IFD at `offset` followed by the values that do not fit in their entry. """
+    data_offset = offset + 2 + 12 * len(entries) + 4
+    table, data = [struct.pack(order + 'H', len(entries))], b""
+    for tag, field_type, count, payload in sorted(entries):
+        if len(payload) <= 4:
+            table.append(struct.pack(order + 'HHI', tag, field_type, count) + payload.ljust(4, b"\0"))
+        else:
+            table.append(struct.pack(order + 'HHII', tag, field_type, count, data_offset + len(data)))
+            data += payload
+    return b"".join(table) + struct.pack(order + 'I', next_offset) + data
+
+
+def cr2(preview, thumbnail, orientation=1, order='<', exif_offset=EXIF_IFD):
+    """ A CR2 layout: IFD0 with the preview strip and the EXIF pointer, IFD1 with the thumbnail, the raw IFD last. """
+    raw = b"\xff\xd8\xff\xc3\x00\x0b\x0e\x0e\xa0\x15\xa0" + bytes(256)
+    thumbnail_offset = DATA
+    preview_offset = thumbnail_offset + len(thumbnail)
+    raw_offset = preview_offset + len(preview)
+    short = lambda tag, value: (tag, 3, 1, struct.pack(order + 'H', value))
+    uint = lambda tag, value: (tag, 4, 1, struct.pack(order + 'I', value))
+    ifd0_entries = [short(0x0103, 6), (0x010F, 2, 6, b"Canon\0"), uint(0x0111, preview_offset), uint(0x0117, len(preview)),
+                    (0x0132, 2, len(DATE), DATE), uint(0x8769, exif_offset)]
+    if orientation is not None:
+        ifd0_entries.append(short(0x0112, orientation))
+    layout = {
+        IFD0: ifd(order, IFD0, ifd0_entries, IFD1),
+        EXIF_IFD: ifd(order, EXIF_IFD, [(0x829A, 5, 1, struct.pack(order + 'II', 1, 250)), (0x9003, 2, len(DATE), DATE)]),
+        IFD1: ifd(order, IFD1, [uint(0x0201, thumbnail_offset), uint(0x0202, len(thumbnail))], RAW_IFD),
+        RAW_IFD: ifd(order, RAW_IFD, [short(0x0103, 6), uint(0x0111, raw_offset), uint(0x0117, len(raw))]),
+    }
+    byte_order = b"II" if order == '<' else b"MM"
+    output = bytearray((byte_order + struct.pack(order + 'HI', 42, IFD0) + b"CR\x02\x00" + struct.pack(order + 'I', RAW_IFD)).ljust(DATA, b"\0"))
+    for offset, table in layout.items():
+        output[offset:offset + len(table)] = table
+    return bytes(output) + thumbnail + preview + raw
+
+
+def write(tmp_path, data, name="IMG_0001.CR2"):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+def patch(data, offset, value):
+    return data[:offset] + value + data[offset + len(value):]
+
+
+@pytest.mark.parametrize("order", ['<', '>'])
+def test_reads_the_largest_preview_and_the_raw_metadata(tmp_path, order):
+    preview, thumbnail = jpeg(320, 240), jpeg(160, 120)
+    data, dimensions, metadata = read_preview(write(tmp_path, cr2(preview, thumbnail, orientation=6, order=order)))
+    assert data == preview
+    assert dimensions == (320, 240)
+    assert metadata["0th"][0x010F] == b"Canon"
+    assert metadata["0th"][0x0112] == 6
+    assert metadata["Exif"][0x829A] == (1, 250)
+    assert capture_date(metadata) == "2021:06:05 14:30:00"
+
+
+def test_jpeg_dimensions():
+    assert jpeg_dimensions(jpeg(64, 48)) == (64, 48)
+    assert jpeg_dimensions(b"\xff\xd8\xff\xc3\x00\x0b\x0e\x0e\xa0\x15\xa0") is None
+    assert jpeg_dimensions(b"GIF89a") is None
+    assert jpeg_dimensions(jpeg(64, 48)[:40]) is None
+
+
+def test_preview_jpeg_keeps_the_orientation(tmp_path):
+    piexif = pytest.importorskip("piexif")
+    path = write(tmp_path, cr2(jpeg(320, 240), jpeg(160, 120), orientation=8))
+    exif = piexif.load(preview_jpeg(path))
+    assert exif["0th"][piexif.ImageIFD.Orientation] == 8
+    assert exif["Exif"][piexif.ExifIFD.PixelXDimension] == 320
+    assert exif["Exif"][piexif.ExifIFD.DateTimeOriginal] == b"2021:06:05 14:30:00"
+    # The preview pixels are stored as shot, only the tag rotates them
+    with Image.open(BytesIO(preview_jpeg(path))) as image:
+        assert image.size == (320, 240)
+
+
+def test_preview_jpeg_without_orientation_or_date(tmp_path):
+    piexif = pytest.importorskip("piexif")
+    data = cr2(jpeg(320, 240), jpeg(160, 120), orientation=None, exif_offset=0)
+    # Drop the DateTime tag by renaming it to an unknown one
+    data = data.replace(struct.pack('<HH', 0x0132, 2), struct.pack('<HH', 0xC000, 2), 1)
+    exif = piexif.load(preview_jpeg(write(tmp_path, data), date="2020:01:02 03:04:05"))
+    assert piexif.ImageIFD.Orientation not in exif["0th"]
+    assert exif["Exif"][piexif.ExifIFD.DateTimeOriginal] == b"2020:01:02 03:04:05"
+
+
+@pytest.mark.parametrize("data", [b"", b"II", b"PK\x03\x04" + bytes(12), b"II" + struct.pack('<HI', 43, 8) + bytes(8)],
+                         ids=["empty", "short", "zip", "magic"])
+def test_rejects_files_that_are_not_tiff(tmp_path, data):
+    with pytest.raises(ValueError):
+        read_preview(write(tmp_path, data))
+
+
+def test_first_ifd_beyond_the_end_of_the_file(tmp_path):
+    data = patch(cr2(jpeg(320, 240), jpeg(160, 120)), 4, struct.pack('<I', 10 ** 7))
+    with pytest.raises(ValueError):
+        read_preview(write(tmp_path, data))
+
+
+def test_truncated_first_ifd(tmp_path):
+    data = cr2(jpeg(320, 240), jpeg(160, 120))[:IFD0 + 20]
+    with pytest.raises(ValueError):
+        read_preview(write(tmp_path, data))
+
+
+def test_corrupt_link_keeps_the_ifds_before_it(tmp_path):
+    preview = jpeg(320, 240)
+    data = cr2(preview, jpeg(160, 120))
+    # Point IFD0's next-IFD link beyond the end of the file
+    entries = struct.unpack('<H', data[IFD0:IFD0 + 2])[0]
+    data = patch(data, IFD0 + 2 + 12 * entries, struct.pack('<I', 10 ** 7))
+    assert read_preview(write(tmp_path, data))[0] == preview
+
+
+def test_looping_ifd_chain_terminates(tmp_path):
+    data = cr2(jpeg(320, 240), jpeg(160, 120))
+    entries = struct.unpack('<H', data[IFD1:IFD1 + 2])[0]
+    data = patch(data, IFD1 + 2 + 12 * entries, struct.pack('<I', IFD0))
+    with open(write(tmp_path, data), 'rb') as raw_file:
+        assert [offset for offset, _ in TiffFile(raw_file).ifd_chain()] == [IFD0, IFD1]
+
+
+def test_preview_offset_out_of_range_falls_back_to_the_thumbnail(tmp_path):
+    thumbnail = jpeg(160, 120)
+    data = cr2(jpeg(320, 240), thumbnail)
+    data = data.replace(struct.pack('<HHI', 0x0111, 4, 1) + struct.pack('<I', DATA + len(thumbnail)),
+                        struct.pack('<HHI', 0x0111, 4, 1) + struct.pack('<I', 10 ** 7), 1)
+    preview, dimensions, _ = read_preview(write(tmp_path, data))
+    assert preview == thumbnail and dimensions == (160, 120)
+
+
+def test_truncated_preview(tmp_path):
+    preview, thumbnail = jpeg(320, 240), jpeg(160, 120)
+    data = cr2(preview, thumbnail)
+    with pytest.raises(ValueError, match="truncated"):
+        read_preview(write(tmp_path, data[:DATA + len(thumbnail) + len(preview) // 2]))
+
+
+def test_no_embedded_jpeg(tmp_path):
+    data = cr2(b"\0" * 64, b"\0" * 32)
+    with pytest.raises(ValueError, match="no embedded JPEG"):
+        read_preview(write(tmp_path, data))
+
+
+def test_corrupt_exif_ifd_keeps_the_preview(tmp_path):
+    preview = jpeg(320, 240)
+    data, _, metadata = read_preview(write(tmp_path, cr2(preview, jpeg(160, 120), exif_offset=10 ** 7)))
+    assert data == preview
+    assert metadata["Exif"] == {}
+    # The IFD0 DateTime still dates the preview
+    assert capture_date(metadata) == "2021:06:05 14:30:00"
+
+
+def test_tag_values_beyond_the_end_of_the_file_are_skipped(tmp_path):
+    data = cr2(jpeg(320, 240), jpeg(160, 120))
+    make = struct.pack('<HHI', 0x010F, 2, 6)
+    position = data.index(make)
+    data = patch(data, position + 8, struct.pack('<I', 10 ** 7))
+    _, _, metadata = read_preview(write(tmp_path, data))
+    assert 0x010F not in metadata["0th"]
+    assert metadata["0th"][0x0112] == 1
@@ -0,0 +1,118 @@
+import random
+
+import pytest
+
+import perceptual_hash
+from perceptual_hash import BKTree, dhash, hamming, image_hash, phash
+
+Image = pytest.importorskip("PIL.Image")
+
+ALL_BITS = 2 ** 64 - 1
+
+
+def random_hashes(count, seed=7):
+    rng = random.Random(seed)
+    return [rng.getrandbits(64) for _ in range(count)]
+
+
+def test_search_matches_a_linear_scan():
+    hashes = random_hashes(500)
+    tree = BKTree((hash_value, index) for index, hash_value in enumerate(hashes))
+    assert len(tree) == 500
+    rng = random.Random(1)
+    queries = [hashes[3], hashes[3] ^ 0b1011] + [rng.getrandbits(64) for _ in range(20)]
+    for query in queries:
+        for radius in (0, 1, 4, 10, 28, 64):
+            expected = sorted((hamming(query, hash_value), index) for index, hash_value in enumerate(hashes)
+                              if hamming(query, hash_value) <= radius)
+            assert sorted(tree.search(query, radius)) == expected
+
+
+def test_radius_bounds_are_inclusive():
+    tree = BKTree([(0, "zero"), (0b111, "three"), (0b1111, "four")])
+    assert sorted(tree.search(0, 3)) == [(0, "zero"), (3, "three")]
+    assert tree.search(0b1, 0) == []
+    assert tree.nearest(0b1, 1) == (1, "zero")
+    assert tree.nearest(0b1111, 1) == (0, "four")
+
+
+def test_equal_hashes_are_all_kept():
+    tree = BKTree([(42, "first"), (42, "second")])
+    assert sorted(tree.search(42, 0)) == [(0, "first"), (0, "second")]
+
+
+def test_empty_tree():
+    tree = BKTree()
+    assert len(tree) == 0
+    assert tree.search(123, 64) == []
+    assert tree.nearest(123, 64) is None
+
+
+def gradient(path, increasing=True, size=(256, 192), rotate=False):
+    ramp = Image.linear_gradient('L').rotate(90 if increasing else -90).resize(size)
+    if rotate:
+        ramp = ramp.transpose(Image.Transpose.ROTATE_90)
+    ramp.save(path)
+    return str(path)
+
+
+def photo(path, seed, size=(640, 480), quality=90):
+    rng = random.Random(seed)
+    image = Image.merge('RGB', [Image.effect_noise((size[0] // 32, size[1] // 32), rng.randint(40, 90)).resize(size, Image.BICUBIC)
+                                for _ in range(3)])
+    image.save(path, quality=quality)
+    return str(path)
+
+
+@pytest.fixture(params=[True, False], ids=["numpy", "python"])
+def numpy_or_not(request, monkeypatch):
+    if request.param:
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(perceptual_hash, "_numpy", False)
+    return request.param
+
+
+def test_dhash_of_gradients(tmp_path, numpy_or_not):
+    # Every pixel is brighter than its left neighbour, or darker
+    assert dhash(gradient(tmp_path / "up.png")) == ALL_BITS
+    assert dhash(gradient(tmp_path / "down.png", increasing=False)) == 0
+
+
+def test_hashes_ignore_size_and_recompression(tmp_path, numpy_or_not):
+    original = photo(tmp_path / "original.jpg", seed=3)
+    with Image.open(original) as image:
+        image.resize((320, 240)).save(tmp_path / "small.jpg", quality=60)
+    other = photo(tmp_path / "other.jpg", seed=11)
+    for method in (dhash, phash):
+        assert hamming(method(original), method(str(tmp_path / "small.jpg"))) <= 6
+        assert hamming(method(original), method(other)) > 6
+
+
+def test_numpy_and_python_hashes_agree(tmp_path, monkeypatch):
+    pytest.importorskip("numpy")
+    path = photo(tmp_path / "photo.jpg", seed=5)
+    with_numpy = (dhash(path), phash(path))
+    monkeypatch.setattr(perceptual_hash, "_numpy", False)
+    without_numpy = (dhash(path), phash(path))
+    assert with_numpy[0] == without_numpy[0]
+    # Float summation order may flip a coefficient sitting on the median
+    assert hamming(with_numpy[1], without_numpy[1]) <= 2
+
+
+def test_exif_orientation_is_applied(tmp_path):
+    piexif = pytest.importorskip("piexif")
+    upright = gradient(tmp_path / "upright.jpg")
+    # Stored rotated, with Orientation 8 (rotate 90 CW to display) restoring the upright image
+    with Image.open(upright) as image:
+        image.transpose(Image.Transpose.ROTATE_270).save(tmp_path / "tagged.jpg",
+                                                         exif=piexif.dump({"0th": {piexif.ImageIFD.Orientation: 8}}))
+    assert hamming(dhash(upright), dhash(str(tmp_path / "tagged.jpg"))) <= 2
+
+
+def test_image_hash_of_unreadable_files(tmp_path):
+    path = tmp_path / "broken.jpg"
+    path.write_bytes(b"not an image")
+    assert image_hash(str(path)) is None
+    assert image_hash(str(tmp_path / "missing.jpg"), 'phash') is None
+    assert image_hash(gradient(tmp_path / "up.png")) == ALL_BITS
@@ -0,0 +1,164 @@
+import threading
+import time
+
+import pytest
+
+from shard_leases import LeaseStore, in_bucket, parse_shard, shard_name
+
+
+@pytest.fixture
+def stores(tmp_path):
+    opened = []
+
+    def open_store(owner, ttl=60, **options):
+        store = LeaseStore(str(tmp_path / "leases.sqlite"), run="test", owner=owner, ttl=ttl, **options)
+        opened.append(store)
+        return store
+    yield open_store
+    for store in opened:
+        store.close()
+
+
+def expire(store, shard):
+    """ Let the lease of `shard` run out without waiting for its ttl. """
+    with store._transaction() as db:
+        db.execute("UPDATE leases SET expires = ? WHERE run = ? AND shard = ?", (time.time() - 1, store.run, shard))
+
+
+def test_shard_names_round_trip():
+    assert parse_shard(shard_name("2021", 3, 8)) == ("2021", 3, 8)
+    assert parse_shard(shard_name("Trip #2")) == ("Trip #2", 0, 1)
+    assert parse_shard("Trip #2#1/4") == ("Trip #2", 1, 4)
+    paths = [f"2021/IMG_{index:04}.jpg" for index in range(200)]
+    assert sorted(path for bucket in range(4) for path in paths if in_bucket(path, bucket, 4)) == sorted(paths)
+
+
+def test_claims_every_shard_once(stores):
+    first, second = stores("first"), stores("second")
+    first.register(["a", "b"])
+    # Registering again, e.g. by a worker starting later, keeps the progress
+    second.register(["a", "b", "c"])
+    claims = [first.claim(), second.claim(), first.claim()]
+    assert sorted(shard for shard, _ in claims) == ["a", "b", "c"]
+    assert not any(stolen for _, stolen in claims)
+    assert second.claim() == (None, False)
+    for shard, _ in claims[:2]:
+        (first if shard in first.held else second).complete(shard)
+    assert first.progress() == {"done": 2, "leased": 1}
+
+
+def test_live_leases_are_not_stolen(stores):
+    first, second = stores("first"), stores("second")
+    first.register(["a"])
+    assert first.claim() == ("a", False)
+    assert second.claim() == (None, False)
+    assert first.renew("a")
+
+
+def test_expired_lease_is_stolen(stores):
+    first, second = stores("first"), stores("second")
+    first.register(["a"])
+    first.claim()
+    expire(first, "a")
+    assert second.claim() == ("a", True)
+    assert not first.renew("a")
+    # The late worker's completion does not mark the shard done for the new owner
+    first.complete("a")
+    assert second.progress() == {"leased": 1}
+    second.complete("a")
+    assert second.progress() == {"done": 1}
+
+
+def test_lease_expires_after_its_ttl(stores):
+    first, second = stores("first", ttl=0.2), stores("second", ttl=0.2)
+    first.register(["a"])
+    first.claim()
+    assert second.claim() == (None, False)
+    time.sleep(0.3)
+    assert second.claim() == ("a", True)
+
+
+def test_failing_shard_is_left_alone_after_max_attempts(stores):
+    store = stores("worker", max_attempts=2)
+    store.register(["a"])
+    for _ in range(2):
+        assert store.claim()[0] == "a"
+        expire(store, "a")
+    assert store.claim() == (None, False)
+
+
+def test_released_shard_is_retried_by_another_worker(stores):
+    first, second = stores("first"), stores("second")
+    first.register(["a"])
+    first.claim()
+    first.release("a")
+    assert "a" not in first.held
+    assert second.claim() == ("a", False)
+
+
+def test_heartbeat_keeps_the_lease(stores):
+    first, second = stores("first", ttl=0.3), stores("second", ttl=0.3)
+    first.register(["a"])
+    first.claim()
+    first.start_heartbeat()
+    time.sleep(0.8)
+    assert second.claim() == (None, False)
+
+
+def test_heartbeat_reports_a_lost_lease(stores):
+    first, second = stores("first", ttl=0.3), stores("second", ttl=60)
+    first.register(["a"])
+    first.claim()
+    # What PhotoSync.syncSharded does: the upload threads check lease_lost before each file
+    lease_lost = threading.Event()
+    lost = []
+    first.start_heartbeat(lambda shard: (lost.append(shard), lease_lost.set()))
+    expire(second, "a")
+    assert second.claim() == ("a", True)
+    assert lease_lost.wait(2)
+    assert lost == ["a"]
+    assert "a" not in first.held
+    assert second.renew("a")
+
+
+def test_ensure_album_creates_once(stores):
+    workers = [stores(f"worker-{index}") for index in range(4)]
+    created = []
+    barrier = threading.Barrier(len(workers))
+
+    def create(title):
+        created.append(title)
+        time.sleep(0.2)
+        return f"id-{title}"
+
+    results = []
+
+    def ensure(store):
+        barrier.wait()
+        results.append(store.ensure_album("2021", create, poll=0.05))
+    threads = [threading.Thread(target=ensure, args=(store,)) for store in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert created == ["2021"]
+    assert results == ["id-2021"] * 4
+    assert workers[0].albums() == {"2021": "id-2021"}
+
+
+def test_failed_album_creation_is_retried(stores):
+    first, second = stores("first"), stores("second")
+
+    def fail(title):
+        raise RuntimeError("quota")
+    with pytest.raises(RuntimeError):
+        first.ensure_album("2021", fail)
+    assert second.ensure_album("2021", lambda title: "id-2021") == "id-2021"
+
+
+def test_expired_album_reservation_is_taken_over(stores):
+    first, second = stores("first", ttl=0.2), stores("second", ttl=0.2)
+    # A worker that died while creating the album
+    with first._transaction() as db:
+        db.execute("INSERT INTO albums (title, album_id, owner, expires) VALUES ('2021', NULL, 'first', ?)", (time.time() + 0.2,))
+    assert second.ensure_album("2021", lambda title: "id-2021", poll=0.05) == "id-2021"
@@ -0,0 +1,254 @@
+"""
+Upload scheduling for PhotoSync: separate small/large file lanes with their own worker threads, priority
+ordering inside each lane (smallest or newest first, optionally round-robin over albums), end-of-run retries
+of failed uploads, and a global bandwidth cap that can follow a time-of-day schedule.
+"""
+import datetime
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger("PhotoSync")
+
+# Seconds of traffic the limiter lets through in a burst before it starts delaying readers
+BURST_SECONDS = 1.0
+# How long a paused schedule window (rate 0) sleeps before checking the schedule again
+PAUSE_POLL_SECONDS = 30
+# Orders of the uploads inside a lane, see upload_priorities
+UPLOAD_ORDERS = ('size', 'newest', 'oldest')
+DEFAULT_RETRIES = 2
+# Seconds before the first retry round, doubled for each further round
+DEFAULT_RETRY_DELAY = 30
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def parse_rate(value):
+    """
+    Parse a bytes/second rate such as '500K', '2M' or '1.5G'.
+    'unlimited' (or an empty value) means no cap, '0' or 'off' pauses uploads.
+    """
+    if value is None:
+        return None
+    value = str(value).strip().upper()
+    if value in ('', 'UNLIMITED', '-'):
+        return None
+    if value == 'OFF':
+        return 0
+    multiplier = 1
+    if value[-1] in 'KMG':
+        multiplier = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}[value[-1]]
+        value = value[:-1]
+    return int(float(value) * multiplier)
+
+
+def parse_schedule(value):
+    """
+    Parse a time-of-day rate schedule, e.g. '08:00-23:00=1M,23:00-08:00=unlimited'.
+    Returns a list of (start minute, end minute, rate) windows, windows may wrap around midnight.
+    """
+    schedule = []
+    if not value:
+        return schedule
+    for window in value.split(','):
+        span, rate = window.split('=')
+        start, end = span.split('-')
+        start_hour, start_minute = (int(part) for part in start.split(':'))
+        end_hour, end_minute = (int(part) for part in end.split(':'))
+        schedule.append((start_hour * 60 + start_minute, end_hour * 60 + end_minute, parse_rate(rate)))
+    return schedule
+
+
+def upload_priorities(entries, order='size', round_robin=False):
+    """
+    Queue priorities of sync plan entries, lower runs first.
+        :param order: 'size' for smallest first (the most files online soonest), 'newest' or 'oldest' for capture date order.
+        :param round_robin: Interleave the albums: the first file of every album runs before the second file of any,
+            so a large backlog in one album does not hold back the others.
+        :return: One priority tuple per entry.
+    """
+    if order not in UPLOAD_ORDERS:
+        raise ValueError(f"Unknown upload order {order}")
+
+    def priority(entry):
+        if order == 'size':
+            return (entry["size"],)
+        seconds = (datetime.datetime.fromisoformat(entry["date"]) - EPOCH).total_seconds()
+        return (-seconds if order == 'newest' else seconds, entry["size"])
+    priorities = [priority(entry) for entry in entries]
+    if not round_robin:
+        return priorities
+    by_album = {}
+    for index, entry in enumerate(entries):
+        by_album.setdefault(entry["album"], []).append(index)
+    for indexes in by_album.values():
+        indexes.sort(key=priorities.__getitem__)
+        for rank, index in enumerate(indexes):
+            priorities[index] = (rank,) + priorities[index]
+    return priorities
+
+
+class BandwidthLimiter:
+    """
+    Shared bytes/second cap for all upload threads.
+        :param rate: Default rate in bytes/second, None for unlimited.
+        :param schedule: Optional time-of-day windows from parse_schedule, overriding the default rate.
+    """
+    def __init__(self, rate=None, schedule=None):
+        self.rate = rate
+        self.schedule = schedule or []
+        self._lock = threading.Lock()
+        self._next_free = time.monotonic()
+
+    def current_rate(self, now=None):
+        now = now or datetime.datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, rate in self.schedule:
+            if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+                return rate
+        return self.rate
+
+    def consume(self, nbytes):
+        """ Block until `nbytes` may be sent without exceeding the current rate. """
+        while True:
+            rate = self.current_rate()
+            if rate is None:
+                return
+            if rate == 0:
+                time.sleep(PAUSE_POLL_SECONDS)
+                continue
+            with self._lock:
+                now = time.monotonic()
+                self._next_free = max(self._next_free, now) + nbytes / rate
+                wait = self._next_free - now - BURST_SECONDS
+            if wait > 0:
+                time.sleep(wait)
+            return
+
+
+class UploadScheduler:
+    """
+    Runs upload tasks in two lanes with independent concurrency, so a few multi-GB videos
+    cannot hold every worker while thousands of small photos wait.
+    Inside a lane queued tasks run by priority, smallest first unless submitted with another priority,
+    which minimizes the time until N photos are synced.
+    Tasks can be submitted before start() (and are then ordered as a whole) or while the lanes are running.
+    Tasks whose upload raises or returns False are retried at the end, in up to `retries` rounds with a growing delay.
+        :param upload: Callable invoked with each task's arguments.
+        :param large_file_threshold: Files larger than this go to the large lane.
+        :param small_workers: Worker threads of the small lane.
+        :param large_workers: Worker threads of the large lane.
+        :param background_lane: Optional lane whose tasks only start while the other lane has none queued.
+        :param retries: Retry rounds for failed tasks.
+        :param retry_delay: Seconds before the first retry round, doubled for each further round.
+    """
+    def __init__(self, upload, large_file_threshold, small_workers=4, large_workers=1, background_lane=None,
+                 retries=0, retry_delay=DEFAULT_RETRY_DELAY):
+        self.upload = upload
+        self.large_file_threshold = large_file_threshold
+        self.workers = {"small": small_workers, "large": large_workers}
+        self.background_lane = background_lane
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.lanes = {"small": [], "large": []}
+        self.running = {}
+        self.failed = []
+        self.submitted = 0
+        self.closed = False
+        self.stopped = False
+        self.threads = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def __len__(self):
+        return self.submitted
+
+    def submit(self, size, *args, lane=None, priority=None):
+        """ Queue a task, in the lane picked by its size unless `lane` names one, ordered by `priority` (default its size). """
+        lane = lane or ("large" if size > self.large_file_threshold else "small")
+        with self._condition:
+            heapq.heappush(self.lanes[lane], (size if priority is None else priority, next(self._sequence), args))
+            self.submitted += 1
+            self._condition.notify_all()
+
+    def start(self):
+        """ Start the lane workers, they keep waiting for new tasks until finish() is called. """
+        for lane, workers in self.workers.items():
+            for index in range(workers):
+                thread = threading.Thread(target=self._work, args=(lane,), name=f"upload-{lane}-{index}")
+                thread.start()
+                self.threads.append(thread)
+
+    def finish(self):
+        """ Stop accepting tasks, wait for both lanes to drain, then retry the failed tasks. """
+        self._drain()
+        for attempt in range(self.retries):
+            with self._condition:
+                if not self.failed or self.stopped:
+                    break
+                failed, self.failed = self.failed, []
+            delay = self.retry_delay * 2 ** attempt
+            logger.warning(f"Retrying {len(failed)} failed uploads in {delay} seconds (round {attempt + 1} of {self.retries})")
+            time.sleep(delay)
+            with self._condition:
+                self.closed = False
+                for priority, lane, args in failed:
+                    heapq.heappush(self.lanes[lane], (priority, next(self._sequence), args))
+            self.start()
+            self._drain()
+        if self.failed:
+            logger.error(f"{len(self.failed)} uploads failed" + (f" after {self.retries} retry rounds" if self.retries else ""))
+
+    def _drain(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def stop(self):
+        """ Let the running tasks complete but start no queued ones, e.g. on an interrupt. The queued tasks stay in pending(). """
+        with self._condition:
+            self.stopped = self.closed = True
+            self._condition.notify_all()
+
+    def pending(self):
+        """ Arguments of the tasks not completed successfully: queued, running and failed, in priority order. """
+        with self._condition:
+            tasks = [(priority, sequence, args) for tasks in self.lanes.values() for priority, sequence, args in tasks]
+            tasks += [(priority, sequence, args) for sequence, (priority, _, args) in self.running.items()]
+            tasks += [(priority, 0, args) for priority, _, args in self.failed]
+        return [args for _, _, args in sorted(tasks, key=lambda task: task[:2])]
+
+    def run(self):
+        """ Run all submitted tasks and wait for them to complete. """
+        for lane, tasks in self.lanes.items():
+            if tasks:
+                logger.info(f"Scheduling {len(tasks)} uploads in the {lane} lane with {self.workers[lane]} workers")
+        self.start()
+        self.finish()
+
+    def _work(self, lane):
+        tasks = self.lanes[lane]
+        others = [queued for name, queued in self.lanes.items() if name != lane] if lane == self.background_lane else []
+        while True:
+            with self._condition:
+                while (not tasks and not self.closed) or (tasks and any(others) and not self.stopped):
+                    self._condition.wait()
+                if not tasks or self.stopped:
+                    return
+                priority, sequence, args = heapq.heappop(tasks)
+                self.running[sequence] = (priority, lane, args)
+                if self.background_lane is not None:
+                    self._condition.notify_all()
+            try:
+                succeeded = self.upload(*args) is not False
+            except Exception as err:
+                logger.error(f"Upload of {args} failed: {err}")
+                succeeded = False
+            with self._condition:
+                del self.running[sequence]
+                if not succeeded:
+                    self.failed.append((priority, lane, args))
@@ -0,0 +1,60 @@
+"""
+Constant-memory streaming of upload bodies. Files are read through a fixed-size buffer that each
+upload thread allocates once and reuses for every file, and the SHA-256 digest is computed from the
+same buffer while the bytes go out, so hashing costs no extra read pass.
+"""
+import hashlib
+import threading
+
+CHUNK_SIZE = 1024 * 1024
+
+_buffers = threading.local()
+
+
+def thread_buffer(size=CHUNK_SIZE):
+    """ Return this thread's reusable read buffer of `size` bytes. """
+    buffer = getattr(_buffers, 'buffer', None)
+    if buffer is None or len(buffer) != size:
+        buffer = _buffers.buffer = bytearray(size)
+    return buffer
+
+
+class UploadStream:
+    """
+    File wrapper passed as a streaming request body.
+        :param fileobj: File opened in binary mode.
+        :param size: Number of bytes the request will send (used for Content-Length).
+        :param limiter: Optional BandwidthLimiter charged for every chunk.
+        :param chunk_size: Size of the reused read buffer.
+    """
+    def __init__(self, fileobj, size, limiter=None, chunk_size=CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.size = size
+        self.limiter = limiter
+        self.view = memoryview(thread_buffer(chunk_size))
+        self.sha256 = hashlib.sha256()
+        self.bytes_read = 0
+
+    def __len__(self):
+        return self.size
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > len(self.view):
+            size = len(self.view)
+        count = self.fileobj.readinto(self.view[:size])
+        if not count:
+            return b""
+        chunk = self.view[:count]
+        self.sha256.update(chunk)
+        self.bytes_read += count
+        if self.limiter is not None:
+            self.limiter.consume(count)
+        return chunk
+
+    @property
+    def complete(self):
+        """ True once the whole file went through the stream, i.e. the digest covers all of it. """
+        return self.bytes_read == self.size
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()